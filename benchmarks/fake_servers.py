@@ -0,0 +1,389 @@
+"""
+离线基准测试使用的本地替身服务
+- FakeCobalt: 模拟 Cobalt API，返回指向 FakeCdn 的 tunnel 链接
+- FakeCdn: 静态文件服务，可配置带宽、首字节延迟和是否支持 Range
+- FakeBotApi: 模拟 Telegram Bot API，支持 getMe、getUpdates、sendMessage、editMessageText、sendVideo、sendMediaGroup，
+  通过 /__enqueue 添加供长轮询返回的更新
+所有服务基于 asyncio 实现，不依赖第三方 Web 框架，运行在独立进程中以免影响被测进程的内存统计
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import itertools
+import multiprocessing
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+ResponseBody = Union[bytes, AsyncIterator[bytes]]
+
+REASONS = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 404: 'Not Found',
+           416: 'Range Not Satisfiable', 429: 'Too Many Requests'}
+
+
+class Request:
+    """解析后的 HTTP 请求，请求体按需读取"""
+    def __init__(self, method: str, target: str, headers: Dict[str, str], reader: asyncio.StreamReader):
+        self.method = method
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.reader = reader
+        self.remaining = int(headers.get('content-length', 0))
+
+    async def iter_body(self, chunk_size: int = 256 * 1024) -> AsyncIterator[bytes]:
+        while self.remaining > 0:
+            chunk = await self.reader.read(min(chunk_size, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+            yield chunk
+
+    async def body(self) -> bytes:
+        return b''.join([chunk async for chunk in self.iter_body()])
+
+    async def drain(self):
+        async for _ in self.iter_body():
+            pass
+
+
+Handler = Callable[[Request], "asyncio.Future[Tuple[int, Dict[str, str], ResponseBody]]"]
+
+
+class HttpServer:
+    """最小的 HTTP/1.1 服务，支持长连接和流式响应"""
+    def __init__(self, handler: Handler, host: str = '127.0.0.1'):
+        self.handler = handler
+        self.host = host
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, port: int = 0) -> int:
+        self.server = await asyncio.start_server(self._serve, self.host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                request = Request(method, target, headers, reader)
+                status, response_headers, body = await self.handler(request)
+                await request.drain()
+
+                response_headers.setdefault('Connection', 'keep-alive')
+                if isinstance(body, bytes):
+                    response_headers['Content-Length'] = str(len(body))
+                head = f'HTTP/1.1 {status} {REASONS.get(status, "OK")}\r\n'
+                head += ''.join(f'{name}: {value}\r\n' for name, value in response_headers.items())
+                writer.write(head.encode('latin-1') + b'\r\n')
+                if method == 'HEAD':
+                    pass
+                elif isinstance(body, bytes):
+                    writer.write(body)
+                else:
+                    async for chunk in body:
+                        writer.write(chunk)
+                        await writer.drain()
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # 停止服务时挂起的长轮询被取消，直接关闭连接
+            pass
+        finally:
+            writer.close()
+
+
+def json_response(payload, status: int = 200):
+    return status, {'Content-Type': 'application/json'}, json.dumps(payload).encode()
+
+
+class FakeCdn:
+    """
+    视频文件服务
+    路径 /files/<名称>/<任意ID>.mp4 返回 files 中对应名称的文件，不同ID模拟不同的源地址
+    """
+    def __init__(self, files: Dict[str, str], bandwidth: float = 0, latency: float = 0.0,
+                 range_support: bool = True, chunk_size: int = 64 * 1024):
+        self.files = files
+        # 每个连接的带宽（字节/秒），0 表示不限
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.range_support = range_support
+        self.chunk_size = chunk_size
+        self.stats = {'requests': 0, 'range_requests': 0, 'bytes_sent': 0}
+
+    async def handle(self, request: Request):
+        match = re.match(r'^/files/([^/]+)/', request.path)
+        path = self.files.get(match.group(1)) if match else None
+        if not path:
+            return 404, {}, b'not found'
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        headers = {'Content-Type': 'video/mp4'}
+        if self.range_support:
+            headers['Accept-Ranges'] = 'bytes'
+            range_header = request.headers.get('range')
+            if range_header:
+                range_match = re.match(r'bytes=(\d*)-(\d*)', range_header)
+                if not range_match or not range_match.group(1) or int(range_match.group(1)) >= size:
+                    return 416, {'Content-Range': f'bytes */{size}'}, b''
+                start = int(range_match.group(1))
+                end = min(int(range_match.group(2) or size - 1), size - 1)
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+                self.stats['range_requests'] += 1
+        headers['Content-Length'] = str(end - start + 1)
+        return status, headers, self._stream(path, start, end)
+
+    async def _stream(self, path: str, start: int, end: int) -> AsyncIterator[bytes]:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.stats['bytes_sent'] += len(chunk)
+                yield chunk
+                if self.bandwidth:
+                    await asyncio.sleep(len(chunk) / self.bandwidth)
+
+
+class FakeCobalt:
+    """
+    Cobalt API 替身
+    请求 https://bench.local/v/<ID>?file=<名称> 时返回 FakeCdn 上对应文件的 tunnel 链接
+    """
+    def __init__(self, cdn_url: str, latency: float = 0.0):
+        self.cdn_url = cdn_url
+        self.latency = latency
+        self.stats = {'requests': 0}
+
+    async def handle(self, request: Request):
+        if request.method != 'POST':
+            return json_response({'status': 'error', 'error': {'code': 'error.api.method'}}, 400)
+        payload = json.loads(await request.body() or b'{}')
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        parts = urlsplit(payload.get('url', ''))
+        name = parse_qs(parts.query).get('file', ['default'])[0]
+        video_id = parts.path.rstrip('/').rsplit('/', 1)[-1] or 'video'
+        return json_response({
+            'status': 'tunnel',
+            'url': f'{self.cdn_url}/files/{name}/{video_id}.mp4',
+            'filename': f'{video_id}.mp4'
+        })
+
+
+class FakeBotApi:
+    """
+    Telegram Bot API 替身
+    记录每个方法的调用次数和上传字节数，sendVideo 可模拟 Telegram 的接收带宽
+    """
+    def __init__(self, upload_bandwidth: float = 0, api_latency: float = 0.0):
+        self.upload_bandwidth = upload_bandwidth
+        self.api_latency = api_latency
+        self.message_ids = itertools.count(1_000_000)
+        # 长轮询模式下待投递的更新
+        self.updates = []
+        self.update_event = asyncio.Event()
+        # replies 记录发给各聊天的消息及时间，用于计算从更新到首次回复的延迟；polls 记录每次 getUpdates 的时间
+        # local_files 记录按 file:// 路径发送的文件，即本地 Bot API 服务器模式下无需上传的文件
+        self.stats = {'calls': {}, 'upload_bytes': 0, 'videos': 0, 'replies': [], 'polls': [], 'local_files': []}
+
+    async def enqueue(self, request: Request):
+        """添加供 getUpdates 返回的更新"""
+        payload = json.loads(await request.body())
+        self.updates.extend(payload if isinstance(payload, list) else [payload])
+        self.update_event.set()
+        return json_response({'ok': True})
+
+    async def handle(self, request: Request):
+        match = re.match(r'^/bot[^/]+/(\w+)$', request.path)
+        if not match:
+            return json_response({'ok': False, 'error_code': 404, 'description': 'Not Found'}, 404)
+        method = match.group(1)
+        self.stats['calls'][method] = self.stats['calls'].get(method, 0) + 1
+        params = await self._read_params(request)
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+        if method == 'getMe':
+            return self._ok({'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'})
+        if method == 'getUpdates':
+            self.stats['polls'].append(time.time())
+            return self._ok(await self._get_updates(params))
+        if method in ('deleteWebhook', 'setWebhook', 'logOut', 'close'):
+            return self._ok(True)
+        if method == 'sendMessage':
+            message = self._message(params, text=params.get('text', ''))
+            self.stats['replies'].append([message['chat']['id'], time.time()])
+            return self._ok(message)
+        if method == 'editMessageText':
+            message = self._message(params, text=params.get('text', ''))
+            message['message_id'] = int(params.get('message_id', 0))
+            return self._ok(message)
+        if method == 'sendVideo':
+            self.stats['videos'] += 1
+            video = params.get('video', '')
+            if video.startswith('file://'):
+                self.stats['local_files'].append(video)
+            file_id = video if video and not video.startswith('attach://') and '/' not in video \
+                else f"video-{next(self.message_ids)}"
+            message = self._message(params, caption=params.get('caption'))
+            self.stats['replies'].append([message['chat']['id'], time.time()])
+            message['video'] = {
+                'file_id': file_id, 'file_unique_id': file_id,
+                'width': int(params.get('width', 0) or 0), 'height': int(params.get('height', 0) or 0),
+                'duration': int(params.get('duration', 0) or 0), 'file_size': params.get('_file_size', 0)
+            }
+            return self._ok(message)
+        if method == 'sendMediaGroup':
+            media = params.get('media', '[]')
+            media = json.loads(media) if isinstance(media, str) else media
+            self.stats['videos'] += len(media)
+            messages = []
+            for entry in media:
+                file_id = entry['media'] if not entry['media'].startswith('attach://') \
+                    else f"{entry['type']}-{next(self.message_ids)}"
+                message = self._message(params, caption=entry.get('caption'))
+                if entry['type'] == 'photo':
+                    message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1, 'height': 1}]
+                else:
+                    message['video'] = {'file_id': file_id, 'file_unique_id': file_id,
+                                        'width': 0, 'height': 0, 'duration': 0}
+                messages.append(message)
+            self.stats['replies'].append([int(params.get('chat_id', 0) or 0), time.time()])
+            return self._ok(messages)
+        return self._ok(True)
+
+    async def _get_updates(self, params: Dict[str, str]) -> list:
+        """按 offset 确认已投递的更新，没有新更新时长轮询等待"""
+        offset = int(params.get('offset', 0) or 0)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), min(float(params.get('timeout', 0) or 0), 10.0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get('limit', 100) or 100)]
+
+    async def _read_params(self, request: Request) -> Dict[str, str]:
+        """解析表单、JSON 或 multipart 参数；multipart 只保留开头的字段，文件内容按带宽读取后丢弃"""
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            prefix = bytearray()
+            total = 0
+            async for chunk in request.iter_body():
+                total += len(chunk)
+                if len(prefix) < 64 * 1024:
+                    prefix.extend(chunk[:64 * 1024])
+                if self.upload_bandwidth:
+                    await asyncio.sleep(len(chunk) / self.upload_bandwidth)
+            self.stats['upload_bytes'] += total
+            params = {
+                name.decode(errors='ignore'): value.decode(errors='ignore')
+                for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', bytes(prefix), re.S)
+            }
+            params['_file_size'] = total
+            return params
+        body = await request.body()
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        params.update(request.query)
+        return params
+
+    def _message(self, params: Dict[str, str], **fields) -> dict:
+        chat_id = int(params.get('chat_id', 0) or 0)
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'}
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+    @staticmethod
+    def _ok(result):
+        return json_response({'ok': True, 'result': result})
+
+
+async def _run_servers(config: dict, ready, stop_event):
+    """在当前进程中启动所有替身服务，并通过 /__stats 提供统计"""
+    cdn = FakeCdn(config['files'], config.get('cdn_bandwidth', 0), config.get('cdn_latency', 0.0),
+                  config.get('range_support', True))
+    cdn_port = await HttpServer(lambda r: _with_stats(r, cdn)).start()
+    cobalt = FakeCobalt(f'http://127.0.0.1:{cdn_port}', config.get('cobalt_latency', 0.0))
+    cobalt_port = await HttpServer(lambda r: _with_stats(r, cobalt)).start()
+    bot = FakeBotApi(config.get('upload_bandwidth', 0), config.get('api_latency', 0.0))
+    bot_port = await HttpServer(lambda r: _with_stats(r, bot)).start()
+
+    ready.send({'cdn': cdn_port, 'cobalt': cobalt_port, 'bot': bot_port})
+    while not stop_event.is_set():
+        await asyncio.sleep(0.2)
+
+
+async def _with_stats(request: Request, service):
+    if request.path == '/__stats':
+        return json_response(service.stats)
+    if request.path == '/__enqueue' and isinstance(service, FakeBotApi):
+        return await service.enqueue(request)
+    return await service.handle(request)
+
+
+def _server_process(config: dict, ready, stop_event):
+    asyncio.run(_run_servers(config, ready, stop_event))
+
+
+class FakeServices:
+    """在独立进程中运行全部替身服务"""
+    def __init__(self, config: dict):
+        self.config = config
+        self.ports: Dict[str, int] = {}
+        self.process: Optional[multiprocessing.Process] = None
+        self.stop_event = multiprocessing.Event()
+
+    def start(self) -> Dict[str, int]:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_server_process, args=(self.config, sender, self.stop_event), daemon=True
+        )
+        self.process.start()
+        if not receiver.poll(30):
+            raise RuntimeError("替身服务启动超时")
+        self.ports = receiver.recv()
+        return self.ports
+
+    def url(self, name: str) -> str:
+        return f'http://127.0.0.1:{self.ports[name]}'
+
+    def stop(self):
+        if self.process is not None:
+            self.stop_event.set()
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
@@ -0,0 +1,376 @@
+"""
+离线端到端基准测试
+
+启动本地的 Cobalt、CDN 和 Bot API 替身服务，用合成流量驱动 main.py 的消息处理，
+输出吞吐量、首次回复和完成延迟分位数、峰值内存和各阶段耗时的 JSON 结果，便于比较不同版本的性能。
+更新可以直接交给处理函数（direct），也可以经完整的 Application 通过长轮询（polling）或 Webhook（webhook）接收。
+
+用法（在项目根目录运行，需要 ffmpeg）:
+    python -m benchmarks.run --scenario mixed --requests 50 --output result.json
+    python -m benchmarks.run --scenario mixed --ingest webhook
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional
+
+import httpx
+import psutil
+
+from .fake_servers import FakeServices
+
+# 流量模型: 文件名称 -> (时长秒, 视频码率kbps)，以及各文件被请求的权重
+SAMPLE_FILES = {
+    'small': (20, 2000),      # 约5MB，无需处理
+    'medium': (60, 4000),     # 约30MB，无需处理
+    'large': (120, 6000),     # 约90MB，超过官方 Bot API 限制，需要压缩
+}
+
+SCENARIOS = {
+    # 每个请求都是不同的链接
+    'unique': {'weights': {'small': 6, 'medium': 3, 'large': 1}, 'duplicate_ratio': 0.0},
+    # 大部分请求集中在少数热门链接，测试请求合并和 file_id 缓存
+    'duplicate': {'weights': {'small': 6, 'medium': 3, 'large': 1}, 'duplicate_ratio': 0.8, 'hot_urls': 5},
+    # 全部为需要压缩的大文件
+    'large': {'weights': {'large': 1}, 'duplicate_ratio': 0.0},
+    # 混合流量
+    'mixed': {'weights': {'small': 6, 'medium': 3, 'large': 1}, 'duplicate_ratio': 0.3, 'hot_urls': 10},
+}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩法计算分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def generate_samples(workdir: str, names) -> Dict[str, str]:
+    """用 ffmpeg 生成测试视频，已存在时复用"""
+    files = {}
+    for name in names:
+        duration, bitrate = SAMPLE_FILES[name]
+        path = os.path.join(workdir, f'sample_{name}.mp4')
+        if not os.path.exists(path):
+            if shutil.which('ffmpeg') is None:
+                raise SystemExit("生成测试视频需要 ffmpeg，请先安装或在 --workdir 中提供 sample_<名称>.mp4")
+            subprocess.run([
+                'ffmpeg', '-v', 'error', '-y',
+                '-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=30:duration={duration}',
+                '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', f'{bitrate}k',
+                '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', path
+            ], check=True)
+        files[name] = path
+    return files
+
+
+class RssSampler:
+    """在后台线程中采样本进程及子进程（ffmpeg）的常驻内存峰值"""
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.process = psutil.Process(os.getpid())
+        self.peak = 0
+        self.peak_children = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                rss = self.process.memory_info().rss
+                children = 0
+                for child in self.process.children(recursive=True):
+                    try:
+                        children += child.memory_info().rss
+                    except psutil.Error:
+                        pass
+                self.peak = max(self.peak, rss)
+                self.peak_children = max(self.peak_children, rss + children)
+            except psutil.Error:
+                pass
+            self.stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def build_traffic(scenario: dict, count: int, users: int, rng: random.Random) -> List[dict]:
+    """生成请求序列: 用户ID和链接"""
+    names = list(scenario['weights'])
+    weights = [scenario['weights'][name] for name in names]
+    hot_urls = [
+        f"https://bench.local/v/hot{i}?file={rng.choices(names, weights)[0]}"
+        for i in range(scenario.get('hot_urls', 1))
+    ]
+    traffic = []
+    for i in range(count):
+        if rng.random() < scenario['duplicate_ratio']:
+            url = rng.choice(hot_urls)
+        else:
+            url = f"https://bench.local/v/{i}?file={rng.choices(names, weights)[0]}"
+        traffic.append({'user_id': 10_000 + rng.randrange(users), 'url': url})
+    return traffic
+
+
+def configure_environment(services: FakeServices, workdir: str, args):
+    """在导入 main 之前设置环境变量，使机器人连接替身服务"""
+    os.environ.update({
+        'TOKEN': '123456:BENCHMARK',
+        'COBALT_API_URL': services.url('cobalt') + '/',
+        'TELEGRAM_API_URL': services.url('bot') + '/bot',
+        'DOWNLOAD_DIR': os.path.join(workdir, 'download'),
+        'METRICS_PORT': '0',
+        'STATUS_MIN_INTERVAL': str(args.status_interval),
+        'BOT_ROLE': 'all',
+    })
+    # 每次运行使用空的任务队列，避免恢复上次未完成的任务
+    for suffix in ('', '-wal', '-shm'):
+        path = os.path.join(workdir, 'download', '.state', 'jobs.db' + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+    if args.ingest == 'webhook':
+        os.environ.update({
+            'WEBHOOK_URL': 'https://bench.local',
+            'WEBHOOK_LISTEN': '127.0.0.1',
+            'WEBHOOK_PORT': str(args.webhook_port),
+            'WEBHOOK_SECRET_TOKEN': 'benchmark',
+        })
+
+
+def make_update(index: int, item: dict) -> dict:
+    """构造群聊消息更新：每个请求使用独立的聊天ID以便匹配首次回复，用户ID决定公平调度"""
+    chat_id = -(index + 1)
+    return {
+        'update_id': index + 1,
+        'message': {
+            'message_id': index + 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'bench'},
+            'from': {'id': item['user_id'], 'is_bot': False, 'first_name': 'bench', 'username': f"u{item['user_id']}"},
+            'text': item['url']
+        }
+    }
+
+
+async def drive_direct(bot_module, bot, traffic: List[dict], rate: float, rng: random.Random) -> List[dict]:
+    """直接调用处理函数，分别记录首次回复延迟和任务完成的延迟"""
+    from telegram import Update
+
+    results = []
+
+    async def one(index: int, item: dict):
+        update = Update.de_json(make_update(index, item), bot)
+        start = time.perf_counter()
+        job_id = await bot_module.accept_message(update, None)
+        first_reply = time.perf_counter() - start
+        if job_id is not None:
+            await bot_module.job_store.wait(job_id)
+        results.append({'url': item['url'], 'first_reply': first_reply, 'latency': time.perf_counter() - start})
+
+    tasks = []
+    for index, item in enumerate(traffic):
+        tasks.append(asyncio.create_task(one(index, item)))
+        if rate > 0:
+            await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return results
+
+
+async def drive_application(bot_module, application, services: FakeServices, traffic: List[dict], rate: float,
+                            rng: random.Random, ingest: str) -> List[dict]:
+    """
+    通过完整的 Application 接收更新：长轮询时由 Bot API 替身投递，Webhook 时直接 POST 到机器人
+    首次回复延迟由 Bot API 替身记录的回复时间计算，完成延迟取自 job_duration 指标
+    """
+    await application.start()
+    await bot_module.start_ingestion(application)
+
+    metrics = bot_module.metrics
+    sent_at: Dict[int, float] = {}
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        if ingest == 'webhook':
+            target = f"http://127.0.0.1:{bot_module.WEBHOOK_PORT}/{bot_module.WEBHOOK_PATH}"
+            headers = {'X-Telegram-Bot-Api-Secret-Token': bot_module.WEBHOOK_SECRET_TOKEN}
+        else:
+            target = services.url('bot') + '/__enqueue'
+            headers = {}
+
+        for index, item in enumerate(traffic):
+            payload = make_update(index, item)
+            sent_at[payload['message']['chat']['id']] = time.time()
+            response = await client.post(target, json=payload, headers=headers)
+            response.raise_for_status()
+            if rate > 0:
+                await asyncio.sleep(rng.expovariate(rate))
+
+        # 等待所有请求处理完成：每个请求最终计入 jobs 或缓存命中
+        while metrics.counter_value(metrics.jobs) + metrics.counter_value(metrics.cache_hits) < len(traffic):
+            await asyncio.sleep(0.2)
+        replies = (await client.get(services.url('bot') + '/__stats')).json()['replies']
+
+    await application.updater.stop()
+    await application.stop()
+
+    first_replies: Dict[int, float] = {}
+    for chat_id, timestamp in replies:
+        first_replies.setdefault(chat_id, timestamp)
+    results = []
+    for index, item in enumerate(traffic):
+        chat_id = -(index + 1)
+        first_reply = first_replies.get(chat_id)
+        results.append({'url': item['url'], 'first_reply': first_reply - sent_at[chat_id] if first_reply else None})
+    return results
+
+
+def summarize_latency(values: List[float]) -> dict:
+    return {
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None,
+    }
+
+
+async def run_benchmark(args) -> dict:
+    scenario = SCENARIOS[args.scenario]
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bot-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    files = generate_samples(workdir, scenario['weights'])
+    services = FakeServices({
+        'files': files,
+        'cdn_bandwidth': args.cdn_bandwidth * 1024 * 1024,
+        'cdn_latency': args.cdn_latency,
+        'range_support': not args.no_range,
+        'cobalt_latency': args.cobalt_latency,
+        'upload_bandwidth': args.upload_bandwidth * 1024 * 1024,
+        'api_latency': args.api_latency,
+    })
+    services.start()
+    try:
+        configure_environment(services, workdir, args)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import main as bot_module
+
+        # 与 main() 相同的 Application 和请求层，连接 Bot API 替身；任务在本进程的 worker 中执行
+        application = bot_module.build_application()
+        await application.initialize()
+        await bot_module.start_services(application.bot)
+
+        traffic = build_traffic(scenario, args.requests, args.users, rng)
+        with RssSampler() as rss:
+            start = time.perf_counter()
+            if args.ingest == 'direct':
+                results = await drive_direct(bot_module, application.bot, traffic, args.rate, rng)
+            else:
+                results = await drive_application(bot_module, application, services, traffic, args.rate, rng, args.ingest)
+            elapsed = time.perf_counter() - start
+
+        async with httpx.AsyncClient() as client:
+            service_stats = {
+                name: (await client.get(services.url(name) + '/__stats')).json()
+                for name in ('cobalt', 'cdn', 'bot')
+            }
+
+        metrics = bot_module.metrics
+        stage_summary = metrics.summary()
+        await bot_module.stop_services()
+        await application.shutdown()
+    finally:
+        services.stop()
+
+    first_replies = [result['first_reply'] for result in results if result['first_reply'] is not None]
+    if args.ingest == 'direct':
+        latency = summarize_latency([result['latency'] for result in results])
+    else:
+        # 经 Application 接收时无法逐个等待后台任务，完成延迟使用指标分桶估算
+        latency = {
+            'p50': metrics.quantile(metrics.job_duration, 0.50),
+            'p95': metrics.quantile(metrics.job_duration, 0.95),
+            'p99': metrics.quantile(metrics.job_duration, 0.99),
+        }
+    succeeded = int(metrics.counter_value(metrics.jobs, result='success'))
+    cache_hits = int(metrics.counter_value(metrics.cache_hits))
+    return {
+        'scenario': args.scenario,
+        'ingest': args.ingest,
+        'config': {
+            'requests': args.requests, 'users': args.users, 'rate': args.rate, 'seed': args.seed,
+            'cdn_bandwidth_mb': args.cdn_bandwidth, 'cdn_latency': args.cdn_latency,
+            'range_support': not args.no_range, 'upload_bandwidth_mb': args.upload_bandwidth,
+            'cobalt_latency': args.cobalt_latency, 'api_latency': args.api_latency,
+        },
+        'environment': {
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'duration_s': elapsed,
+        'succeeded': succeeded + cache_hits,
+        'failed': len(results) - succeeded - cache_hits,
+        'throughput_rps': len(results) / elapsed if elapsed else None,
+        'download_mb_per_s': service_stats['cdn']['bytes_sent'] / 1024 / 1024 / elapsed if elapsed else None,
+        'first_reply_latency_s': summarize_latency(first_replies),
+        'latency_s': latency,
+        'peak_rss_mb': rss.peak / 1024 / 1024,
+        'peak_rss_with_children_mb': rss.peak_children / 1024 / 1024,
+        'stages': stage_summary,
+        'cache_hits': cache_hits,
+        'coalesced': int(metrics.counter_value(metrics.coalesced)),
+        'services': service_stats,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='离线端到端基准测试')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed', help='流量模型')
+    parser.add_argument('--ingest', choices=('direct', 'polling', 'webhook'), default='direct',
+                        help='更新接收方式: 直接调用处理函数、长轮询或 Webhook')
+    parser.add_argument('--webhook-port', type=int, default=18443, help='Webhook 模式下机器人监听的端口')
+    parser.add_argument('--requests', type=int, default=30, help='请求总数')
+    parser.add_argument('--users', type=int, default=10, help='用户数')
+    parser.add_argument('--rate', type=float, default=2.0, help='平均到达速率（请求/秒），0 表示同时发出')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子')
+    parser.add_argument('--cdn-bandwidth', type=float, default=20, help='CDN 每连接带宽（MB/s），0 表示不限')
+    parser.add_argument('--cdn-latency', type=float, default=0.05, help='CDN 首字节延迟（秒）')
+    parser.add_argument('--no-range', action='store_true', help='CDN 不支持 Range 请求')
+    parser.add_argument('--cobalt-latency', type=float, default=0.2, help='Cobalt 解析延迟（秒）')
+    parser.add_argument('--upload-bandwidth', type=float, default=10, help='Bot API 接收带宽（MB/s），0 表示不限')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='Bot API 每次调用的延迟（秒）')
+    parser.add_argument('--status-interval', type=float, default=3.0, help='状态消息最小编辑间隔（秒）')
+    parser.add_argument('--workdir', help='工作目录，默认使用临时目录；测试视频会缓存在此处')
+    parser.add_argument('--output', help='结果 JSON 文件路径，默认输出到标准输出')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run_benchmark(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+冷启动基准测试
+
+测量两项指标:
+- import_s: 在新的解释器中导入 main 模块的耗时（不含解释器自身启动）
+- first_poll_s: 从启动 main.py 进程到 Bot API 收到第一次 getUpdates 的耗时，即重启后开始接收更新的时间
+同时记录收到 SIGTERM 后进程退出的耗时。机器人连接本地的 Bot API 替身服务，不需要网络和 ffmpeg。
+
+用法（在项目根目录运行）:
+    python -m benchmarks.startup --runs 5 --output startup.json
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import List, Optional
+
+import httpx
+
+from .fake_servers import FakeServices
+from .run import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bot_environment(services: FakeServices, workdir: str, role: str) -> dict:
+    """子进程使用的环境变量，连接替身服务并使用独立的下载目录"""
+    return dict(
+        os.environ,
+        TOKEN='123456:BENCHMARK',
+        COBALT_API_URL=services.url('cobalt') + '/',
+        TELEGRAM_API_URL=services.url('bot') + '/bot',
+        DOWNLOAD_DIR=os.path.join(workdir, 'download'),
+        METRICS_PORT='0',
+        BOT_ROLE=role,
+        WORKER_PROCESSES='0',
+        PYTHONUNBUFFERED='1',
+    )
+
+
+def measure_import(env: dict) -> float:
+    """在新的解释器中导入 main，返回导入耗时"""
+    code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    ).stdout
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def measure_first_poll(services: FakeServices, env: dict, timeout: float) -> dict:
+    """启动 main.py，等待第一次 getUpdates 后发送 SIGTERM 并等待退出"""
+    stats_url = services.url('bot') + '/__stats'
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, 'main.py'], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    first_poll = None
+    try:
+        while time.time() - start < timeout and process.poll() is None:
+            polls = [t for t in httpx.get(stats_url).json()['polls'] if t >= start]
+            if polls:
+                first_poll = min(polls) - start
+                break
+            time.sleep(0.1)
+    finally:
+        stop_start = time.time()
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        shutdown = time.time() - stop_start
+    return {'first_poll_s': first_poll, 'shutdown_s': shutdown, 'returncode': process.returncode}
+
+
+def summarize(values: List[Optional[float]]) -> dict:
+    values = [value for value in values if value is not None]
+    if not values:
+        return {'runs': 0}
+    return {
+        'runs': len(values),
+        'min': round(min(values), 4),
+        'p50': round(percentile(values, 0.5), 4),
+        'max': round(max(values), 4),
+    }
+
+
+def run_benchmark(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bot-startup-')
+    services = FakeServices({'files': {}, 'api_latency': args.api_latency})
+    services.start()
+    try:
+        env = bot_environment(services, workdir, args.role)
+        imports = [measure_import(env) for _ in range(args.runs)]
+        starts = [measure_first_poll(services, env, args.timeout) for _ in range(args.runs)]
+    finally:
+        services.stop()
+    return {
+        'python': platform.python_version(),
+        'role': args.role,
+        'runs': args.runs,
+        'import_s': summarize(imports),
+        'first_poll_s': summarize([run['first_poll_s'] for run in starts]),
+        'shutdown_s': summarize([run['shutdown_s'] for run in starts]),
+        'failed_runs': sum(1 for run in starts if run['first_poll_s'] is None),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='冷启动基准测试')
+    parser.add_argument('--runs', type=int, default=5, help='重复次数')
+    parser.add_argument('--role', choices=('all', 'ingest'), default='all', help='机器人角色')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='Bot API 每次调用的延迟（秒）')
+    parser.add_argument('--timeout', type=float, default=60, help='等待第一次 getUpdates 的超时（秒）')
+    parser.add_argument('--workdir', help='工作目录，默认使用临时目录')
+    parser.add_argument('--output', help='结果 JSON 文件路径，默认输出到标准输出')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run_benchmark(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,148 +1,385 @@
 import logging
 import os
-import re
 import uuid
+import hashlib
 import time
 import asyncio
 import sys
+import signal
+import contextlib
+import sqlite3
+from typing import Dict, Optional
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Message, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import TimedOut, NetworkError
-import backoff
+from telegram.error import TimedOut, NetworkError, BadRequest
 import threading
-import json
-import psutil
-
-import ssl
-import httpx
-from telegram.request import HTTPXRequest
 
 # 导入自定义模块
 from utils.resource_monitor import ResourceMonitor
-from utils.download_manager import DownloadManager
+from utils.download_manager import DownloadManager, TRANSIENT_ERRORS
 from utils.video_processor import VideoProcessor
 from utils.instance_manager import SingleInstanceManager
+from utils.file_id_cache import FileIdCache
+from utils.url_utils import normalize_url, extract_urls
+from utils.cobalt_client import CobaltClient, CobaltError, RateLimitedError
+from utils.job_scheduler import JobScheduler, QueueFullError
+from utils.job_store import Job, JobStore, JobWorker
+from utils.transcode_pool import TranscodePool
+from utils.bot_api import BotApiSettings
+from utils.streaming_upload import StreamingHTTPXRequest, StreamingInputFile
+from utils.status_updater import StatusMessage, StatusUpdater, format_transfer_progress
+from utils.metrics import Metrics
+from utils.storage_manager import StorageManager
+from utils.bandwidth_manager import BandwidthManager
+from utils.media_group import MediaItem, picker_kind, split_media_groups, build_input_media
+from utils import tracing
+from utils.tracing import Tracer, TraceContextFilter, JsonFormatter, format_timeline
 
 # 加载环境变量和设置日志
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
-DOWNLOAD_DIR = "download"
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', "download")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-COBALT_API_URL = os.getenv('COBALT_API_URL', "http://localhost:9999/")
+STATE_DIR = os.path.join(DOWNLOAD_DIR, ".state")  # 持久化状态目录，不参与定期清理
+STORAGE_DIR = os.path.join(DOWNLOAD_DIR, "store")  # 按内容寻址的视频存储目录
+COBALT_API_URL = os.getenv('COBALT_API_URL', "http://localhost:9999/")  # 多个实例用逗号分隔
+COBALT_API_TOKEN = os.getenv('COBALT_API_TOKEN')
+COBALT_POOL_SIZE = int(os.getenv('COBALT_POOL_SIZE', 20))  # Cobalt 连接池大小
+COBALT_TIMEOUT = float(os.getenv('COBALT_TIMEOUT', 30))  # Cobalt 请求超时（秒）
+COBALT_HTTP2 = os.getenv('COBALT_HTTP2', 'true').lower() == 'true'  # 服务端支持时使用 HTTP/2
+COBALT_FAILURE_THRESHOLD = int(os.getenv('COBALT_FAILURE_THRESHOLD', 3))  # 实例连续失败多少次后熔断
+COBALT_COOLDOWN = float(os.getenv('COBALT_COOLDOWN', 30))  # 熔断后多久放行探测请求（秒）
+COBALT_CACHE_TTL = float(os.getenv('COBALT_CACHE_TTL', 300))  # 解析结果缓存时间（秒），不超过链接的过期时间
+COBALT_NEGATIVE_TTL = float(os.getenv('COBALT_NEGATIVE_TTL', 60))  # 不支持、不可用等永久性错误的缓存时间（秒）
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))  # 下载读取缓冲区大小（字节）
+DOWNLOAD_SEGMENTS = int(os.getenv('DOWNLOAD_SEGMENTS', 4))  # 大文件分段下载的并行连接数
+DOWNLOAD_SEGMENT_MIN_SIZE = int(os.getenv('DOWNLOAD_SEGMENT_MIN_SIZE', 16 * 1024 * 1024))  # 启用分段下载的最小文件大小（字节）
+MIN_DISK_FREE_MB = int(os.getenv('MIN_DISK_FREE_MB', 1024))  # 下载目录最小可用空间（MB）
+STORAGE_QUOTA_MB = int(os.getenv('STORAGE_QUOTA_MB', 20 * 1024))  # 视频存储的总大小配额（MB）
+STORAGE_EVICTION_POLICY = os.getenv('STORAGE_EVICTION_POLICY', 'lru').lower()  # 淘汰策略: lru 或 lfu
+STORAGE_GRACE_SECONDS = float(os.getenv('STORAGE_GRACE_SECONDS', 600))  # 最近访问的文件在此时间内不会被淘汰
+RESOURCE_SAMPLE_INTERVAL = float(os.getenv('RESOURCE_SAMPLE_INTERVAL', 2.0))  # 资源采样间隔（秒）
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 8))  # 全局最大并发任务数
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 100))  # 全局最大排队任务数
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 3))  # 每个用户的最大并发任务数
+MAX_QUEUED_PER_USER = int(os.getenv('MAX_QUEUED_PER_USER', 10))  # 本进程调度器中每个用户的最大排队数
+MAX_BATCH_ITEMS = int(os.getenv('MAX_BATCH_ITEMS', 20))  # 一条消息中最多处理的链接数和媒体数
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', 6))  # 下载阶段并发数
+TRANSCODE_PROCESSES = int(os.getenv('TRANSCODE_PROCESSES', 0)) or None  # 转码进程数，默认为CPU核心数的一半
+TRANSCODE_THREADS = int(os.getenv('TRANSCODE_THREADS', 0)) or None  # 每个转码进程的线程数，默认平分CPU核心
+TRANSCODE_NICE = int(os.getenv('TRANSCODE_NICE', 10))  # 转码进程的 nice 值
+TRANSCODE_TWO_PASS = os.getenv('TRANSCODE_TWO_PASS', 'true').lower() == 'true'  # 压缩时使用两遍编码
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', 4))  # 上传阶段并发数
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'  # 根据耗时、吞吐量和超时自动调整各阶段并发数，以上述并发数为初始值
+DOWNLOAD_CONCURRENCY_MAX = int(os.getenv('DOWNLOAD_CONCURRENCY_MAX', 0)) or DOWNLOAD_CONCURRENCY * 2  # 下载阶段自适应并发数上限
+TRANSCODE_PROCESSES_MAX = int(os.getenv('TRANSCODE_PROCESSES_MAX', 0)) or os.cpu_count() or 1  # 转码进程数自适应上限，默认为CPU核心数
+UPLOAD_CONCURRENCY_MAX = int(os.getenv('UPLOAD_CONCURRENCY_MAX', 0)) or UPLOAD_CONCURRENCY * 2  # 上传阶段自适应并发数上限
+FILE_ID_CACHE_TTL = int(os.getenv('FILE_ID_CACHE_TTL', 7 * 24 * 3600))  # file_id 缓存有效期（秒）
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv('FILE_ID_CACHE_MAX_ENTRIES', 10000))  # file_id 缓存最大条目数
+FILE_ID_CACHE_MAX_MB = int(os.getenv('FILE_ID_CACHE_MAX_MB', 0))  # file_id 缓存对应文件的总大小上限（MB），0 表示不限制
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # 自建 Bot API 服务器地址，如 http://telegram-bot-api:8081/bot
+TELEGRAM_API_FILE_URL = os.getenv('TELEGRAM_API_FILE_URL')  # 文件下载地址，默认由 TELEGRAM_API_URL 推导
+TELEGRAM_LOCAL_MODE = os.getenv('TELEGRAM_LOCAL_MODE', 'false').lower() == 'true'  # Bot API 服务器以 --local 模式运行
+TELEGRAM_API_DOWNLOAD_DIR = os.getenv('TELEGRAM_API_DOWNLOAD_DIR')  # 下载目录在 Bot API 服务器中的路径，默认与本机相同
+BANDWIDTH_INGRESS_MBIT = float(os.getenv('BANDWIDTH_INGRESS_MBIT', 0))  # 下载总带宽上限（Mbit/s），0 表示不限速
+BANDWIDTH_EGRESS_MBIT = float(os.getenv('BANDWIDTH_EGRESS_MBIT', 0))  # 上传总带宽上限（Mbit/s），0 表示不限速
+BANDWIDTH_RESERVE = float(os.getenv('BANDWIDTH_RESERVE', 0.1))  # 为 Telegram API 调用等控制流量预留的带宽比例
+USER_BANDWIDTH_MBIT = float(os.getenv('USER_BANDWIDTH_MBIT', 0))  # 单个用户每个方向的带宽上限（Mbit/s），0 表示可借用全部空闲带宽
+UPLOAD_TIMEOUT = float(os.getenv('UPLOAD_TIMEOUT', 300))  # 发送视频的超时时间（秒）
+STATUS_MIN_INTERVAL = float(os.getenv('STATUS_MIN_INTERVAL', 3.0))  # 同一状态消息两次编辑的最小间隔（秒）
+STATUS_CHAT_RATE = float(os.getenv('STATUS_CHAT_RATE', 1.0))  # 每个聊天每秒最多编辑次数
+STATUS_GLOBAL_RATE = float(os.getenv('STATUS_GLOBAL_RATE', 25.0))  # 整个机器人每秒最多编辑次数
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))  # Prometheus /metrics 端口，0 表示不启动
+METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')  # /metrics 监听地址
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 64))  # 同时处理的更新数上限
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # 公网地址，如 https://bot.example.com，设置后使用 Webhook 模式
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')  # Webhook 监听地址
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))  # Webhook 监听端口
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')  # Webhook 路径
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or uuid.uuid4().hex  # 校验请求来自 Telegram，未设置时每次启动随机生成
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # Telegram 向 Webhook 建立的最大连接数
+BOT_ROLE = os.getenv('BOT_ROLE', 'all').lower()  # all: 接收更新并处理任务; ingest: 只接收更新; worker: 只处理任务
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 0))  # all/ingest 角色额外启动的 worker 子进程数
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', 0))  # worker 子进程编号，用于区分指标端口
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', 60))  # 任务租约时长（秒），worker 崩溃后超过此时间任务被重新领取
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))  # 每个任务的最大尝试次数
+JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', 10))  # 任务失败后重新排队的延迟（秒）
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1.0))  # worker 轮询新任务的间隔（秒）
+QUEUE_POSITION_INTERVAL = float(os.getenv('QUEUE_POSITION_INTERVAL', 10.0))  # 更新排队位置的间隔（秒）
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # text: 普通文本; json: 每行一条 JSON，便于日志系统采集
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}  # 可使用 /trace 的用户ID，逗号分隔
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.05))  # 普通任务时间线的输出比例，失败和慢任务总是输出
+TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', 60))  # 超过此耗时或近期 P95 的任务视为慢任务
+
+if BOT_ROLE not in ('all', 'ingest', 'worker'):
+    raise SystemExit(f"无效的 BOT_ROLE: {BOT_ROLE}，可选 all、ingest、worker")
+# 每个用户同时运行的任务各自向调度器提交媒体，排队上限至少要容纳每个任务一个
+if MAX_QUEUED_PER_USER < MAX_CONCURRENT_DOWNLOADS:
+    raise SystemExit(
+        f"MAX_QUEUED_PER_USER ({MAX_QUEUED_PER_USER}) 不能小于 MAX_CONCURRENT_DOWNLOADS ({MAX_CONCURRENT_DOWNLOADS})"
+    )
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+for handler in logging.getLogger().handlers:
+    # 日志附带当前任务ID，JSON 格式下追踪记录附带完整时间线
+    handler.addFilter(TraceContextFilter())
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
 logger = logging.getLogger(__name__)
 
+# Bot API 服务器配置，本地模式下上传限制为2000MB
+bot_api = BotApiSettings(
+    base_url=TELEGRAM_API_URL,
+    base_file_url=TELEGRAM_API_FILE_URL,
+    local_mode=TELEGRAM_LOCAL_MODE,
+    download_dir=DOWNLOAD_DIR,
+    server_download_dir=TELEGRAM_API_DOWNLOAD_DIR
+)
+MAX_VIDEO_SIZE_MB = int(os.getenv('MAX_VIDEO_SIZE_MB', 0)) or bot_api.upload_limit_mb  # 视频大小限制（MB）
+
+# Prometheus 指标，/stats 命令读取同一注册表
+metrics = Metrics()
+
 # 初始化资源管理器和下载管理器
-resource_monitor = ResourceMonitor(memory_threshold=75, min_memory_available=500)
+resource_monitor = ResourceMonitor(
+    memory_threshold=75,
+    min_memory_available=500,
+    min_disk_free=MIN_DISK_FREE_MB,
+    disk_path=DOWNLOAD_DIR,
+    sample_interval=RESOURCE_SAMPLE_INTERVAL
+)
+# 视频按内容摘要存储，总大小受配额限制，下载前按可用空间准入
+storage_manager = StorageManager(
+    root=STORAGE_DIR,
+    quota_bytes=STORAGE_QUOTA_MB * 1024 * 1024,
+    min_free_bytes=MIN_DISK_FREE_MB * 1024 * 1024,
+    policy=STORAGE_EVICTION_POLICY,
+    grace=STORAGE_GRACE_SECONDS
+)
+# 下载和上传分别共享入站、出站带宽，按用户均分并为控制流量预留一部分
+bandwidth_manager = BandwidthManager(
+    ingress_rate=BANDWIDTH_INGRESS_MBIT * 125000,
+    egress_rate=BANDWIDTH_EGRESS_MBIT * 125000,
+    reserve=BANDWIDTH_RESERVE,
+    user_ingress_rate=USER_BANDWIDTH_MBIT * 125000,
+    user_egress_rate=USER_BANDWIDTH_MBIT * 125000
+)
 download_manager = DownloadManager(
-    max_workers=8,  # 基于CPU核心数(4)的2倍优化线程数
-    max_concurrent_per_user=3,  # 每个用户的最大并发下载数
+    max_workers=8,  # 下载连接池大小
     download_timeout=180,  # 下载超时时间（秒）
     max_retries=3,  # 最大重试次数
     max_file_size=2000,  # 最大文件大小限制(MB)
-    download_dir=DOWNLOAD_DIR
+    download_dir=DOWNLOAD_DIR,
+    chunk_size=DOWNLOAD_CHUNK_SIZE,
+    progress_interval=1.0,  # 进度回调间隔（秒），状态消息的编辑频率由 status_updater 控制
+    segments=DOWNLOAD_SEGMENTS,
+    segment_min_size=DOWNLOAD_SEGMENT_MIN_SIZE,
+    metrics=metrics,
+    storage=storage_manager,
+    bandwidth=bandwidth_manager
+)
+job_scheduler = JobScheduler(
+    max_workers=MAX_WORKERS,
+    max_queue_size=MAX_QUEUE_SIZE,
+    max_concurrent_per_user=MAX_CONCURRENT_DOWNLOADS,
+    max_queued_per_user=MAX_QUEUED_PER_USER,
+    stage_limits={
+        'download': DOWNLOAD_CONCURRENCY,
+        'upload': UPLOAD_CONCURRENCY
+    },
+    # 各阶段上限在 1 和给定值之间自适应，超时和连接错误计为过载信号；
+    # BadRequest、文件过大、下载链接失效（4xx）、磁盘空间不足等其他错误不影响上限
+    adaptive_limits={
+        'download': DOWNLOAD_CONCURRENCY_MAX,
+        'upload': UPLOAD_CONCURRENCY_MAX
+    } if ADAPTIVE_CONCURRENCY else None,
+    drop_errors=(TimedOut, *TRANSIENT_ERRORS, asyncio.TimeoutError, ConnectionError),
+    resource_monitor=resource_monitor,
+    backpressure=lambda: transcode_pool.saturated
+)
+transcode_pool = TranscodePool(
+    max_processes=TRANSCODE_PROCESSES,
+    threads_per_job=TRANSCODE_THREADS,
+    niceness=TRANSCODE_NICE,
+    adaptive_max=TRANSCODE_PROCESSES_MAX if ADAPTIVE_CONCURRENCY else None
+)
+video_processor = VideoProcessor(
+    max_size_mb=MAX_VIDEO_SIZE_MB,
+    transcode_pool=transcode_pool,
+    two_pass=TRANSCODE_TWO_PASS,
+    metrics=metrics
 )
-video_processor = VideoProcessor(max_size_mb=50)
+file_id_cache = FileIdCache(
+    db_path=os.path.join(STATE_DIR, "file_id_cache.db"),
+    ttl=FILE_ID_CACHE_TTL,
+    max_entries=FILE_ID_CACHE_MAX_ENTRIES,
+    max_bytes=FILE_ID_CACHE_MAX_MB * 1024 * 1024
+)
+# 持久化任务队列，位于下载目录中，由所有进程共享
+job_store = JobStore(
+    db_path=os.path.join(STATE_DIR, "jobs.db"),
+    lease_seconds=JOB_LEASE_SECONDS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    max_queued=MAX_QUEUE_SIZE,
+    max_running_per_user=MAX_CONCURRENT_DOWNLOADS
+)
+status_updater = StatusUpdater(
+    min_interval=STATUS_MIN_INTERVAL,
+    chat_rate=STATUS_CHAT_RATE,
+    global_rate=STATUS_GLOBAL_RATE
+)
+# 任务时间线，慢任务、失败任务和抽样任务输出到 trace 日志，并保存到任务记录中供 /trace 查询
+tracer = Tracer(
+    sample_rate=TRACE_SAMPLE_RATE,
+    slow_seconds=TRACE_SLOW_SECONDS
+)
+cobalt_client = CobaltClient(
+    api_urls=COBALT_API_URL,
+    api_key=COBALT_API_TOKEN,
+    max_connections=COBALT_POOL_SIZE,
+    max_keepalive_connections=COBALT_POOL_SIZE,
+    timeout=COBALT_TIMEOUT,
+    http2=COBALT_HTTP2,
+    failure_threshold=COBALT_FAILURE_THRESHOLD,
+    cooldown=COBALT_COOLDOWN,
+    cache_ttl=COBALT_CACHE_TTL,
+    negative_ttl=COBALT_NEGATIVE_TTL
+)
+
+# 各阶段的显示名称
+STAGE_NAMES = {'download': '下载中', 'upload': '上传中'}
 
 # 定期任务锁
 scheduled_task_lock = threading.Lock()
 
-# URL验证函数
-def is_url(text):
-    """检查文本是否为URL"""
-    url_pattern = re.compile(
-        r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    )
-    return bool(url_pattern.match(text))
-
+# 在本进程中执行任务的 worker 及其发送消息使用的 Bot，只在 all/worker 角色下启动
+job_worker = JobWorker(
+    job_store,
+    lambda job, owner: run_job(job, owner),
+    capacity=MAX_WORKERS,
+    poll_interval=JOB_POLL_INTERVAL
+)
+worker_bot = None
+# 本进程接收的排队中任务的状态消息，按任务库中的排队位置定期更新，任务开始执行后交给 worker
+queued_status: Dict[int, StatusMessage] = {}
+queue_position_task: Optional[asyncio.Task] = None
 
 async def fetch_video_with_cobalt(url):
-    """使用Cobalt API获取视频下载链接"""
+    """使用Cobalt API获取视频下载链接，失败时抛出 CobaltError"""
     try:
-        # 检查系统资源
-        can_proceed, message = resource_monitor.check_system_resources()
-        if not can_proceed:
-            logger.warning(message)
-            return None
-            
-        # 准备请求
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
-        data = {"url": url}
-        
-        # 异步执行请求
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: httpx.post(COBALT_API_URL, headers=headers, json=data, timeout=30)
-        )
-        
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
+        # 在多个实例间负载均衡并缓存结果
+        with metrics.time(metrics.cobalt_latency), tracing.span('resolve'):
+            return await cobalt_client.resolve(url)
+    except CobaltError as e:
         logger.error(f"请求 Cobalt API 失败: {e}")
-        return None
+        metrics.cobalt_errors.labels(type(e).__name__).inc()
+        raise
 
 
-async def download_video_task(url, update: Update, context: ContextTypes.DEFAULT_TYPE, status_message):
-    """处理视频下载任务"""
+async def download_video_task(url, update: Update, context: ContextTypes.DEFAULT_TYPE, status_message,
+                              on_stage=None, response=None, file_key=None):
+    """
+    处理视频下载任务
+    response 为已解析的 Cobalt 结果，为空时先解析 url；file_key 默认为归一化的链接
+    """
     user_id = update.effective_user.id
     start_time = time.time()
-    success = False
     
     try:
-        # 发送状态更新
-        await update_status_message(status_message, "正在获取视频信息...")
-        
-        # 从Cobalt API获取下载链接
-        response = await fetch_video_with_cobalt(url)
-        if not response or 'url' not in response:
+        if response is None:
+            # 发送状态更新
+            await update_status_message(status_message, "正在获取视频信息...")
+            if on_stage:
+                await on_stage('resolve')
+
+            # 从Cobalt API获取下载链接
+            response = await fetch_video_with_cobalt(url)
+        if 'url' not in response:
             raise Exception("无法获取有效的下载链接")
         
         download_url = response['url']
         
         # 发送状态更新
         await update_status_message(status_message, "正在下载视频...")
+        if on_stage:
+            await on_stage('download')
         
         # 执行下载
-        video_file = await download_manager.download_file(download_url, user_id)
-        if not video_file:
-            raise Exception("下载失败")
+        async def report_progress(downloaded, total, speed):
+            await update_status_message(status_message, format_transfer_progress("正在下载视频", downloaded, total, speed))
             
-        # 检查视频完整性
-        if not await video_processor.check_video_integrity(video_file):
-            raise Exception("下载的视频文件已损坏")
+        # 明显需要压缩的大文件在下载的同时送入 ffmpeg
+        user_dir = os.path.join(DOWNLOAD_DIR, str(user_id))
+        os.makedirs(user_dir, exist_ok=True)
+        stream_compressor = video_processor.create_stream_compressor(user_dir)
+        try:
+            # 以归一化的原始链接作为文件键，Cobalt 返回的临时链接变化时仍可续传
+            with tracing.span('download'):
+                async with job_scheduler.stage('download') as slot:
+                    video_file = await download_manager.download_file(
+                        download_url, user_id, report_progress,
+                        file_key=file_key or normalize_url(url), stream_sink=stream_compressor,
+                        on_error=slot.record_error
+                    )
+                    # 下载的字节数用于按吞吐量调整并发上限
+                    if video_file:
+                        slot.cost = os.path.getsize(video_file)
+            if not video_file:
+                # 下载链接可能已失效，重试时重新解析
+                cobalt_client.invalidate(url)
+                raise Exception("下载失败")
+
+            # 流式压缩成功时直接使用其输出
+            await update_status_message(status_message, "正在处理视频...")
+            if on_stage:
+                await on_stage('process')
+            # 输出超出大小限制时 finish 返回 None，保留原文件走下面的压缩流程
+            with tracing.span('stream_transcode') if stream_compressor.active else contextlib.nullcontext():
+                processed_file = await stream_compressor.finish()
+        finally:
+            # 下载失败、异常或任务被取消（租约被接管、worker 停止）时终止 ffmpeg 并归还转码名额
+            if not stream_compressor.closed:
+                await stream_compressor.abort()
+        if processed_file and await video_processor.check_video_integrity(processed_file):
+            os.remove(video_file)
+        else:
+            if processed_file:
+                os.remove(processed_file)
+
+            # 检查视频完整性
+            with tracing.span('probe'):
+                intact = await video_processor.check_video_integrity(video_file)
+            if not intact:
+                raise Exception("下载的视频文件已损坏")
+                
+            # 压缩视频（如果需要），在转码进程池中排队
+            with tracing.span('transcode'):
+                processed_file = await video_processor.compress_video(video_file)
+            if not processed_file:
+                # 如果压缩失败，使用原始文件
+                processed_file = video_file
             
-        # 压缩视频（如果需要）
-        await update_status_message(status_message, "正在处理视频...")
-        processed_file = await video_processor.compress_video(video_file)
-        if not processed_file:
-            # 如果压缩失败，使用原始文件
-            processed_file = video_file
+        if processed_file != video_file and os.path.exists(video_file):
+            os.remove(video_file)
             
-        # 生成唯一文件名
-        unique_id = str(uuid.uuid4())
-        final_file = os.path.join(DOWNLOAD_DIR, f"{unique_id}_{os.path.basename(processed_file)}")
-        os.rename(processed_file, final_file)
+        # 移入按内容寻址的存储，持有引用直到发送完成
+        with tracing.span('store') as span:
+            stored = await storage_manager.put(processed_file)
+            span.set(size=stored.size)
+        video_processor.prober.moved(processed_file, stored.path)
         
-        success = True
         processing_time = time.time() - start_time
         logger.info(f"下载完成: {url}, 耗时: {processing_time:.2f}秒")
         
-        return final_file
+        return stored
         
+    except CobaltError:
+        # 解析错误携带给用户的提示，交给上层处理
+        raise
     except Exception as e:
         logger.error(f"下载任务失败: {e}")
         return None
-        
-    finally:
-        # 更新性能指标
-        processing_time = time.time() - start_time
-        download_manager.update_metrics(success, processing_time)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -155,97 +392,544 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # 获取系统资源使用情况
     resource_usage = resource_monitor.get_resource_usage()
     
-    # 获取下载统计信息
-    download_stats = download_manager.get_metrics()
+    # 请求和各阶段耗时统计来自 Prometheus 注册表，任务队列统计来自所有进程共享的任务库
+    scheduler_stats = job_scheduler.get_stats()
+    job_stats = await job_store.get_stats()
     
     # 格式化统计信息
     stats_text = (
         "📊 系统状态统计 📊\n\n"
         f"CPU使用率: {resource_usage.get('cpu_percent', 0):.1f}%\n"
         f"内存使用率: {resource_usage.get('memory_percent', 0):.1f}%\n"
-        f"可用内存: {resource_usage.get('memory_available', 0):.1f} MB\n\n"
-        f"总下载请求: {download_stats.get('total_downloads', 0)}\n"
-        f"成功下载: {download_stats.get('successful_downloads', 0)}\n"
-        f"失败下载: {download_stats.get('failed_downloads', 0)}\n"
+        f"可用内存: {resource_usage.get('memory_available', 0):.1f} MB\n"
+        f"磁盘可用: {resource_usage.get('disk_free', 0):.1f} MB\n"
+        f"进程内存: {resource_usage.get('process_rss', 0) + resource_usage.get('children_rss', 0):.1f} MB\n\n"
+        f"成功请求: {metrics.counter_value(metrics.jobs, result='success'):.0f}\n"
+        f"失败请求: {metrics.counter_value(metrics.jobs, result='failure'):.0f}\n"
+        f"缓存命中: {metrics.counter_value(metrics.cache_hits):.0f}\n"
+        f"合并请求: {metrics.counter_value(metrics.coalesced):.0f}\n"
+        f"事件循环延迟: {metrics.gauge_value(metrics.event_loop_lag) * 1000:.1f}ms\n\n"
+        f"任务队列: 排队 {job_stats['queued']} / 运行 {job_stats['running']} / 失败 {job_stats['failed']}\n"
+        f"本进程运行任务: {scheduler_stats['running']}/{scheduler_stats['max_workers']}\n"
     )
+    for name, stage in scheduler_stats['stages'].items():
+        adaptive = "（自适应）" if stage['adaptive'] else ""
+        stats_text += f"{STAGE_NAMES.get(name, name)}: {stage['active']}/{stage['limit']}{adaptive}\n"
+    for backend_url, backend in cobalt_client.get_stats().items():
+        latency = f"{backend['latency'] * 1000:.0f}ms" if backend['latency'] is not None else "-"
+        stats_text += f"Cobalt {backend_url}: {backend['state']} {latency}\n"
+    storage_stats = storage_manager.get_stats()
+    stats_text += (
+        f"视频存储: {storage_stats['files']}个文件 {storage_stats['total_bytes'] / 1024 / 1024:.0f}MB"
+        f" / {storage_stats['quota_bytes'] / 1024 / 1024:.0f}MB，已淘汰 {storage_stats['evictions']}\n"
+    )
+    for direction, link in bandwidth_manager.get_stats().items():
+        if link['rate']:
+            stats_text += (
+                f"{'下载' if direction == 'ingress' else '上传'}带宽: {link['bulk_rate'] * 8 / 1e6:.0f}"
+                f" / {link['rate'] * 8 / 1e6:.0f}Mbit/s，排队用户 {link['waiting_users']}\n"
+            )
+    transcode_stats = transcode_pool.get_stats()
+    stats_text += (
+        f"转码中: {transcode_stats['running']}/{transcode_stats['max_processes']}"
+        f"{'（自适应）' if transcode_stats['adaptive'] else ''}，每进程 {transcode_stats['threads_per_job']} 线程"
+        f" (等待 {transcode_stats['waiting']})\n\n"
+        "阶段耗时 (次数 / P50 / P95):\n"
+    )
+    for name, summary in metrics.summary().items():
+        if summary['count']:
+            stats_text += f"{name}: {summary['count']} / {summary['p50']:.2f}s / {summary['p95']:.2f}s\n"
     
     await update.message.reply_text(stats_text)
 
 
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """管理员查看任务时间线: /trace <任务ID>，不带参数时列出本进程最近的慢任务"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("无权限")
+        return
+
+    if not context.args:
+        outliers = tracer.recent_outliers()
+        if not outliers:
+            await update.message.reply_text("暂无慢任务。用法: /trace <任务ID>")
+            return
+        lines = [f"最近的慢任务（阈值 {tracer.threshold():.1f}秒）:"]
+        for trace in outliers[:10]:
+            lines.append(f"{trace['job_id']}: {trace['duration']:.2f}秒{' 失败' if trace.get('error') else ''}")
+        await update.message.reply_text("\n".join(lines))
+        return
+
+    try:
+        job_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("用法: /trace <任务ID>")
+        return
+    # 时间线保存在任务库中，可查询其他 worker 进程执行的任务
+    job = await job_store.get(job_id)
+    trace = (job.trace if job else None) or tracer.get(job_id)
+    if trace is None:
+        await update.message.reply_text(f"任务 {job_id} 没有时间线记录")
+        return
+    await update.message.reply_text(format_timeline(trace))
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """处理用户消息"""
+    """处理用户消息：回复状态消息后将任务写入持久化队列，处理函数立即返回"""
+    await accept_message(update, context)
+
+
+async def accept_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+    """校验链接并回复状态消息，需要下载时返回任务ID"""
     start_time = time.time()
     user = update.effective_user
     message_text = update.message.text
     status_message = None
-    video_file = None
-    success = False
     
     try:
         logger.info(f"收到来自用户 {user.id} ({user.username}) 的消息: {message_text}")
         
-        # 检查是否为URL
-        if not is_url(message_text):
+        # 提取消息中的所有链接
+        urls = extract_urls(message_text, MAX_BATCH_ITEMS)
+        if not urls:
             await update.message.reply_text("请发送有效的视频链接。")
-            return
-            
-        # 检查用户是否可以开始新的下载
-        can_download, reason = await download_manager.can_start_download(user.id)
-        if not can_download:
-            await update.message.reply_text(reason)
-            return
+            return None
             
-        # 发送状态消息
-        status_message = await update.message.reply_text("开始处理下载请求...")
+        if len(urls) == 1:
+            # 命中 file_id 缓存时直接转发，无需下载
+            url_key = normalize_url(urls[0])
+            if await send_cached_video(update.message, url_key):
+                metrics.cache_hits.inc()
+                logger.info(f"缓存命中 - URL: {urls[0]}, 耗时: {time.time() - start_time:.2f}秒")
+                return None
+
+            if await job_store.is_active(url_key):
+                # 相同链接正在处理中，该任务完成后直接复用其 file_id
+                status_message = await update.message.reply_text("相同链接正在处理中，等待结果...")
+            else:
+                status_message = await update.message.reply_text("开始处理下载请求...")
+        else:
+            # 多个链接作为一个批量任务，共用一条状态消息，结果以媒体组发送
+            url_key = "batch:" + hashlib.sha1("\n".join(normalize_url(url) for url in urls).encode()).hexdigest()
+            status_message = await update.message.reply_text(f"开始处理 {len(urls)} 个链接...")
         
-        # 执行下载任务
-        video_file = await download_video_task(message_text, update, context, status_message)
-        if not video_file:
-            raise Exception("下载处理失败")
+        # 任务连同原始消息和状态消息写入队列，任意 worker 进程都能恢复执行
+        try:
+            job_id = await job_store.enqueue(
+                urls[0], url_key, user.id,
+                {'update': update.to_dict(), 'status': status_message.to_dict(), 'urls': urls}
+            )
+        except QueueFullError as e:
+            metrics.jobs.labels('rejected').inc()
+            await status_message.edit_text(str(e))
+            return None
+        logger.info(f"任务 {job_id} 已加入队列")
+        job_worker.notify()
+        queued_status[job_id] = status_updater.track(status_message)
+        if BOT_ROLE == 'ingest' or len(job_worker.running) >= job_worker.capacity:
+            # 本进程的 worker 有空闲名额时任务会立即开始，无需显示排队位置
+            await report_queue_positions([job_id])
+        return job_id
+        
+    except Exception as e:
+        total_time = time.time() - start_time
+        logger.error(f"处理失败: {str(e)}")
+        metrics.jobs.labels('failure').inc()
+        metrics.job_duration.labels('failure').observe(total_time)
+        
+        if status_message:
+            await status_message.edit_text(f"文件处理失败，请稍后重试。\n总耗时: {total_time:.2f}秒")
+        return None
+
+
+async def report_queue_positions(job_ids):
+    """更新排队中任务的状态消息，已开始执行或已结束的任务不再跟踪"""
+    try:
+        positions = await job_store.positions(job_ids)
+    except sqlite3.Error as e:
+        logger.error(f"查询排队位置失败: {e}")
+        return
+    for job_id in job_ids:
+        status_message = queued_status.get(job_id)
+        if status_message is None:
+            continue
+        position = positions.get(job_id)
+        if position is None:
+            # 之后由执行任务的 worker 更新状态消息
+            status_message.cancel()
+            del queued_status[job_id]
+        else:
+            await status_message.update(f"排队中，当前位置: 第{position}位")
+
+
+async def queue_position_loop():
+    """定期更新本进程接收的排队任务的位置"""
+    while True:
+        await asyncio.sleep(QUEUE_POSITION_INTERVAL)
+        if queued_status:
+            await report_queue_positions(list(queued_status))
+
+
+async def run_job(job: Job, owner: str):
+    """在 worker 中执行队列中的任务，完成后更新状态消息"""
+    update = Update.de_json(job.payload['update'], worker_bot)
+    # 状态消息的编辑经过限速和合并
+    status_message = status_updater.track(Message.de_json(job.payload['status'], worker_bot))
+    user = update.effective_user
+    
+    async def on_stage(stage):
+        await job_store.set_stage(job.id, owner, stage)
+        
+    # 本次执行的时间线，子任务通过上下文记录各阶段
+    trace = tracer.start(
+        job.id, url=job.url, user_id=job.user_id, attempt=job.attempts,
+        urls=len(job.payload.get('urls') or [job.url]), queue_wait=round(time.time() - job.created_at, 3)
+    )
+    error = None
+    try:
+        if job.attempts > job_store.max_attempts:
+            raise Exception("已达到最大重试次数")
+        if job.attempts > 1:
+            await update_status_message(status_message, "任务恢复中...")
             
-        # 发送视频
-        await update_status_message(status_message, "正在发送视频...")
-        await send_video_with_retry(update.message, video_file)
+        urls = job.payload.get('urls') or [job.url]
+        summary = None
+        # 相同链接的其他任务已上传时直接复用 file_id
+        if len(urls) == 1 and await send_cached_video(update.message, job.url_key):
+            metrics.coalesced.inc()
+            file_id = None
+        elif len(urls) == 1:
+            await update_status_message(status_message, "正在获取视频信息...")
+            await on_stage('resolve')
+            response = await fetch_video_with_cobalt(job.url)
+            if response.get('status') == 'picker':
+                # 图集等包含多个媒体的链接按批量任务处理
+                file_id = None
+                summary = await process_batch(urls, update, status_message, on_stage)
+            else:
+                async def report_position(position):
+                    await update_status_message(status_message, f"排队中，当前位置: 第{position}位")
+
+                # 在本进程内按用户公平调度，并受各阶段并发限制
+                file_id = await job_scheduler.submit(
+                    user.id,
+                    lambda: process_download(job.url, job.url_key, update, None, status_message, on_stage, response),
+                    on_position=report_position
+                )
+        else:
+            file_id = None
+            summary = await process_batch(urls, update, status_message, on_stage)
+        await job_store.complete(job.id, owner, file_id)
         
         # 更新成功状态
-        success = True
-        total_time = time.time() - start_time
+        total_time = time.time() - job.created_at
         
         # 发送完成状态消息
         status_text = (
-            f"下载完成并已发送文件！\n"
+            f"{summary or '下载完成并已发送文件！'}\n"
             f"总耗时: {total_time:.2f}秒"
         )
-        await status_message.edit_text(status_text)
+        await status_message.finish(status_text)
+        metrics.jobs.labels('success').inc()
+        metrics.job_duration.labels('success').observe(total_time)
         
         # 记录详细日志
-        logger.info(f"处理完成 - URL: {message_text}\n{status_text}")
+        logger.info(f"处理完成 - URL: {job.url}\n{status_text}")
         
     except Exception as e:
-        total_time = time.time() - start_time
-        error_message = f"处理失败: {str(e)}"
-        logger.error(error_message)
-        
-        if status_message:
-            await status_message.edit_text(f"文件处理失败，请稍后重试。\n总耗时: {total_time:.2f}秒")
+        error = e
+        total_time = time.time() - job.created_at
+        logger.error(f"任务 {job.id} 处理失败: {str(e)}")
+        # 不支持的链接等永久性错误不再重试，限流时至少等待到限流结束
+        retry_delay = max(JOB_RETRY_DELAY, e.retry_after if isinstance(e, RateLimitedError) else 0)
+        retryable = not (isinstance(e, CobaltError) and e.permanent)
+        retry = await job_store.fail(job.id, owner, str(e), retry_delay, retryable)
+        if retry is None:
+            # 任务已由其他 worker 接管
+            return
+        reason = e.user_message if isinstance(e, CobaltError) else "文件处理失败"
+        if retry:
+            await status_message.finish(
+                f"{reason}，{retry_delay:.0f}秒后重试（第{job.attempts}/{job_store.max_attempts}次）"
+            )
+            return
+        metrics.jobs.labels('failure').inc()
+        metrics.job_duration.labels('failure').observe(total_time)
+        if isinstance(e, CobaltError):
+            await status_message.finish(f"{reason}\n总耗时: {total_time:.2f}秒")
+        else:
+            await status_message.finish(f"文件处理失败，请稍后重试。\n总耗时: {total_time:.2f}秒")
+        if not retryable:
+            # 永久性错误对相同链接的其他排队任务同样成立，直接共享错误而不再逐个执行
+            await fail_duplicate_jobs(job.url_key, e)
+    finally:
+        result = tracer.finish(trace, error)
+        try:
+            await job_store.save_trace(job.id, result)
+        except Exception as e:
+            logger.warning(f"保存任务 {job.id} 的时间线失败: {e}")
+
+
+async def fail_duplicate_jobs(url_key: str, error: CobaltError):
+    """将相同链接的排队任务标记为失败，并在各自的状态消息中显示错误"""
+    try:
+        duplicates = await job_store.fail_duplicates(url_key, str(error))
+    except sqlite3.Error as e:
+        logger.error(f"标记相同链接的任务失败时出错: {e}")
+        return
+    for duplicate in duplicates:
+        logger.info(f"任务 {duplicate.id} 与失败的任务链接相同，共享错误: {error}")
+        metrics.jobs.labels('failure').inc()
+        metrics.job_duration.labels('failure').observe(time.time() - duplicate.created_at)
+        status_message = status_updater.track(Message.de_json(duplicate.payload['status'], worker_bot))
+        await status_message.finish(error.user_message)
+
+
+async def process_download(url, url_key, update: Update, context: ContextTypes.DEFAULT_TYPE, status_message,
+                           on_stage=None, response=None):
+    """下载并发送视频，返回 Telegram file_id"""
+    stored = None
+    
+    try:
+        # 执行下载任务
+        stored = await download_video_task(url, update, context, status_message, on_stage, response)
+        if not stored:
+            raise Exception("下载处理失败")
+            
+        # 内容相同的视频已上传过时直接复用 file_id
+        content_key = f"sha256:{stored.digest}"
+        if await send_cached_video(update.message, content_key):
+            file_id = file_id_cache.get(content_key)
+            if file_id:
+                file_id_cache.put(url_key, file_id, stored.size)
+            return file_id
             
+        # 发送视频
+        await update_status_message(status_message, "正在发送视频...")
+        if on_stage:
+            await on_stage('upload')
+        async def report_progress(uploaded, total, speed):
+            await update_status_message(status_message, format_transfer_progress("正在发送视频", uploaded, total, speed))
+
+        with tracing.span('upload', size=stored.size):
+            async with job_scheduler.stage('upload') as slot:
+                slot.cost = stored.size
+                sent_message = await send_video_with_retry(
+                    update.message, stored.path, progress_callback=report_progress
+                )
+        return remember_file_id(url_key, sent_message, content_key)
+        
     finally:
-        # 启动异步清理任务
-        if video_file and os.path.exists(video_file):
-            asyncio.create_task(cleanup_files(video_file))
+        # 释放引用，文件保留在存储中直到按配额淘汰
+        if stored:
+            storage_manager.release(stored)
+
+
+async def resolve_media_items(url) -> list:
+    """解析单个链接，返回其中的媒体；链接或 picker 中的媒体命中 file_id 缓存时无需下载"""
+    url_key = normalize_url(url)
+    file_id = file_id_cache.get(url_key)
+    if file_id:
+        return [MediaItem(url_key, url, file_id=file_id)]
+
+    response = await fetch_video_with_cobalt(url)
+    if response.get('status') == 'picker':
+        items = []
+        for index, entry in enumerate(response.get('picker') or []):
+            if not entry.get('url'):
+                continue
+            key = f"{url_key}#{index}"
+            items.append(MediaItem(key, url, picker_kind(entry.get('type')), entry['url'], file_id_cache.get(key)))
+        if not items:
+            raise Exception("无法获取有效的下载链接")
+        return items
+    if 'url' not in response:
+        raise Exception("无法获取有效的下载链接")
+    return [MediaItem(url_key, url, download_url=response['url'])]
+
+
+async def prepare_media_item(item: MediaItem, update: Update):
+    """下载并处理单个媒体，视频经过完整性检查和压缩，图片直接存储"""
+    if item.kind == 'photo':
+        async with job_scheduler.stage('download') as slot:
+            photo_file = await download_manager.download_file(
+                item.download_url, update.effective_user.id, file_key=item.key, suffix='.jpg',
+                on_error=slot.record_error
+            )
+            if photo_file:
+                slot.cost = os.path.getsize(photo_file)
+        if not photo_file:
+            cobalt_client.invalidate(item.source_url)
+            raise Exception("下载失败")
+        item.stored = await storage_manager.put(photo_file)
+    else:
+        item.stored = await download_video_task(
+            item.source_url, update, None, None, response={'url': item.download_url}, file_key=item.key
+        )
+        if not item.stored:
+            raise Exception("下载处理失败")
+        media = await video_processor.probe(item.stored.path)
+        item.metadata = media.telegram_video_kwargs() if media else {}
+
+    # 内容相同的媒体已上传过时直接复用 file_id
+    file_id = file_id_cache.get(f"sha256:{item.stored.digest}")
+    if file_id:
+        item.file_id = file_id
+
+
+async def process_batch(urls, update: Update, status_message, on_stage=None) -> str:
+    """
+    批量处理多个链接及 picker 中的多个媒体
+    各媒体在该用户的公平份额内并发下载处理，按原始顺序以媒体组发送，返回结果摘要；全部失败时抛出第一个错误
+    """
+    user_id = update.effective_user.id
+    await update_status_message(status_message, f"正在解析 {len(urls)} 个链接...")
+    if on_stage:
+        await on_stage('resolve')
+    resolved = await asyncio.gather(*(resolve_media_items(url) for url in urls), return_exceptions=True)
+
+    items = []
+    errors = []
+    for url, result in zip(urls, resolved):
+        if isinstance(result, Exception):
+            logger.error(f"解析失败 {url}: {result}")
+            errors.append(result)
+        else:
+            items.extend(result)
+    items = items[:MAX_BATCH_ITEMS]
+    if not items:
+        raise errors[0]
+
+    if on_stage:
+        await on_stage('download')
+    pending = [item for item in items if not item.file_id]
+    done = 0
+    # 同一用户最多有 MAX_CONCURRENT_DOWNLOADS 个任务同时提交，每个批量任务只占其中一份排队名额，
+    # 媒体数超过调度器的用户排队上限时不会被拒绝
+    submit_slots = asyncio.Semaphore(max(1, MAX_QUEUED_PER_USER // MAX_CONCURRENT_DOWNLOADS))
+
+    async def prepare(item):
+        nonlocal done
+        try:
+            async with submit_slots:
+                await job_scheduler.submit(user_id, lambda: prepare_media_item(item, update))
+        except Exception as e:
+            logger.error(f"媒体处理失败 {item.key}: {e}")
+            item.error = str(e)
+            errors.append(e)
+        done += 1
+        await update_status_message(status_message, f"正在下载处理 {done}/{len(pending)}...")
+
+    try:
+        await asyncio.gather(*(prepare(item) for item in pending))
+        ready = [item for item in items if item.ready]
+        if not ready:
+            raise errors[0]
+
+        await update_status_message(status_message, f"正在发送 {len(ready)} 个文件...")
+        if on_stage:
+            await on_stage('upload')
+        sent = await send_media_items(update.message, ready)
+    finally:
+        # 释放引用，文件保留在存储中直到按配额淘汰
+        for item in items:
+            if item.stored:
+                storage_manager.release(item.stored)
+
+    summary = f"已发送 {sent} 个文件"
+    if errors:
+        reason = errors[0].user_message if isinstance(errors[0], CobaltError) else "文件处理失败"
+        summary += f"，{len(errors)} 个失败（{reason}）"
+    return summary
+
+
+async def send_media_items(message, items, max_retries=3) -> int:
+    """按媒体组发送，每组不超过 10 个，返回发送的数量并缓存各媒体的 file_id"""
+    def source(item, flow):
+        if item.file_id:
+            return item.file_id
+        # 本地 Bot API 服务器直接读取共享目录中的文件，否则从磁盘流式上传
+        return bot_api.file_input(item.stored.path) or \
+            StreamingInputFile(item.stored.path, attach=True, throttle=flow.consume)
+
+    sent = 0
+    for group in split_media_groups(items):
+        caption = "下载完成！" if sent == 0 else None
+        for attempt in range(max_retries):
+            try:
+                with tracing.span('upload_group', items=len(group), attempt=attempt + 1):
+                    async with job_scheduler.stage('upload') as slot:
+                        flow = upload_flow(message)
+                        slot.cost = sum(item.stored.size for item in group if item.stored and not item.file_id)
+                        with metrics.time(metrics.upload_duration.labels('group')):
+                            if len(group) > 1:
+                                messages = await message.reply_media_group(
+                                    media=[build_input_media(item, source(item, flow), caption if index == 0 else None)
+                                           for index, item in enumerate(group)],
+                                    read_timeout=UPLOAD_TIMEOUT
+                                )
+                            elif group[0].kind == 'photo':
+                                messages = [await message.reply_photo(
+                                    photo=source(group[0], flow), caption=caption, read_timeout=UPLOAD_TIMEOUT
+                                )]
+                            else:
+                                messages = [await message.reply_video(
+                                    video=source(group[0], flow), caption=caption, read_timeout=UPLOAD_TIMEOUT,
+                                    **group[0].metadata
+                                )]
+                break
+            except (TimedOut, NetworkError) as e:
+                if attempt == max_retries - 1:
+                    logger.error(f"发送媒体组失败，已达到最大重试次数: {e}")
+                    raise
+                logger.warning(f"发送媒体组失败，正在重试 ({attempt+1}/{max_retries}): {e}")
+                await asyncio.sleep(2)
+            except BadRequest:
+                # 缓存的 file_id 可能已失效，重试时重新下载
+                for item in group:
+                    if item.file_id:
+                        file_id_cache.invalidate(item.key)
+                        if item.stored:
+                            file_id_cache.invalidate(f"sha256:{item.stored.digest}")
+                raise
+
+        for item, sent_message in zip(group, messages):
+            remember_file_id(item.key, sent_message, f"sha256:{item.stored.digest}" if item.stored else None)
+        sent += len(group)
+    return sent
 
 
-async def send_video_with_retry(message, video_file, max_retries=3):
+async def send_video_with_retry(message, video_file, max_retries=3, progress_callback=None):
     """带重试机制的视频发送函数"""
+    # 附带时长、尺寸等元数据，Telegram 无需在服务端重新探测
+    media = await video_processor.probe(video_file)
+    metadata = media.telegram_video_kwargs() if media else {}
+
     for attempt in range(max_retries):
+        tracing.annotate(attempts=attempt + 1)
         try:
-            with open(video_file, 'rb') as video:
-                await message.reply_video(
-                    video=video,
-                    filename=os.path.basename(video_file),
-                    caption="下载完成！"
+            # 本地 Bot API 服务器直接读取共享目录中的文件，无需上传
+            local_file = bot_api.file_input(video_file)
+            if local_file is not None:
+                tracing.annotate(mode='local')
+                with metrics.time(metrics.upload_duration.labels('local')):
+                    return await message.reply_video(
+                        video=local_file,
+                        caption="下载完成！",
+                        read_timeout=UPLOAD_TIMEOUT,
+                        **metadata
+                    )
+
+            # 从磁盘分块流式上传，内存占用与文件大小无关，重试时重新读取文件
+            tracing.annotate(mode='stream')
+            with metrics.time(metrics.upload_duration.labels('stream')):
+                return await message.reply_video(
+                    video=StreamingInputFile(video_file, progress_callback=progress_callback, progress_interval=1.0,
+                                             throttle=upload_flow(message).consume),
+                    caption="下载完成！",
+                    read_timeout=UPLOAD_TIMEOUT,
+                    **metadata
                 )
-            return True
         except (TimedOut, NetworkError) as e:
             if attempt < max_retries - 1:
                 logger.warning(f"发送视频失败，正在重试 ({attempt+1}/{max_retries}): {e}")
@@ -258,24 +942,46 @@ async def send_video_with_retry(message, video_file, max_retries=3):
             raise
 
 
-async def update_status_message(status_message, text):
-    """更新状态消息的辅助函数"""
-    if status_message:
-        try:
-            await status_message.edit_text(text)
-        except Exception as e:
-            logger.error(f"更新状态消息失败: {e}")
+def upload_flow(message):
+    """上传占用出站带宽，按发起请求的用户分配份额"""
+    user_id = message.from_user.id if message.from_user else message.chat_id
+    return bandwidth_manager.flow('egress', user_id)
 
 
-async def cleanup_files(file_path, delay=60):
-    """异步清理文件"""
+async def send_cached_video(message, url_key):
+    """尝试使用缓存的 file_id 发送视频"""
+    file_id = file_id_cache.get(url_key)
+    if not file_id:
+        return False
+        
     try:
-        await asyncio.sleep(delay)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"已清理临时文件: {file_path}")
+        await message.reply_video(video=file_id, caption="下载完成！")
+        return True
+    except BadRequest as e:
+        # file_id 已失效，删除缓存后走正常下载流程
+        logger.warning(f"缓存的 file_id 已失效: {e}")
+        file_id_cache.invalidate(url_key)
     except Exception as e:
-        logger.error(f"清理文件失败: {e}")
+        logger.warning(f"使用缓存发送视频失败: {e}")
+    return False
+
+
+def remember_file_id(url_key, sent_message, content_key=None):
+    """记录并返回 Telegram 返回的 file_id，同时按链接和内容摘要缓存"""
+    media = sent_message and (sent_message.video or sent_message.document or sent_message.animation
+                              or (sent_message.photo[-1] if sent_message.photo else None))
+    if not media:
+        return None
+    file_id_cache.put(url_key, media.file_id, media.file_size or 0)
+    if content_key:
+        file_id_cache.put(content_key, media.file_id, media.file_size or 0)
+    return media.file_id
+
+
+async def update_status_message(status_message, text):
+    """更新状态消息的辅助函数，编辑由 status_updater 限速并合并"""
+    if status_message:
+        await status_message.update(text)
 
 
 async def scheduled_cleanup():
@@ -283,7 +989,9 @@ async def scheduled_cleanup():
     with scheduled_task_lock:
         try:
             # 清理旧文件
-            await download_manager.cleanup_old_files(max_age_hours=24)
+            # 存储中的视频按配额淘汰，这里只清理中断后未续传的临时文件
+            await download_manager.cleanup_old_files(max_age_hours=24, exclude=STORAGE_DIR)
+            await job_store.purge(max_age=24 * 3600)
             
             # 检查系统资源
             resource_usage = resource_monitor.get_resource_usage()
@@ -301,56 +1009,166 @@ async def run_scheduled_tasks(app):
         await asyncio.sleep(3600)  # 每小时运行一次
 
 
+def build_application() -> Application:
+    """创建并配置 Application"""
+    # 配置自定义连接池和超时设置
+    # 上传视频时从磁盘流式发送请求体
+    request = StreamingHTTPXRequest(
+        connection_pool_size=8,
+        read_timeout=30.0,
+        write_timeout=30.0,
+        connect_timeout=30.0,
+    )
+    
+    # 创建应用
+    # 有界并发处理更新，耗时任务在后台执行，处理函数很快返回
+    # 长轮询使用单独的连接，与其他请求共用 SSL 上下文
+    get_updates_request = StreamingHTTPXRequest(connection_pool_size=1)
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+    )
+    application = bot_api.apply(builder).build()
+    logger.info(f"Bot API: {bot_api.describe()}，视频大小限制: {MAX_VIDEO_SIZE_MB}MB")
+    
+    # 添加命令处理器
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("trace", trace_command))
+    
+    # 添加消息处理器
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+
+async def start_services(bot=None):
+    """
+    启动资源采样和指标服务；处理任务的角色还启动任务调度、Cobalt、下载连接池和任务 worker
+    接收更新的角色在开始轮询之后才调用，连接池创建和存储扫描不推迟接收第一条更新
+    """
+    global worker_bot, queue_position_task
+    await resource_monitor.start()
+    metrics.watch(job_scheduler, transcode_pool, resource_monitor, storage_manager)
+    # 同一主机上的多个 worker 进程使用不同的指标端口
+    await metrics.start(METRICS_PORT + WORKER_INDEX if METRICS_PORT else 0, METRICS_ADDR)
+    if BOT_ROLE in ('all', 'worker'):
+        worker_bot = bot
+        await job_scheduler.start()
+        await asyncio.gather(cobalt_client.start(), download_manager.start(), storage_manager.start())
+        await job_worker.start()
+    if BOT_ROLE in ('all', 'ingest'):
+        queue_position_task = asyncio.create_task(queue_position_loop())
+
+
+async def stop_services():
+    """归还运行中的任务并释放资源"""
+    if queue_position_task is not None:
+        queue_position_task.cancel()
+    await job_worker.stop()
+    await job_scheduler.stop()
+    await resource_monitor.stop()
+    await metrics.stop()
+    await cobalt_client.close()
+    await download_manager.close()
+    await storage_manager.stop()
+    file_id_cache.close()
+    job_store.close()
+
+
+async def supervise_worker(index: int):
+    """启动并守护 worker 子进程，异常退出后重启"""
+    env = dict(os.environ, BOT_ROLE='worker', WORKER_INDEX=str(index))
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        logger.info(f"worker 进程 {index} 已启动: PID {process.pid}")
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            # 通知 worker 归还任务后退出
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), 30)
+            except asyncio.TimeoutError:
+                process.kill()
+            raise
+        logger.warning(f"worker 进程 {index} 已退出（返回码 {returncode}），5秒后重启")
+        await asyncio.sleep(5)
+
+
+async def start_ingestion(application: Application):
+    """配置了 WEBHOOK_URL 时使用 Webhook 接收更新，否则使用长轮询"""
+    if WEBHOOK_URL:
+        # 使用 PTB 内置的 Webhook 服务，校验 X-Telegram-Bot-Api-Secret-Token
+        await application.updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=False
+        )
+        logger.info(f"Webhook 已启动: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    else:
+        await application.updater.start_polling()
+        logger.info("长轮询已启动")
+
+
 async def main():
-    """主函数"""
-    # 确保只有一个机器人实例运行
-    instance_manager = SingleInstanceManager()
-    if not instance_manager.ensure_single_instance():
-        logger.error("另一个机器人实例已在运行，本实例将退出")
-        sys.exit(1)
-        
+    """
+    主函数
+    all: 接收更新并在本进程处理任务；ingest: 只接收更新写入任务队列；worker: 只处理任务队列
+    只有接收更新的角色需要保证单实例，worker 进程可以启动多个
+    """
+    instance_manager = None
+    if BOT_ROLE in ('all', 'ingest'):
+        instance_manager = SingleInstanceManager()
+        if not instance_manager.ensure_single_instance():
+            logger.error("另一个机器人实例已在运行，本实例将退出")
+            sys.exit(1)
+    
+    # 收到 SIGTERM 时正常退出，运行中的任务归还到队列
+    stop_event = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    
+    application = None
+    supervisors = []
     try:
-        # 配置自定义连接池和超时设置
-        request = HTTPXRequest(
-            connection_pool_size=8,
-            read_timeout=30.0,
-            write_timeout=30.0,
-            connect_timeout=30.0,
-        )
-        
-        # 创建应用
-        application = Application.builder().token(TOKEN).request(request).build()
-        
-        # 添加命令处理器
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("stats", stats))
+        application = build_application()
+        await application.initialize()
         
-        # 添加消息处理器
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        if BOT_ROLE in ('all', 'ingest'):
+            # 先开始接收更新：收到的消息只需写入任务队列，任务在 worker 启动后处理
+            await application.start()
+            await start_ingestion(application)
         
-        # 启动定期任务
-        asyncio.create_task(run_scheduled_tasks(application))
+        await start_services(application.bot)
         
-        # 启动机器人
-        await application.initialize()
-        await application.start()
-        await application.updater.start_polling()
+        if BOT_ROLE in ('all', 'ingest'):
+            # 启动定期任务
+            asyncio.create_task(run_scheduled_tasks(application))
+            supervisors = [asyncio.create_task(supervise_worker(i + 1)) for i in range(WORKER_PROCESSES)]
         
-        logger.info("机器人已启动")
-        
-        # 保持运行 - 兼容不同版本的python-telegram-bot
-        try:
-            await application.idle()
-        except AttributeError:
-            # 如果没有idle方法，使用无限循环保持运行
-            while True:
-                await asyncio.sleep(3600)
+        logger.info(f"机器人已启动，角色: {BOT_ROLE}")
+        await stop_event.wait()
         
     except Exception as e:
         logger.error(f"启动失败: {e}")
     finally:
         # 确保在程序结束时清理资源
-        if 'instance_manager' in locals():
+        for supervisor in supervisors:
+            supervisor.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        if application is not None:
+            if application.running:
+                await application.updater.stop()
+                await application.stop()
+            await application.shutdown()
+        await stop_services()
+        if instance_manager is not None:
             instance_manager.cleanup()
 
 
@@ -0,0 +1,121 @@
+"""
+本地 Bot API 服务器模式测试
+经 BotApiSettings 配置的 PTB Bot 向 benchmarks 中的 Bot API 替身发送视频，检查按路径发送、路径映射和回退上传
+
+运行: python -m pytest tests
+"""
+import asyncio
+import os
+import socket
+
+import pytest
+from telegram.error import NetworkError
+from telegram.ext import ApplicationBuilder
+
+from benchmarks.fake_servers import FakeBotApi, HttpServer
+from utils.bot_api import CLOUD_UPLOAD_LIMIT_MB, LOCAL_UPLOAD_LIMIT_MB, BotApiSettings
+
+CHAT_ID = 42
+
+
+def _free_port() -> int:
+    """返回当前未被监听的端口，用于模拟不可达的服务器"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _send_video(settings: BotApiSettings, video_path: str):
+    """启动 Bot API 替身，按 settings 构建 Bot 并发送视频，返回发送结果和替身的统计"""
+    api = FakeBotApi()
+    server = HttpServer(api.handle)
+    port = await server.start()
+    settings.base_url = f'http://127.0.0.1:{port}/bot'
+    bot = settings.apply(ApplicationBuilder().token('1:test')).build().bot
+    try:
+        async with bot:
+            video = settings.file_input(video_path)
+            if video is None:
+                with open(video_path, 'rb') as file:
+                    message = await bot.send_video(CHAT_ID, video=file)
+            else:
+                message = await bot.send_video(CHAT_ID, video=video)
+    finally:
+        server.server.close()
+        await server.server.wait_closed()
+    return message, api.stats
+
+
+@pytest.fixture
+def download_dir(tmp_path):
+    path = tmp_path / 'download'
+    (path / '1').mkdir(parents=True)
+    (path / '1' / 'video.mp4').write_bytes(b'\0' * 4096)
+    return path
+
+
+def test_local_mode_sends_file_path(download_dir):
+    settings = BotApiSettings(base_url='http://placeholder/bot', local_mode=True, download_dir=str(download_dir))
+    video_path = str(download_dir / '1' / 'video.mp4')
+
+    message, stats = asyncio.run(_send_video(settings, video_path))
+
+    assert settings.upload_limit_mb == LOCAL_UPLOAD_LIMIT_MB
+    assert stats['local_files'] == [f'file://{os.path.abspath(video_path)}']
+    assert stats['upload_bytes'] == 0
+    assert message.video is not None
+
+
+def test_local_mode_remaps_server_path(download_dir):
+    settings = BotApiSettings(
+        base_url='http://placeholder/bot', local_mode=True,
+        download_dir=str(download_dir), server_download_dir='/var/lib/telegram-bot-api/download'
+    )
+
+    _, stats = asyncio.run(_send_video(settings, str(download_dir / '1' / 'video.mp4')))
+
+    assert stats['local_files'] == ['file:///var/lib/telegram-bot-api/download/1/video.mp4']
+    assert stats['upload_bytes'] == 0
+
+
+def test_file_outside_shared_directory_is_uploaded(download_dir, tmp_path):
+    settings = BotApiSettings(base_url='http://placeholder/bot', local_mode=True, download_dir=str(download_dir))
+    outside = tmp_path / 'outside.mp4'
+    outside.write_bytes(b'\0' * 4096)
+
+    _, stats = asyncio.run(_send_video(settings, str(outside)))
+
+    assert stats['local_files'] == []
+    assert stats['upload_bytes'] >= 4096
+
+
+def test_cloud_mode_uploads(download_dir):
+    settings = BotApiSettings(base_url='http://placeholder/bot', download_dir=str(download_dir))
+
+    _, stats = asyncio.run(_send_video(settings, str(download_dir / '1' / 'video.mp4')))
+
+    assert settings.upload_limit_mb == CLOUD_UPLOAD_LIMIT_MB
+    assert stats['local_files'] == []
+    assert stats['upload_bytes'] >= 4096
+
+
+def test_local_mode_without_server_falls_back_to_cloud(download_dir):
+    settings = BotApiSettings(local_mode=True, download_dir=str(download_dir))
+
+    assert not settings.local_mode
+    assert settings.upload_limit_mb == CLOUD_UPLOAD_LIMIT_MB
+    assert settings.file_input(str(download_dir / '1' / 'video.mp4')) is None
+
+
+def test_unreachable_server_raises_network_error(download_dir):
+    settings = BotApiSettings(
+        base_url=f'http://127.0.0.1:{_free_port()}/bot', local_mode=True, download_dir=str(download_dir)
+    )
+    bot = settings.apply(ApplicationBuilder().token('1:test')).build().bot
+
+    async def send():
+        await bot.send_video(CHAT_ID, video=settings.file_input(str(download_dir / '1' / 'video.mp4')))
+
+    # 连接失败属于 NetworkError，send_video_with_retry 会重试后向上抛出，不会误判为文件错误
+    with pytest.raises(NetworkError):
+        asyncio.run(send())
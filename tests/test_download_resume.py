@@ -0,0 +1,70 @@
+"""
+断点续传测试
+重启后重新解析的链接可能指向不同的文件，续传前必须确认源文件未变化，否则从头下载
+
+运行: python -m pytest tests
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+import pytest
+
+from benchmarks.fake_servers import FakeCdn, HttpServer
+from utils.download_manager import DownloadManager
+
+OLD_SIZE = 1024 * 1024
+SEGMENTS = 4
+
+
+def _write_interrupted_download(user_dir: str, file_key: str, content: bytes):
+    """模拟中断的分段下载：每个区间只写入了前一半，进度记录在 .part.json 中"""
+    name = hashlib.sha1(file_key.encode()).hexdigest()[:16]
+    part_path = os.path.join(user_dir, f"{name}.mp4.part")
+    segment_size = len(content) // SEGMENTS
+    segments = []
+    with open(part_path, 'wb') as f:
+        f.truncate(len(content))
+        for begin in range(0, len(content), segment_size):
+            end = begin + segment_size - 1
+            written = begin + segment_size // 2
+            f.seek(begin)
+            f.write(content[begin:written])
+            segments.append([begin, end, written])
+    with open(f"{part_path}.json", 'w') as f:
+        json.dump({'total': len(content), 'segments': segments}, f)
+    return part_path
+
+
+@pytest.mark.parametrize('new_size', [OLD_SIZE + 512 * 1024, OLD_SIZE - 256 * 1024])
+def test_resume_restarts_when_source_length_changed(tmp_path, new_size):
+    download_dir = tmp_path / 'download'
+    user_dir = download_dir / '1'
+    user_dir.mkdir(parents=True)
+    old_content = os.urandom(OLD_SIZE)
+    new_content = os.urandom(new_size)
+    source = tmp_path / 'new.mp4'
+    source.write_bytes(new_content)
+    part_path = _write_interrupted_download(str(user_dir), 'video', old_content)
+
+    async def run():
+        server = HttpServer(FakeCdn({'video': str(source)}).handle)
+        port = await server.start()
+        manager = DownloadManager(
+            download_dir=str(download_dir), segments=SEGMENTS, segment_min_size=64 * 1024, chunk_size=64 * 1024
+        )
+        try:
+            return await manager.download_file(f'http://127.0.0.1:{port}/files/video/2.mp4', 1, file_key='video')
+        finally:
+            await manager.close()
+            server.server.close()
+            await server.server.wait_closed()
+
+    file_path = asyncio.run(run())
+
+    assert file_path is not None
+    with open(file_path, 'rb') as f:
+        assert f.read() == new_content
+    assert not os.path.exists(part_path)
+    assert not os.path.exists(f"{part_path}.json")
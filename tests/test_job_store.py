@@ -0,0 +1,63 @@
+"""
+任务库测试
+positions 与 claim 使用相同的条件和顺序，位置应与之后实际领取的顺序一致；
+永久性错误只共享给排队中的相同链接任务
+
+运行: python -m pytest tests
+"""
+import asyncio
+
+from utils.job_store import JobStore
+
+
+def test_positions_follow_claim_order(tmp_path):
+    async def run():
+        store = JobStore(str(tmp_path / 'jobs.db'), max_running_per_user=2)
+        try:
+            first = await store.enqueue('a1', 'a1', 1, {})
+            a2 = await store.enqueue('a2', 'a2', 1, {})
+            a3 = await store.enqueue('a3', 'a3', 1, {})
+            b1 = await store.enqueue('b1', 'b1', 2, {})
+            duplicate = await store.enqueue('a1', 'a1', 2, {})
+            b2 = await store.enqueue('b2', 'b2', 2, {})
+
+            claimed = await store.claim('worker')
+            assert claimed.id == first
+            positions = await store.positions([first, a2, a3, b1, duplicate, b2])
+            # 用户 2 没有运行中的任务，排在用户 1 之前；相同链接正在运行的任务不计位置
+            assert positions == {b1: 1, b2: 2, a2: 3, a3: 4}
+
+            order = []
+            while True:
+                job = await store.claim('worker')
+                if job is None:
+                    break
+                order.append(job.id)
+            assert order[:2] == [b1, a2]
+            assert await store.positions([b1, a2]) == {}
+        finally:
+            store.close()
+
+    asyncio.run(run())
+
+
+def test_fail_duplicates_only_affects_queued_jobs_with_same_url(tmp_path):
+    async def run():
+        store = JobStore(str(tmp_path / 'jobs.db'))
+        try:
+            leader = await store.enqueue('a', 'a', 1, {})
+            duplicate = await store.enqueue('a', 'a', 2, {})
+            other = await store.enqueue('b', 'b', 2, {})
+            await store.claim('worker')
+            await store.fail(leader, 'worker', '不支持的链接', retryable=False)
+
+            failed = await store.fail_duplicates('a', '不支持的链接')
+
+            assert [job.id for job in failed] == [duplicate]
+            assert (await store.get(duplicate)).state == 'failed'
+            assert (await store.get(duplicate)).error == '不支持的链接'
+            assert (await store.get(other)).state == 'queued'
+        finally:
+            store.close()
+
+    asyncio.run(run())
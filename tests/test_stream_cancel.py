@@ -0,0 +1,68 @@
+"""
+边下载边压缩的清理测试
+任务在下载途中被取消时，流式压缩持有的转码名额必须归还，否则转码进程池会被逐渐占满
+
+运行: python -m pytest tests
+"""
+import asyncio
+import importlib
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.fake_servers import FakeCdn, HttpServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def bot_module(tmp_path_factory):
+    """以小的视频大小限制导入 main，使数 MB 的文件即可启用边下载边压缩"""
+    workdir = tmp_path_factory.mktemp('bot')
+    os.environ.update({
+        'TOKEN': '123456:TEST',
+        'DOWNLOAD_DIR': str(workdir / 'download'),
+        'METRICS_PORT': '0',
+        'BOT_ROLE': 'all',
+        'MAX_VIDEO_SIZE_MB': '1',
+    })
+    sys.path.insert(0, ROOT)
+    return importlib.import_module('main')
+
+
+def test_cancel_mid_download_releases_transcode_slot(bot_module, tmp_path):
+    source = tmp_path / 'source.mp4'
+    source.write_bytes(os.urandom(4 * 1024 * 1024))
+    pool = bot_module.transcode_pool
+
+    async def run():
+        # 每秒 512KB，取消时尚未读满文件头，不会启动 ffmpeg
+        cdn = FakeCdn({'video': str(source)}, bandwidth=512 * 1024)
+        server = HttpServer(cdn.handle)
+        port = await server.start()
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=1))
+        task = asyncio.create_task(bot_module.download_video_task(
+            'https://example.com/v/1', update, None, None,
+            response={'url': f'http://127.0.0.1:{port}/files/video/1.mp4'}
+        ))
+        try:
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if pool.running:
+                    break
+            in_use = pool.running
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        finally:
+            server.server.close()
+            await server.server.wait_closed()
+            await bot_module.download_manager.close()
+        return in_use
+
+    in_use = asyncio.run(run())
+
+    assert in_use == 1
+    assert pool.running == 0
@@ -1,6 +1,18 @@
-from .resource_monitor import ResourceMonitor
-from .download_manager import DownloadManager
-from .video_processor import VideoProcessor
-from .instance_manager import SingleInstanceManager
+import importlib
 
-__all__ = ['ResourceMonitor', 'DownloadManager', 'VideoProcessor', 'SingleInstanceManager']
+# 按需导入子模块，导入 utils 中的单个模块时不会连带加载 psutil、httpx 等依赖
+_EXPORTS = {
+    'ResourceMonitor': '.resource_monitor',
+    'DownloadManager': '.download_manager',
+    'VideoProcessor': '.video_processor',
+    'SingleInstanceManager': '.instance_manager',
+    'FileIdCache': '.file_id_cache',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
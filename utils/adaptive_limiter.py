@@ -0,0 +1,140 @@
+import math
+import logging
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 归一化耗时的单位，小于 1MB 的任务按 1MB 计，避免固定开销放大小文件的单位耗时
+COST_UNIT = 1024 * 1024
+
+
+class AdaptiveLimiter:
+    """
+    自适应并发上限
+    参考 Netflix concurrency-limits 的 Gradient2 算法，结合 AIMD:
+    - 每个样本的耗时按处理的字节数归一化为每 MB 耗时，即吞吐量的倒数，不同大小的文件可以比较
+    - 每 window 个样本计算一次短期平均耗时，与无负载时的基准耗时比较得到梯度；
+      耗时超过基准的 tolerance 倍说明出现排队，按比例降低上限，否则每次增加约 sqrt(上限)
+    - 基准耗时取历史最低值；连续 probe_interval 个窗口没有刷新时，类似 BBR 的 ProbeRTT，
+      将上限降为 1/4，只用积压排空后开始的操作重新测量基准，再恢复原上限，以适应网络或源站本身变慢
+    - 窗口内出现超时或网络错误时按 backoff 乘性降低上限
+    - 实际并发不到上限一半时不再增加，避免空闲时上限无限增长
+    上限在 [min_limit, max_limit] 之间，变化时调用 on_change
+    """
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        min_limit: int = 1,
+        max_limit: Optional[int] = None,
+        window: int = 5,
+        probe_interval: int = 20,
+        tolerance: float = 1.5,
+        smoothing: float = 0.2,
+        backoff: float = 0.9,
+        on_change: Optional[Callable[[int], None]] = None
+    ):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit or initial * 4)
+        self.value = float(min(max(initial, self.min_limit), self.max_limit))
+        self.window = window
+        self.probe_interval = probe_interval
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.on_change = on_change
+
+        self.base_latency: Optional[float] = None
+        self.short_latency: Optional[float] = None
+        self.stale_windows = 0
+        # 探测基准时保存原上限
+        self.probe_from: Optional[float] = None
+        self.samples: List[float] = []
+        self.max_inflight = 0
+        self.drops = 0
+        self.total_samples = 0
+        self.total_drops = 0
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self.value))
+
+    def sample(self, latency: float, inflight: int, cost: Optional[float] = None, dropped: bool = False):
+        """
+        记录一次完成的操作
+        latency 为持有名额的时间，inflight 为开始时的并发数，cost 为处理的字节数，
+        dropped 表示超时或网络错误
+        """
+        self.total_samples += 1
+        if self.probe_from is not None and inflight > self.limit:
+            # 探测期间只使用并发已降到探测上限后开始的操作
+            return
+        self.max_inflight = max(self.max_inflight, inflight)
+        if dropped:
+            self.drops += 1
+            self.total_drops += 1
+        else:
+            self.samples.append(latency / max((cost or 0) / COST_UNIT, 1.0))
+        if len(self.samples) + self.drops < self.window:
+            return
+
+        short = sum(self.samples) / len(self.samples) if self.samples else None
+        if self.probe_from is not None:
+            new_value = self._finish_probe(short)
+        elif self.drops:
+            new_value = self.value * self.backoff
+        else:
+            new_value = self._gradient_limit(short)
+        self.samples = []
+        self.drops = 0
+        self.max_inflight = 0
+        self._set(new_value)
+
+    def _finish_probe(self, short: Optional[float]) -> float:
+        """以探测窗口的平均耗时作为新基准并恢复原上限，窗口内全部超时时只恢复上限"""
+        if short is not None:
+            self.short_latency = short
+            self.base_latency = short
+        restored, self.probe_from = self.probe_from, None
+        return restored
+
+    def _gradient_limit(self, short: float) -> float:
+        """根据短期平均耗时和基准耗时的比值计算新上限"""
+        self.short_latency = short
+        if self.base_latency is None or short < self.base_latency:
+            self.base_latency = short
+            self.stale_windows = 0
+        else:
+            self.stale_windows += 1
+            if self.stale_windows >= self.probe_interval:
+                self.stale_windows = 0
+                self.probe_from = self.value
+                return self.value / 4
+
+        if self.max_inflight < self.value / 2:
+            # 需求不足，不能据此判断更高的并发是否可行
+            return self.value
+        gradient = max(0.5, min(1.0, self.tolerance * self.base_latency / max(short, 1e-9)))
+        target = self.value * gradient + math.sqrt(self.value)
+        return self.value * (1 - self.smoothing) + target * self.smoothing
+
+    def _set(self, value: float):
+        old_limit = self.limit
+        self.value = min(max(value, self.min_limit), self.max_limit)
+        if self.limit != old_limit:
+            logger.info(f"{self.name} 并发上限调整: {old_limit} -> {self.limit}")
+            if self.on_change is not None:
+                self.on_change(self.limit)
+
+    def get_stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'min_limit': self.min_limit,
+            'max_limit': self.max_limit,
+            'short_latency': self.short_latency,
+            'base_latency': self.base_latency,
+            'probing': self.probe_from is not None,
+            'samples': self.total_samples,
+            'drops': self.total_drops
+        }
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from .token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    """等待发放的令牌"""
+    __slots__ = ('flow', 'size', 'future')
+
+    def __init__(self, flow: "Flow", size: int, future: asyncio.Future):
+        self.flow = flow
+        self.size = size
+        self.future = future
+
+
+class Flow:
+    """
+    一次传输（一个文件的下载或上传），多个连接的分段下载共用一个 Flow
+    每读取或写入一个数据块调用 consume，令牌不足时等待
+    """
+    __slots__ = ('link', 'user_id', 'transferred')
+
+    def __init__(self, link: Optional["_Link"], user_id: int):
+        self.link = link
+        self.user_id = user_id
+        self.transferred = 0
+
+    async def consume(self, size: int):
+        if self.link is not None:
+            await self.link.acquire(self, size)
+        self.transferred += size
+
+
+class _Link:
+    """
+    单个方向（入站或出站）的分层令牌桶
+    根节点为链路总速率，其中 reserve 比例留给 Telegram API 调用等控制流量，不参与分配；
+    其余带宽由批量传输共享，按用户轮询发放，每个用户获得相同份额，空闲用户的份额由其他用户借用，
+    可选 user_rate 限制单个用户的最高速率；
+    同一用户的多个传输中优先发放给已传输字节数最少的，小文件不会排在大文件之后
+    """
+    def __init__(self, name: str, rate: float, reserve: float = 0.1, user_rate: float = 0,
+                 burst_seconds: float = 0.5, max_users: int = 10000):
+        self.name = name
+        self.rate = rate
+        self.bulk_rate = rate * (1 - reserve)
+        self.user_rate = user_rate
+        self.burst_seconds = burst_seconds
+        self.max_users = max_users
+        self.bucket = TokenBucket(self.bulk_rate, max(self.bulk_rate * burst_seconds, 64 * 1024)) if rate > 0 else None
+        self.user_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        # 按用户排队，OrderedDict 的顺序即轮询顺序
+        self.queues: "OrderedDict[int, List[_Request]]" = OrderedDict()
+        self.pump_task: Optional[asyncio.Task] = None
+        self.transferred = 0
+
+    def _user_bucket(self, user_id: int) -> TokenBucket:
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.user_buckets[user_id] = TokenBucket(
+                self.user_rate, max(self.user_rate * self.burst_seconds, 64 * 1024)
+            )
+            while len(self.user_buckets) > self.max_users:
+                self.user_buckets.popitem(last=False)
+        else:
+            self.user_buckets.move_to_end(user_id)
+        return bucket
+
+    async def acquire(self, flow: Flow, size: int):
+        """获取 size 字节的令牌，先经过用户桶，再在根桶中按用户轮询排队"""
+        self.transferred += size
+        if self.user_rate > 0:
+            await self._user_bucket(flow.user_id).acquire(size)
+        if self.bucket is None:
+            return
+        idle = self.pump_task is None or self.pump_task.done()
+        if idle and self.bucket.try_acquire(size):
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(flow.user_id, []).append(_Request(flow, size, future))
+        if idle:
+            self.pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        """按用户轮询发放令牌，令牌不足时等待补充；超过桶容量的请求允许透支"""
+        while self.queues:
+            user_id, queue = next(iter(self.queues.items()))
+            request = min(queue, key=lambda item: item.flow.transferred)
+            queue.remove(request)
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            if request.future.done():
+                # 等待者已取消
+                continue
+
+            wait = self.bucket.delay(min(request.size, self.bucket.capacity))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.bucket.tokens -= request.size
+            if not request.future.done():
+                request.future.set_result(None)
+                # 让刚获得令牌的传输先重新排队，再选择下一个用户
+                await asyncio.sleep(0)
+
+    def get_stats(self) -> dict:
+        return {
+            'rate': self.rate,
+            'bulk_rate': self.bulk_rate,
+            'user_rate': self.user_rate,
+            'waiting_users': len(self.queues),
+            'transferred': self.transferred
+        }
+
+
+class BandwidthManager:
+    """
+    全局带宽管理
+    下载（入站）和上传（出站）各自一棵令牌桶: 链路总速率 -> 批量传输（扣除控制流量的预留部分）-> 各用户。
+    速率单位为字节/秒，0 表示不限速
+    """
+    def __init__(self, ingress_rate: float = 0, egress_rate: float = 0, reserve: float = 0.1,
+                 user_ingress_rate: float = 0, user_egress_rate: float = 0):
+        self.links: Dict[str, _Link] = {
+            'ingress': _Link('ingress', ingress_rate, reserve, user_ingress_rate),
+            'egress': _Link('egress', egress_rate, reserve, user_egress_rate)
+        }
+
+    def flow(self, direction: str, user_id: int) -> Flow:
+        """开始一次传输，direction 为 ingress 或 egress"""
+        link = self.links[direction]
+        return Flow(link if link.bucket is not None or link.user_rate > 0 else None, user_id)
+
+    def get_stats(self) -> Dict[str, dict]:
+        return {name: link.get_stats() for name, link in self.links.items()}
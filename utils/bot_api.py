@@ -0,0 +1,90 @@
+import os
+import logging
+from pathlib import Path
+from typing import Optional, Union
+
+from telegram.ext import ApplicationBuilder
+
+logger = logging.getLogger(__name__)
+
+# Telegram 官方 Bot API 的上传大小限制（MB）
+CLOUD_UPLOAD_LIMIT_MB = 50
+# 本地 Bot API 服务器的上传大小限制（MB）
+LOCAL_UPLOAD_LIMIT_MB = 2000
+
+
+class BotApiSettings:
+    """
+    Bot API 服务器配置
+    支持官方 Bot API 和自建的本地 Bot API 服务器（telegram-bot-api --local）。
+    本地模式下按文件路径发送视频，服务器直接读取共享下载目录中的文件，无需上传副本
+    """
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        base_file_url: Optional[str] = None,
+        local_mode: bool = False,
+        download_dir: str = "download",
+        server_download_dir: Optional[str] = None
+    ):
+        self.base_url = base_url
+        self.base_file_url = base_file_url
+        self.local_mode = local_mode
+        self.download_dir = os.path.abspath(download_dir)
+        # 下载目录在 Bot API 服务器中的挂载路径，默认与本机路径相同
+        self.server_download_dir = server_download_dir or self.download_dir
+
+        if local_mode and not base_url:
+            logger.warning("已启用本地模式但未配置 Bot API 服务器地址，将使用官方 Bot API")
+            self.local_mode = False
+
+    @property
+    def upload_limit_mb(self) -> int:
+        """当前服务器模式下的上传大小限制（MB）"""
+        return LOCAL_UPLOAD_LIMIT_MB if self.local_mode else CLOUD_UPLOAD_LIMIT_MB
+
+    def apply(self, builder: ApplicationBuilder) -> ApplicationBuilder:
+        """将服务器地址和本地模式配置到 ApplicationBuilder"""
+        if self.base_url:
+            builder = builder.base_url(self.base_url)
+            builder = builder.base_file_url(self.base_file_url or self._default_file_url())
+        if self.local_mode:
+            builder = builder.local_mode(True)
+        return builder
+
+    def _default_file_url(self) -> str:
+        """按官方地址格式由 .../bot 推导出 .../file/bot"""
+        root = self.base_url.rstrip('/')
+        if root.endswith('/bot'):
+            root = root[:-len('/bot')]
+        return f"{root}/file/bot"
+
+    def server_path(self, file_path: str) -> str:
+        """将本机文件路径转换为 Bot API 服务器中的路径"""
+        relative = os.path.relpath(os.path.abspath(file_path), self.download_dir)
+        if relative.startswith(os.pardir):
+            raise ValueError(f"文件不在共享下载目录中: {file_path}")
+        return os.path.join(self.server_download_dir, relative)
+
+    def file_input(self, file_path: str) -> Optional[Union[str, Path]]:
+        """
+        本地模式下返回可直接传给 send_* 方法的文件引用，否则返回 None 表示需要上传
+        路径相同时交给 PTB 转换为 file:// URI，不同时直接传入服务器端的 file:// URI；
+        文件不在共享下载目录中时服务器无法读取，同样返回 None 改为上传
+        """
+        if not self.local_mode:
+            return None
+        try:
+            server_path = self.server_path(file_path)
+        except ValueError as e:
+            logger.warning(f"{e}，改为上传")
+            return None
+        if server_path == os.path.abspath(file_path):
+            return Path(server_path)
+        return Path(server_path).as_uri()
+
+    def describe(self) -> str:
+        """用于日志和统计的简短描述"""
+        if not self.base_url:
+            return "官方 Bot API"
+        return f"{self.base_url} ({'本地模式' if self.local_mode else '远程模式'})"
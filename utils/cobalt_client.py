@@ -0,0 +1,346 @@
+import time
+import logging
+import importlib.util
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+from . import tracing
+from .ssl_context import shared_ssl_context
+
+logger = logging.getLogger(__name__)
+
+
+class CobaltError(Exception):
+    """
+    Cobalt 解析失败
+    code 为 Cobalt 返回的错误码，user_message 可直接回复给用户，permanent 表示重试无意义
+    """
+    permanent = False
+    default_message = "解析视频链接失败，请稍后重试"
+
+    def __init__(self, message: str, code: Optional[str] = None, user_message: Optional[str] = None):
+        super().__init__(message)
+        self.code = code
+        self.user_message = user_message or self.default_message
+
+
+class UnsupportedLinkError(CobaltError):
+    """链接无效或平台不受支持"""
+    permanent = True
+    default_message = "暂不支持该链接，请确认链接是否正确"
+
+
+class ContentUnavailableError(CobaltError):
+    """内容不存在、私密、有年龄限制或过长"""
+    permanent = True
+    default_message = "无法获取该视频，可能已被删除、设为私密或超出时长限制"
+
+
+class RateLimitedError(CobaltError):
+    """Cobalt 或源站限流"""
+    default_message = "请求过于频繁，请稍后再试"
+
+    def __init__(self, message: str, code: Optional[str] = None, user_message: Optional[str] = None,
+                 retry_after: float = 0.0):
+        super().__init__(message, code, user_message)
+        self.retry_after = retry_after
+
+
+class BackendUnavailableError(CobaltError):
+    """所有 Cobalt 实例都不可用"""
+    default_message = "视频解析服务暂时不可用，请稍后重试"
+
+
+def classify_error(code: str, context: Optional[dict] = None) -> CobaltError:
+    """将 Cobalt 的错误码转换为对应的异常类型"""
+    context = context or {}
+    if code == 'error.api.rate_exceeded' or code.endswith('.rate'):
+        return RateLimitedError(f"Cobalt 限流: {code}", code, retry_after=float(context.get('limit') or 0))
+    if code.startswith('error.api.link') or code.startswith('error.api.service.unsupported') \
+            or code == 'error.api.service.disabled':
+        return UnsupportedLinkError(f"不支持的链接: {code}", code)
+    if code.startswith('error.api.content') or code.startswith('error.api.youtube'):
+        return ContentUnavailableError(f"内容不可用: {code}", code)
+    return CobaltError(f"Cobalt 返回错误: {code}", code)
+
+
+def link_expiry(url: str) -> Optional[float]:
+    """
+    从链接参数中读取过期时间（Unix 秒）
+    Cobalt tunnel 链接使用毫秒的 exp 参数，部分源站直链使用秒级的 expire/expires 参数
+    """
+    try:
+        query = parse_qs(urlsplit(url).query)
+    except ValueError:
+        return None
+    for name in ('exp', 'expire', 'expires'):
+        if name in query:
+            try:
+                value = float(query[name][0])
+            except ValueError:
+                continue
+            # 毫秒时间戳
+            return value / 1000 if value > 1e11 else value
+    return None
+
+
+class _Backend:
+    """
+    单个 Cobalt 实例
+    记录延迟的指数移动平均和进行中的请求数，并维护熔断状态:
+    closed 正常; open 连续失败后暂停使用; half_open 冷却结束后只放行一个探测请求
+    """
+    def __init__(self, url: str, failure_threshold: int, cooldown: float, smoothing: float = 0.3):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.latency: Optional[float] = None
+        self.in_flight = 0
+        self.failures = 0
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probing = False
+
+    def available(self, now: float) -> bool:
+        """是否可以接收请求，冷却结束的熔断实例转为半开"""
+        if self.state == 'open' and now - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self.probing = False
+        if self.state == 'half_open':
+            return not self.probing
+        return self.state == 'closed'
+
+    def score(self) -> float:
+        """预期等待时间，未测得延迟的实例优先尝试"""
+        return (self.latency or 0.0) * (self.in_flight + 1)
+
+    def record_success(self, latency: float):
+        self.latency = latency if self.latency is None else \
+            self.smoothing * latency + (1 - self.smoothing) * self.latency
+        self.failures = 0
+        if self.state != 'closed':
+            logger.info(f"Cobalt 实例已恢复: {self.url}")
+        self.state = 'closed'
+        self.probing = False
+
+    def record_failure(self, now: float):
+        self.failures += 1
+        self.probing = False
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"Cobalt 实例熔断 {self.cooldown:.0f}秒: {self.url}")
+            self.state = 'open'
+            self.opened_at = now
+
+
+class CobaltClient:
+    """
+    Cobalt API 解析器
+    支持多个 Cobalt 实例，按延迟和进行中的请求数选择实例，失败时切换到其他实例；
+    每个实例独立熔断，冷却后以单个请求探测是否恢复。
+    成功结果按 TTL 缓存（不超过 tunnel 链接的过期时间），永久性错误短时间缓存。
+    所有实例共享一个长连接 httpx.AsyncClient
+    """
+    def __init__(
+        self,
+        api_urls: Union[str, Sequence[str]],
+        api_key: Optional[str] = None,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        http2: bool = True,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        cache_ttl: float = 300.0,
+        negative_ttl: float = 60.0,
+        expiry_margin: float = 30.0,
+        max_cache_entries: int = 1000
+    ):
+        if isinstance(api_urls, str):
+            api_urls = [url.strip() for url in api_urls.split(',') if url.strip()]
+        if not api_urls:
+            raise ValueError("至少需要一个 Cobalt API 地址")
+        self.backends: List[_Backend] = [_Backend(url, failure_threshold, cooldown) for url in api_urls]
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.expiry_margin = expiry_margin
+        self.max_cache_entries = max_cache_entries
+        # 链接 -> (过期时间, 解析结果或永久性错误)
+        self.cache: "OrderedDict[str, Tuple[float, Union[dict, CobaltError]]]" = OrderedDict()
+
+        # HTTP/2 需要安装 h2 依赖，缺失时回退到 HTTP/1.1
+        self.http2 = http2 and importlib.util.find_spec('h2') is not None
+        if http2 and not self.http2:
+            logger.warning("未安装 h2，Cobalt 客户端将使用 HTTP/1.1")
+
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        """创建连接池"""
+        if self.client is None or self.client.is_closed:
+            headers = {
+                "Accept": "application/json",
+                "Content-Type": "application/json"
+            }
+            if self.api_key:
+                headers["Authorization"] = f"Api-Key {self.api_key}"
+
+            self.client = httpx.AsyncClient(
+                headers=headers,
+                limits=self.limits,
+                timeout=self.timeout,
+                http2=self.http2,
+                verify=shared_ssl_context(self.http2)
+            )
+            logger.info(f"Cobalt 客户端已启动 (HTTP/{'2' if self.http2 else '1.1'})，实例数: {len(self.backends)}")
+
+    async def close(self):
+        """关闭连接池"""
+        if self.client is not None and not self.client.is_closed:
+            await self.client.aclose()
+            logger.info("Cobalt 客户端已关闭")
+
+    async def resolve(self, url: str) -> dict:
+        """
+        解析视频链接，返回 Cobalt 的响应（tunnel、redirect 或 picker）
+        失败时抛出 CobaltError 的子类
+        """
+        cached = self._cache_get(url)
+        if isinstance(cached, CobaltError):
+            raise cached
+        if cached is not None:
+            tracing.annotate(cached=True)
+            return cached
+
+        if self.client is None or self.client.is_closed:
+            await self.start()
+
+        try:
+            result = await self._resolve_with_failover(url)
+        except CobaltError as e:
+            if e.permanent:
+                self._cache_put(url, e, self.negative_ttl)
+            raise
+        self._cache_put(url, result, self._result_ttl(result))
+        return result
+
+    async def _resolve_with_failover(self, url: str) -> dict:
+        """按预期等待时间依次尝试可用实例，实例故障或限流时切换到下一个"""
+        tried = set()
+        rate_limited: Optional[RateLimitedError] = None
+        last_error: Optional[Exception] = None
+        while True:
+            backend = self._pick(tried)
+            if backend is None:
+                break
+            tried.add(backend)
+            tracing.annotate(backend=backend.url, backends_tried=len(tried))
+            try:
+                return await self._request(backend, url)
+            except RateLimitedError as e:
+                rate_limited = e
+                logger.warning(f"Cobalt 实例限流 {backend.url}: {e.code}")
+            except (httpx.HTTPError, ValueError) as e:
+                last_error = e
+                logger.warning(f"Cobalt 实例请求失败 {backend.url}: {e!r}")
+        if rate_limited is not None:
+            raise rate_limited
+        raise BackendUnavailableError(f"没有可用的 Cobalt 实例: {last_error!r}")
+
+    def _pick(self, tried) -> Optional[_Backend]:
+        """选择预期等待时间最短的可用实例"""
+        now = time.monotonic()
+        candidates = [backend for backend in self.backends if backend not in tried and backend.available(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: backend.score())
+
+    async def _request(self, backend: _Backend, url: str) -> dict:
+        """向单个实例发送请求并更新其延迟和熔断状态"""
+        if backend.state == 'half_open':
+            backend.probing = True
+        backend.in_flight += 1
+        start = time.monotonic()
+        try:
+            response = await self.client.post(backend.url, json={"url": url})
+            latency = time.monotonic() - start
+            if response.status_code >= 500:
+                response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError):
+            backend.record_failure(time.monotonic())
+            raise
+        finally:
+            backend.in_flight -= 1
+            # 探测请求被取消时允许下一个请求继续探测
+            backend.probing = False
+
+        # 实例能正常返回结果，即使是业务错误也视为健康
+        backend.record_success(latency)
+        if data.get('status') == 'error' or response.status_code >= 400:
+            error = data.get('error') or {}
+            code = error.get('code') if isinstance(error, dict) else str(error)
+            if response.status_code == 429 and not code:
+                code = 'error.api.rate_exceeded'
+            raise classify_error(code or f"http.{response.status_code}", error.get('context') if isinstance(error, dict) else None)
+        return data
+
+    def _result_ttl(self, result: dict) -> float:
+        """缓存时间不超过结果中链接的过期时间"""
+        ttl = self.cache_ttl
+        urls = [result.get('url')] + [item.get('url') for item in result.get('picker') or []]
+        for link in urls:
+            expires = link_expiry(link) if link else None
+            if expires is not None:
+                ttl = min(ttl, expires - time.time() - self.expiry_margin)
+        return ttl
+
+    def _cache_get(self, url: str) -> Union[dict, CobaltError, None]:
+        entry = self.cache.get(url)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self.cache[url]
+            return None
+        self.cache.move_to_end(url)
+        return value
+
+    def _cache_put(self, url: str, value: Union[dict, CobaltError], ttl: float):
+        if ttl <= 0:
+            return
+        self.cache[url] = (time.monotonic() + ttl, value)
+        self.cache.move_to_end(url)
+        while len(self.cache) > self.max_cache_entries:
+            self.cache.popitem(last=False)
+
+    def invalidate(self, url: str):
+        """删除缓存的解析结果，如下载链接已失效时"""
+        self.cache.pop(url, None)
+
+    def get_stats(self) -> Dict[str, dict]:
+        """各实例的熔断状态、延迟和进行中的请求数"""
+        now = time.monotonic()
+        return {
+            backend.url: {
+                'state': 'half_open' if backend.state == 'open' and now - backend.opened_at >= backend.cooldown
+                else backend.state,
+                'latency': backend.latency,
+                'in_flight': backend.in_flight,
+                'failures': backend.failures
+            }
+            for backend in self.backends
+        }
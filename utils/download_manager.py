@@ -1,154 +1,455 @@
 import os
+import json
 import time
+import hashlib
 import logging
-import requests
 import asyncio
-from typing import Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
-from .resource_monitor import ResourceMonitor
+from typing import Awaitable, Callable, Optional, TYPE_CHECKING
+
+import httpx
+
+from . import tracing
+from .metrics import Metrics
+from .storage_manager import DiskSpaceError, StorageManager
+from .ssl_context import shared_ssl_context
+
+if TYPE_CHECKING:
+    from .bandwidth_manager import BandwidthManager
 
 logger = logging.getLogger(__name__)
 
+# 下载进度回调: (已下载字节数, 总字节数或None, 当前速度 bytes/s)
+ProgressCallback = Callable[[int, Optional[int], float], Awaitable[None]]
+# 限速回调: 参数为刚读取或即将发送的字节数，带宽不足时等待
+Throttle = Callable[[int], Awaitable[None]]
+# 超时和连接错误，说明源站或链路过载；文件过大、4xx、磁盘空间不足等其他错误与并发无关
+TRANSIENT_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+class FileTooLargeError(Exception):
+    """文件超过大小限制"""
+
+
+class RangeNotSatisfiableError(Exception):
+    """服务端不支持或拒绝分段请求"""
+
+
+class SourceChangedError(Exception):
+    """分段响应的文件总大小、ETag 或 Last-Modified 与断点记录不一致，源文件已变化"""
+
+
+class _Progress:
+    """汇总多个连接的下载进度，并按间隔回调；设置 throttle 时每个数据块都经过带宽限速"""
+    def __init__(self, callback: Optional[ProgressCallback], interval: float, throttle: Optional[Throttle] = None):
+        self.callback = callback
+        self.interval = interval
+        self.throttle = throttle
+        self.total = None
+        self.downloaded = 0
+        self.last_report = time.time()
+        self.last_reported_bytes = 0
+
+    def reset(self, total: Optional[int], downloaded: int = 0):
+        """开始新的下载尝试"""
+        self.total = total
+        self.downloaded = downloaded
+        self.last_reported_bytes = downloaded
+
+    async def add(self, size: int):
+        """累加已下载字节数"""
+        if self.throttle is not None:
+            await self.throttle(size)
+        self.downloaded += size
+        now = time.time()
+        if self.callback and now - self.last_report >= self.interval:
+            speed = (self.downloaded - self.last_reported_bytes) / (now - self.last_report)
+            self.last_report = now
+            self.last_reported_bytes = self.downloaded
+            await self.callback(self.downloaded, self.total, speed)
+
+    async def finish(self, elapsed: float):
+        """下载完成时回调平均速度"""
+        if self.callback:
+            await self.callback(self.downloaded, self.total, self.downloaded / max(elapsed, 1e-6))
+
+
 class DownloadManager:
     def __init__(
         self,
         max_workers: int = 8,
-        max_concurrent_per_user: int = 3,
         download_timeout: int = 180,
         max_retries: int = 3,
         max_file_size: int = 2000,
-        download_dir: str = "download"
+        download_dir: str = "download",
+        chunk_size: int = 1024 * 1024,
+        progress_interval: float = 1.0,
+        segments: int = 4,
+        segment_min_size: int = 16 * 1024 * 1024,
+        state_save_interval: int = 8 * 1024 * 1024,
+        metrics: Optional[Metrics] = None,
+        storage: Optional[StorageManager] = None,
+        bandwidth: Optional["BandwidthManager"] = None
     ):
         self.max_workers = max_workers
-        self.max_concurrent_per_user = max_concurrent_per_user
         self.download_timeout = download_timeout
         self.max_retries = max_retries
         self.max_file_size = max_file_size
         self.download_dir = download_dir
-        
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
-        self.active_downloads = {}
-        self.download_lock = Lock()
-        self.resource_monitor = ResourceMonitor()
-        
-        # 性能指标
-        self.metrics = {
-            'total_downloads': 0,
-            'successful_downloads': 0,
-            'failed_downloads': 0,
-            'total_processing_time': 0
-        }
-        self.metrics_lock = Lock()
-
-    async def can_start_download(self, user_id: int) -> Tuple[bool, str]:
-        """检查用户是否可以开始新的下载"""
-        # 检查系统资源
-        can_proceed, message = self.resource_monitor.check_system_resources()
-        if not can_proceed:
-            return False, message
-
-        with self.download_lock:
-            current_downloads = self.active_downloads.get(user_id, 0)
-            if current_downloads >= self.max_concurrent_per_user:
-                return False, f"您当前已有{current_downloads}个下载任务正在进行"
-            self.active_downloads[user_id] = current_downloads + 1
-            
-        return True, ""
-
-    def update_metrics(self, success: bool, processing_time: float):
-        """更新性能指标"""
-        with self.metrics_lock:
-            self.metrics['total_downloads'] += 1
-            if success:
-                self.metrics['successful_downloads'] += 1
-            else:
-                self.metrics['failed_downloads'] += 1
-            self.metrics['total_processing_time'] += processing_time
-
-    async def check_file_size(self, url: str) -> Tuple[bool, float, str]:
-        """检查文件大小"""
-        try:
-            # u4f7fu7528 loop.run_in_executor u6765u5f02u6b65u6267u884cu540cu6b65u8bf7u6c42
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: requests.head(url, timeout=10)
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self.state_save_interval = state_save_interval
+
+        self.client: Optional[httpx.AsyncClient] = None
+
+        # Prometheus 指标，可选
+        self.metrics = metrics
+        # 文件存储，可选，用于按可用空间做下载准入
+        self.storage = storage
+        # 带宽管理，可选，所有下载连接共享入站带宽
+        self.bandwidth = bandwidth
+
+    async def start(self):
+        """创建下载连接池，max_workers 为最大并发连接数"""
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_workers,
+                    max_keepalive_connections=self.max_workers
+                ),
+                timeout=httpx.Timeout(self.download_timeout, connect=10.0),
+                verify=shared_ssl_context()
             )
-            
-            size_mb = int(response.headers.get('content-length', 0)) / (1024 * 1024)
-            if size_mb > self.max_file_size:
-                return False, size_mb, f"文件太大 ({size_mb:.1f}MB)，超过限制 ({self.max_file_size}MB)"
-            return True, size_mb, ""
-        except Exception as e:
-            logger.warning(f"无法获取文件大小: {e}")
-            return True, 0, ""  # 如果无法获取大小，允许继续下载
 
-    async def download_file(self, url: str, user_id: int) -> Optional[str]:
-        """下载文件"""
+    async def close(self):
+        """关闭下载连接池"""
+        if self.client is not None and not self.client.is_closed:
+            await self.client.aclose()
+
+    def _check_size(self, size_bytes: int):
+        """超过大小限制时抛出异常"""
+        size_mb = size_bytes / (1024 * 1024)
+        if size_mb > self.max_file_size:
+            raise FileTooLargeError(f"文件太大 ({size_mb:.1f}MB)，超过限制 ({self.max_file_size}MB)")
+
+    async def download_file(
+        self,
+        url: str,
+        user_id: int,
+        progress_callback: Optional[ProgressCallback] = None,
+        file_key: Optional[str] = None,
+        stream_sink=None,
+        suffix: str = '.mp4',
+        on_error: Optional[Callable[[Exception], None]] = None
+    ) -> Optional[str]:
+        """
+        下载文件
+        file_key 用于生成稳定的文件名，相同的键在重试或重启后可以续传。
+        stream_sink 需提供 open(total)、feed(chunk) 和 abort()，open 返回 True 时
+        以单连接顺序下载，并将每个数据块同时送入 stream_sink；suffix 为保存文件的扩展名。
+        下载失败时返回 None，并以导致失败的异常调用 on_error，调用方据此区分超时、网络错误和
+        文件过大、链接失效等其他原因
+        """
         start_time = time.time()
-        success = False
-        
+
         try:
+            if self.client is None or self.client.is_closed:
+                await self.start()
+
             # 创建用户下载目录
             user_dir = os.path.join(self.download_dir, str(user_id))
             os.makedirs(user_dir, exist_ok=True)
-            
-            # 检查文件大小
-            can_download, size_mb, message = await self.check_file_size(url)
-            if not can_download:
-                raise Exception(message)
-                
-            # 开始下载
-            file_path = os.path.join(user_dir, f"{int(time.time())}.mp4")
-            
-            # u4f7fu7528 loop.run_in_executor u6765u5f02u6b65u6267u884cu540cu6b65u4e0bu8f7d
-            loop = asyncio.get_event_loop()
-            
-            def download_task():
-                with requests.get(url, stream=True, timeout=self.download_timeout) as response:
-                    response.raise_for_status()
-                    with open(file_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-            
-            # u5f02u6b65u6267u884cu4e0bu8f7du4efbu52a1
-            await loop.run_in_executor(None, download_task)
-            
-            success = True
+            name = hashlib.sha1((file_key or url).encode()).hexdigest()[:16]
+            file_path = os.path.join(user_dir, f"{name}{suffix}")
+            part_path = f"{file_path}.part"
+
+            # 分段下载的多个连接共用一个带宽流
+            throttle = self.bandwidth.flow('ingress', user_id).consume if self.bandwidth is not None else None
+            progress = _Progress(progress_callback, self.progress_interval, throttle)
+            allow_segments = True
+            restarted = False
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    await self._download_attempt(url, part_path, progress, allow_segments, stream_sink)
+                    break
+                except (FileTooLargeError, DiskSpaceError):
+                    await self._discard(part_path)
+                    raise
+                except RangeNotSatisfiableError as e:
+                    # 分段请求不可用时回退到单连接下载，不计入重试次数
+                    logger.warning(f"{e}，回退到单连接下载")
+                    await self._discard(part_path)
+                    allow_segments = False
+                    attempt -= 1
+                    continue
+                except SourceChangedError as e:
+                    # 重新解析后的链接可能指向不同的文件，已下载的区间不能拼接，从头下载；
+                    # 只免费重来一次，之后按普通错误计入重试次数
+                    await self._discard(part_path)
+                    if not restarted:
+                        logger.warning(f"{e}，从头重新下载")
+                        restarted = True
+                        attempt -= 1
+                        continue
+                    error = e
+                except httpx.HTTPStatusError as e:
+                    # 客户端错误重试无意义
+                    if e.response.status_code < 500 and e.response.status_code != 429:
+                        raise
+                    error = e
+                except (httpx.HTTPError, OSError) as e:
+                    error = e
+                if attempt == self.max_retries:
+                    raise error
+                if stream_sink is not None:
+                    # 重试会从头或断点读取，已送入的数据无法接续
+                    await stream_sink.abort()
+                    stream_sink = None
+                logger.warning(f"下载中断，正在重试 ({attempt}/{self.max_retries}): {error}")
+                await asyncio.sleep(2 ** attempt)
+
+            os.replace(part_path, file_path)
+
+            elapsed = time.time() - start_time
+            tracing.annotate(bytes=progress.downloaded, size=progress.total, attempts=attempt)
+            logger.info(
+                f"下载完成: {progress.downloaded / 1024 / 1024:.1f}MB, "
+                f"平均速度: {progress.downloaded / 1024 / 1024 / max(elapsed, 1e-6):.2f}MB/s"
+            )
+            await progress.finish(elapsed)
+
+            if self.metrics is not None:
+                self.metrics.download_duration.observe(elapsed)
+                self.metrics.download_bytes.inc(progress.downloaded)
+                self.metrics.download_throughput.observe(progress.downloaded / max(elapsed, 1e-6))
             return file_path
-            
+
         except Exception as e:
             logger.error(f"下载失败: {e}")
+            if on_error is not None:
+                on_error(e)
             return None
-            
+
+    async def _download_attempt(self, url: str, part_path: str, progress: "_Progress",
+                                allow_segments: bool = True, stream_sink=None):
+        """执行一次下载尝试，存在分段进度记录时只下载缺失的部分"""
+        state_path = f"{part_path}.json"
+        state = await self._load_state(state_path, part_path) if allow_segments else None
+        if state:
+            logger.info(f"从断点续传: {part_path}")
+            tracing.annotate(mode='resume')
+            await self._download_segments(url, part_path, state_path, state, progress)
+            return
+
+        async with self.client.stream('GET', url) as response:
+            response.raise_for_status()
+
+            # 根据响应头提前拒绝过大的文件，无需额外的 HEAD 请求
+            content_length = response.headers.get('content-length')
+            total = int(content_length) if content_length and content_length.isdigit() else None
+            if total is not None:
+                self._check_size(total)
+            # 空间不足时先淘汰存储中的旧文件，仍不足则拒绝下载
+            if self.storage is not None and not await self.storage.admit(total or 0):
+                raise DiskSpaceError("磁盘可用空间不足，无法下载")
+
+            # 需要顺序送入数据时只能单连接下载
+            streaming = stream_sink is not None and await stream_sink.open(total)
+
+            # 服务端支持 Range 且文件足够大时改用多连接分段下载
+            ranged = (
+                not streaming
+                and allow_segments
+                and total is not None
+                and self.segments > 1
+                and total >= self.segment_min_size
+                and response.headers.get('accept-ranges', '').lower() == 'bytes'
+            )
+            tracing.annotate(mode='segments' if ranged else 'stream' if streaming else 'single')
+            if not ranged:
+                await self._download_stream(response, part_path, total, progress,
+                                            stream_sink if streaming else None)
+                return
+
+        state = self._create_state(total, response.headers)
+        await self._preallocate(part_path, total)
+        await self._save_state(state_path, state)
+        await self._download_segments(url, part_path, state_path, state, progress)
+
+    async def _download_stream(self, response: httpx.Response, part_path: str,
+                               total: Optional[int], progress: "_Progress", stream_sink=None):
+        """单连接流式下载"""
+        loop = asyncio.get_running_loop()
+        progress.reset(total)
+        f = await loop.run_in_executor(None, open, part_path, 'wb')
+        try:
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                # Content-Length 缺失或不准确时，在流式读取过程中强制大小限制
+                self._check_size(progress.downloaded + len(chunk))
+                # 在线程池中写入磁盘，避免阻塞事件循环
+                if stream_sink is not None:
+                    # 写盘和送入 stream_sink 并行进行
+                    await asyncio.gather(
+                        loop.run_in_executor(None, f.write, chunk),
+                        stream_sink.feed(chunk)
+                    )
+                else:
+                    await loop.run_in_executor(None, f.write, chunk)
+                await progress.add(len(chunk))
         finally:
-            # 更新指标
-            processing_time = time.time() - start_time
-            self.update_metrics(success, processing_time)
-            
-            # 减少活跃下载计数
-            with self.download_lock:
-                self.active_downloads[user_id] = max(0, self.active_downloads.get(user_id, 1) - 1)
-
-    async def cleanup_old_files(self, max_age_hours: int = 24):
-        """清理旧文件"""
+            await loop.run_in_executor(None, f.close)
+
+    def _create_state(self, total: int, headers: httpx.Headers) -> dict:
+        """将文件划分为若干字节区间，并记录用于续传时校验源文件的 ETag 和 Last-Modified"""
+        segment_size = -(-total // self.segments)
+        segments = [
+            [offset, min(offset + segment_size, total) - 1, offset]
+            for offset in range(0, total, segment_size)
+        ]
+        return {
+            'total': total, 'segments': segments,
+            'etag': headers.get('etag'), 'last_modified': headers.get('last-modified')
+        }
+
+    @staticmethod
+    def _check_source(response: httpx.Response, state: dict):
+        """校验分段响应与断点记录来自同一文件，记录或响应中缺少的字段不参与比较"""
+        content_range = response.headers.get('content-range', '')
+        total = content_range.rpartition('/')[2]
+        if total.isdigit() and int(total) != state['total']:
+            raise SourceChangedError(f"源文件大小已变化: {state['total']} -> {total}")
+        for field, header in (('etag', 'etag'), ('last_modified', 'last-modified')):
+            expected, actual = state.get(field), response.headers.get(header)
+            if expected and actual and expected != actual:
+                raise SourceChangedError(f"源文件 {header} 已变化: {expected} -> {actual}")
+
+    async def _download_segments(self, url: str, part_path: str, state_path: str,
+                                 state: dict, progress: "_Progress"):
+        """并行下载各个未完成的区间，每个区间记录 [起始, 结束, 下一个待写入位置]"""
+        loop = asyncio.get_running_loop()
+        total = state['total']
+        self._check_size(total)
+        progress.reset(total, sum(pos - begin for begin, _, pos in state['segments']))
+
+        fd = await loop.run_in_executor(None, os.open, part_path, os.O_WRONLY)
         try:
+            pending = [segment for segment in state['segments'] if segment[2] <= segment[1]]
+            tasks = [
+                asyncio.create_task(self._download_range(url, fd, segment, state_path, state, progress))
+                for segment in pending
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await self._save_state(state_path, state)
+        finally:
+            await loop.run_in_executor(None, os.close, fd)
+
+        await loop.run_in_executor(None, os.remove, state_path)
+
+    async def _download_range(self, url: str, fd: int, segment: list, state_path: str,
+                              state: dict, progress: "_Progress"):
+        """下载单个字节区间并写入预分配文件的对应位置"""
+        loop = asyncio.get_running_loop()
+        headers = {'Range': f"bytes={segment[2]}-{segment[1]}"}
+        unsaved = 0
+        async with self.client.stream('GET', url, headers=headers) as response:
+            if response.status_code == 416:
+                raise RangeNotSatisfiableError("服务端拒绝了分段请求")
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RangeNotSatisfiableError("服务端不支持分段下载")
+            self._check_source(response, state)
+
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                chunk = chunk[:segment[1] + 1 - segment[2]]
+                if not chunk:
+                    break
+                await loop.run_in_executor(None, os.pwrite, fd, chunk, segment[2])
+                segment[2] += len(chunk)
+                await progress.add(len(chunk))
+
+                # 定期保存进度，中断后可从此处续传
+                unsaved += len(chunk)
+                if unsaved >= self.state_save_interval:
+                    await self._save_state(state_path, state)
+                    unsaved = 0
+
+        if segment[2] <= segment[1]:
+            raise httpx.ReadError(f"区间 {segment[0]}-{segment[1]} 未下载完整")
+
+    async def _discard(self, part_path: str):
+        """删除未完成的下载文件及其进度记录"""
+        def discard():
+            for path in (part_path, f"{part_path}.json"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        await asyncio.get_running_loop().run_in_executor(None, discard)
+
+    async def _preallocate(self, part_path: str, total: int):
+        """预分配目标文件"""
+        def preallocate():
+            with open(part_path, 'wb') as f:
+                f.truncate(total)
+
+        await asyncio.get_running_loop().run_in_executor(None, preallocate)
+
+    async def _save_state(self, state_path: str, state: dict):
+        """原子地写入分段进度记录"""
+        def save():
+            tmp_path = f"{state_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, state_path)
+
+        await asyncio.get_running_loop().run_in_executor(None, save)
+
+    async def _load_state(self, state_path: str, part_path: str) -> Optional[dict]:
+        """读取分段进度记录，记录无效时删除"""
+        def load():
+            if not os.path.exists(state_path):
+                return None
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                if os.path.getsize(part_path) == state['total']:
+                    return state
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"分段进度记录无效，重新下载: {e}")
+            os.remove(state_path)
+            return None
+
+        return await asyncio.get_running_loop().run_in_executor(None, load)
+
+    async def cleanup_old_files(self, max_age_hours: int = 24, exclude: Optional[str] = None):
+        """在线程池中清理长时间未修改的文件，如中断后未再续传的 .part 文件；exclude 目录由其他组件管理"""
+        def cleanup():
             current_time = time.time()
-            for root, _, files in os.walk(self.download_dir):
+            excluded = os.path.abspath(exclude) if exclude else None
+            for root, dirs, files in os.walk(self.download_dir):
+                # 跳过隐藏目录（如持久化状态目录）和排除的目录
+                dirs[:] = [
+                    d for d in dirs
+                    if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) != excluded
+                ]
                 for file in files:
                     file_path = os.path.join(root, file)
-                    if current_time - os.path.getctime(file_path) > max_age_hours * 3600:
-                        try:
+                    try:
+                        if current_time - os.path.getmtime(file_path) > max_age_hours * 3600:
                             os.remove(file_path)
                             logger.info(f"已清理旧文件: {file_path}")
-                        except Exception as e:
-                            logger.error(f"清理文件失败 {file_path}: {e}")
+                    except OSError as e:
+                        logger.error(f"清理文件失败 {file_path}: {e}")
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, cleanup)
         except Exception as e:
             logger.error(f"清理旧文件失败: {e}")
-
-    def get_metrics(self) -> dict:
-        """获取性能指标"""
-        with self.metrics_lock:
-            return self.metrics.copy()
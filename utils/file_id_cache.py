@@ -0,0 +1,182 @@
+import os
+import time
+import sqlite3
+import logging
+from typing import Dict, Optional
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+class FileIdCache:
+    """
+    持久化的 Telegram file_id 缓存
+    将归一化后的URL映射到 Telegram 返回的 file_id，命中时无需重新下载和上传。
+    命中时的访问时间先记录在内存中，累计 flush_threshold 条或距上次写入超过 flush_interval 秒时批量写入，
+    写入缓存和关闭时也会写入；超出条目数或 file_size 总和（max_bytes，0 表示不限制）时按最近最少使用淘汰
+    """
+    def __init__(
+        self,
+        db_path: str,
+        ttl: int = 7 * 24 * 3600,
+        max_entries: int = 10000,
+        max_bytes: int = 0,
+        flush_threshold: int = 100,
+        flush_interval: float = 60.0
+    ):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.flush_threshold = flush_threshold
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        # 尚未写入数据库的访问时间
+        self.touched: Dict[str, float] = {}
+        self.last_flush = time.monotonic()
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS file_ids (
+                url_key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                file_size INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_file_ids_last_access ON file_ids (last_access)"
+        )
+        self.conn.commit()
+
+    def get(self, url_key: str) -> Optional[str]:
+        """查找缓存的 file_id，过期条目视为未命中"""
+        now = time.time()
+        try:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT file_id, created_at FROM file_ids WHERE url_key = ?",
+                    (url_key,)
+                ).fetchone()
+                if not row:
+                    return None
+
+                file_id, created_at = row
+                if now - created_at > self.ttl:
+                    self.touched.pop(url_key, None)
+                    self.conn.execute("DELETE FROM file_ids WHERE url_key = ?", (url_key,))
+                    self.conn.commit()
+                    return None
+
+                self.touched[url_key] = now
+                if len(self.touched) >= self.flush_threshold or \
+                        time.monotonic() - self.last_flush >= self.flush_interval:
+                    self._write_touched()
+                    self.conn.commit()
+                return file_id
+        except sqlite3.Error as e:
+            logger.error(f"读取 file_id 缓存失败: {e}")
+            return None
+
+    def put(self, url_key: str, file_id: str, file_size: int = 0):
+        """写入缓存，超出条目上限时按最近最少使用淘汰"""
+        now = time.time()
+        try:
+            with self.lock:
+                self.conn.execute(
+                    """
+                    INSERT INTO file_ids (url_key, file_id, file_size, created_at, last_access)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(url_key) DO UPDATE SET
+                        file_id = excluded.file_id,
+                        file_size = excluded.file_size,
+                        created_at = excluded.created_at,
+                        last_access = excluded.last_access
+                    """,
+                    (url_key, file_id, file_size, now, now)
+                )
+                self.touched.pop(url_key, None)
+                # 淘汰前写入访问时间，保证按最近访问排序
+                self._write_touched()
+                self._evict(now)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"写入 file_id 缓存失败: {e}")
+
+    def invalidate(self, url_key: str):
+        """删除失效的缓存条目"""
+        try:
+            with self.lock:
+                self.touched.pop(url_key, None)
+                self.conn.execute("DELETE FROM file_ids WHERE url_key = ?", (url_key,))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"删除 file_id 缓存失败: {e}")
+
+    def _write_touched(self):
+        """批量写入内存中的访问时间，由调用方提交"""
+        if self.touched:
+            self.conn.executemany(
+                "UPDATE file_ids SET last_access = ? WHERE url_key = ?",
+                [(last_access, url_key) for url_key, last_access in self.touched.items()]
+            )
+            self.touched.clear()
+        self.last_flush = time.monotonic()
+
+    def _evict(self, now: float):
+        """清除过期条目，并按LRU淘汰超出条目数或总大小上限的条目"""
+        self.conn.execute("DELETE FROM file_ids WHERE created_at < ?", (now - self.ttl,))
+        count = self.conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self.conn.execute(
+                """
+                DELETE FROM file_ids WHERE url_key IN (
+                    SELECT url_key FROM file_ids ORDER BY last_access ASC LIMIT ?
+                )
+                """,
+                (overflow,)
+            )
+            logger.info(f"file_id 缓存已淘汰 {overflow} 个条目")
+        if self.max_bytes > 0:
+            # 从最近访问的条目开始累计大小，淘汰累计值超出上限的条目
+            deleted = self.conn.execute(
+                """
+                DELETE FROM file_ids WHERE url_key IN (
+                    SELECT url_key FROM (
+                        SELECT url_key, SUM(file_size) OVER (ORDER BY last_access DESC, url_key) AS total
+                        FROM file_ids
+                    ) WHERE total > ?
+                )
+                """,
+                (self.max_bytes,)
+            ).rowcount
+            if deleted > 0:
+                logger.info(f"file_id 缓存超出大小上限，已淘汰 {deleted} 个条目")
+
+    def get_stats(self) -> dict:
+        """获取缓存统计信息"""
+        try:
+            with self.lock:
+                count, total_size = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM file_ids"
+                ).fetchone()
+            return {'entries': count, 'total_size': total_size}
+        except sqlite3.Error as e:
+            logger.error(f"获取 file_id 缓存统计失败: {e}")
+            return {}
+
+    def close(self):
+        """写入未保存的访问时间并关闭数据库连接"""
+        with self.lock:
+            try:
+                self._write_touched()
+                self.conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"写入 file_id 缓存访问时间失败: {e}")
+            self.conn.close()
@@ -0,0 +1,368 @@
+import time
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, Type
+
+from . import tracing
+from .adaptive_limiter import AdaptiveLimiter
+from .resource_monitor import ResourceMonitor
+
+logger = logging.getLogger(__name__)
+
+# 排队位置回调: 参数为从1开始的队列位置
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class QueueFullError(Exception):
+    """队列已满，任务被拒绝"""
+
+
+class _Job:
+    """排队中的任务，保存提交时的上下文，执行时沿用调用方的追踪信息"""
+    __slots__ = ('user_id', 'factory', 'future', 'on_position', 'position', 'context', 'submitted_at')
+
+    def __init__(self, user_id: int, factory: Callable[[], Awaitable[Any]],
+                 future: asyncio.Future, on_position: Optional[PositionCallback]):
+        self.user_id = user_id
+        self.factory = factory
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+        self.context = contextvars.copy_context()
+        self.submitted_at = time.monotonic()
+
+
+class _Stage:
+    """
+    阶段并发限制，记录当前活跃数量，名额按先来先得移交给等待者
+    设置 limiter 时上限由其根据每次持有名额的耗时和错误自动调整
+    """
+    def __init__(self, limit: int, limiter: Optional[AdaptiveLimiter] = None,
+                 drop_errors: Tuple[Type[BaseException], ...] = ()):
+        self.limit = limiter.limit if limiter is not None else limit
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.limiter = limiter
+        self.drop_errors = drop_errors
+        if limiter is not None:
+            limiter.on_change = self.set_limit
+
+    def set_limit(self, limit: int):
+        """修改上限，上调时立即唤醒等待者，下调时等待活跃任务结束后生效"""
+        self.limit = limit
+        self._wake()
+
+    def try_acquire(self) -> bool:
+        """非阻塞地获取名额"""
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return True
+        return False
+
+    async def acquire(self):
+        """获取名额，已满时排队等待"""
+        if self.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        start = time.monotonic()
+        try:
+            await future
+            # 等待名额的时间计入当前追踪阶段
+            tracing.add(stage_wait=round(time.monotonic() - start, 3))
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已移交但等待者被取消，归还名额
+                self.release()
+            else:
+                try:
+                    self.waiters.remove(future)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self):
+        """释放名额，未超过上限时移交给等待者"""
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.active < self.limit:
+            future = self.waiters.popleft()
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def slot(self) -> "_StageSlot":
+        return _StageSlot(self)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class _StageSlot:
+    """
+    一次持有阶段名额，退出时将耗时反馈给自适应上限
+    调用方可设置 cost 为处理的字节数，操作失败但没有抛出异常时以异常调用 record_error；
+    drop_errors 中的异常（超时、网络错误）计为过载信号，其他异常不计入样本
+    """
+    __slots__ = ('stage', 'cost', 'failed', 'skip', 'start', 'inflight')
+
+    def __init__(self, stage: _Stage):
+        self.stage = stage
+        self.cost: Optional[float] = None
+        self.failed = False
+        self.skip = False
+        self.start = 0.0
+        self.inflight = 0
+
+    def record_error(self, error: BaseException):
+        """记录被调用方处理掉的异常，与抛出的异常按同样的规则计入样本"""
+        if isinstance(error, self.stage.drop_errors):
+            self.failed = True
+        else:
+            self.skip = True
+
+    async def __aenter__(self):
+        await self.stage.acquire()
+        self.start = time.monotonic()
+        self.inflight = self.stage.active
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.stage.release()
+        limiter = self.stage.limiter
+        if limiter is None:
+            return
+        if self.skip or (exc_type is not None and not issubclass(exc_type, self.stage.drop_errors)):
+            return
+        limiter.sample(
+            time.monotonic() - self.start, self.inflight, self.cost,
+            dropped=self.failed or exc_type is not None
+        )
+
+
+class JobScheduler:
+    """
+    公平调度的任务队列
+    有界全局队列，按用户轮询出队，限制全局并发和每个用户的并发，
+    并为下载、转码、上传各阶段提供独立的并发限制；
+    adaptive_limits 中列出的阶段以 stage_limits 为初始值，在 [1, 给定上限] 之间自适应调整
+    """
+    def __init__(
+        self,
+        max_workers: int = 8,
+        max_queue_size: int = 100,
+        max_concurrent_per_user: int = 3,
+        max_queued_per_user: int = 10,
+        stage_limits: Optional[Dict[str, int]] = None,
+        adaptive_limits: Optional[Dict[str, int]] = None,
+        drop_errors: Tuple[Type[BaseException], ...] = (asyncio.TimeoutError, ConnectionError),
+        resource_monitor: Optional[ResourceMonitor] = None,
+        resource_check_interval: float = 1.0,
+        backpressure: Optional[Callable[[], bool]] = None
+    ):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.max_concurrent_per_user = max_concurrent_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.resource_monitor = resource_monitor
+        self.resource_check_interval = resource_check_interval
+        # 返回 True 时暂停派发新任务（如转码进程池饱和）
+        self.backpressure = backpressure
+
+        adaptive_limits = adaptive_limits or {}
+        self.stages = {
+            name: _Stage(
+                limit,
+                AdaptiveLimiter(name, limit, max_limit=adaptive_limits[name]) if name in adaptive_limits else None,
+                drop_errors
+            )
+            for name, limit in (stage_limits or {}).items()
+        }
+
+        # 每个用户一个队列，OrderedDict 的顺序即轮询顺序
+        self.user_queues: "OrderedDict[int, Deque[_Job]]" = OrderedDict()
+        self.queued = 0
+        self.running: Dict[int, int] = {}
+        self.running_total = 0
+        self.wakeup = asyncio.Event()
+        self.dispatcher_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """启动调度循环"""
+        if self.dispatcher_task is None or self.dispatcher_task.done():
+            self.dispatcher_task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self):
+        """停止调度循环"""
+        if self.dispatcher_task is not None:
+            self.dispatcher_task.cancel()
+            try:
+                await self.dispatcher_task
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher_task = None
+
+    def submit(self, user_id: int, factory: Callable[[], Awaitable[Any]],
+               on_position: Optional[PositionCallback] = None) -> asyncio.Future:
+        """提交任务，返回任务结果的 Future；队列已满时抛出 QueueFullError"""
+        if self.queued >= self.max_queue_size:
+            raise QueueFullError("当前排队任务过多，请稍后再试")
+
+        user_queue = self.user_queues.get(user_id)
+        queued_for_user = len(user_queue) if user_queue else 0
+        if queued_for_user >= self.max_queued_per_user:
+            raise QueueFullError(f"您当前已有{queued_for_user}个任务在排队")
+
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(user_id, factory, future, on_position)
+        future.add_done_callback(lambda f: self._on_cancel(job))
+
+        if user_queue is None:
+            user_queue = self.user_queues[user_id] = deque()
+        user_queue.append(job)
+        self.queued += 1
+
+        self._notify_positions()
+        self.wakeup.set()
+        return future
+
+    def stage(self, name: str) -> _StageSlot:
+        """
+        获取阶段名额，用法: async with scheduler.stage('download') as slot，
+        可设置 slot.cost 和 slot.failed 供自适应上限使用
+        """
+        return self.stages[name].slot()
+
+    def _on_cancel(self, job: _Job):
+        """等待者取消时将未开始的任务移出队列"""
+        if not job.future.cancelled():
+            return
+        user_queue = self.user_queues.get(job.user_id)
+        if user_queue and job in user_queue:
+            user_queue.remove(job)
+            self.queued -= 1
+            if not user_queue:
+                del self.user_queues[job.user_id]
+            self._notify_positions()
+
+    def _next_job(self) -> Optional[_Job]:
+        """按轮询顺序取出下一个未达到并发上限的用户的任务"""
+        for user_id in list(self.user_queues):
+            if self.running.get(user_id, 0) >= self.max_concurrent_per_user:
+                continue
+            user_queue = self.user_queues[user_id]
+            job = user_queue.popleft()
+            self.queued -= 1
+            if user_queue:
+                # 该用户排到轮询末尾，让其他用户先出队
+                self.user_queues.move_to_end(user_id)
+            else:
+                del self.user_queues[user_id]
+            return job
+        return None
+
+    def _resources_available(self) -> bool:
+        """资源紧张或下游饱和时暂停出队，而不是拒绝任务"""
+        if self.backpressure is not None and self.backpressure():
+            logger.info("下游处理能力饱和，暂停调度")
+            return False
+        if self.resource_monitor is None:
+            return True
+        can_proceed, message = self.resource_monitor.check_system_resources()
+        if not can_proceed:
+            logger.warning(f"资源紧张，暂停调度: {message}")
+        return can_proceed
+
+    async def _dispatch_loop(self):
+        """调度循环"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            dispatched = False
+            while self.queued and self.running_total < self.max_workers:
+                if not self._resources_available():
+                    await asyncio.sleep(self.resource_check_interval)
+                    continue
+                job = self._next_job()
+                if job is None:
+                    break
+                self._run(job)
+                dispatched = True
+
+            if dispatched:
+                self._notify_positions()
+
+    def _run(self, job: _Job):
+        """启动任务"""
+        self.running[job.user_id] = self.running.get(job.user_id, 0) + 1
+        self.running_total += 1
+
+        async def runner():
+            tracing.record('schedule_wait', job.submitted_at)
+            try:
+                result = await job.factory()
+                if not job.future.done():
+                    job.future.set_result(result)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                else:
+                    logger.error(f"任务执行失败: {e}")
+            finally:
+                self._finish(job.user_id)
+
+        asyncio.create_task(runner(), context=job.context)
+
+    def _finish(self, user_id: int):
+        """任务结束，释放并发名额"""
+        remaining = self.running.get(user_id, 1) - 1
+        if remaining > 0:
+            self.running[user_id] = remaining
+        else:
+            self.running.pop(user_id, None)
+        self.running_total -= 1
+        self.wakeup.set()
+
+    def _notify_positions(self):
+        """计算轮询顺序下每个排队任务的位置，并通知位置发生变化的任务"""
+        queues = [list(user_queue) for user_queue in self.user_queues.values()]
+        position = 0
+        depth = 0
+        while True:
+            round_jobs = [user_queue[depth] for user_queue in queues if depth < len(user_queue)]
+            if not round_jobs:
+                break
+            for job in round_jobs:
+                position += 1
+                if job.position != position and job.on_position:
+                    job.position = position
+                    asyncio.create_task(self._safe_position_callback(job, position))
+            depth += 1
+
+    async def _safe_position_callback(self, job: _Job, position: int):
+        """执行位置回调，忽略回调中的异常"""
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            logger.error(f"更新排队位置失败: {e}")
+
+    def get_stats(self) -> dict:
+        """获取调度统计信息"""
+        return {
+            'queued': self.queued,
+            'running': self.running_total,
+            'max_workers': self.max_workers,
+            'stages': {
+                name: {'active': stage.active, 'limit': stage.limit, 'adaptive': stage.limiter is not None}
+                for name, stage in self.stages.items()
+            }
+        }
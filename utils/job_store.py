@@ -0,0 +1,452 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .job_scheduler import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# 可领取的任务及其用户当前运行中的任务数：排队中或租约已过期，且同一链接没有其他运行中的任务。
+# 领取和排队位置共用这一条件，按 (user_running, id) 排序
+_CLAIMABLE = """
+    SELECT j.id, (
+        SELECT COUNT(*) FROM jobs r
+        WHERE r.user_id = j.user_id AND r.state = :running AND r.lease_expires >= :now
+    ) AS user_running
+    FROM jobs j
+    WHERE ((j.state = :queued AND j.available_at <= :now)
+           OR (j.state = :running AND j.lease_expires < :now))
+      AND NOT EXISTS (
+        SELECT 1 FROM jobs r
+        WHERE r.url_key = j.url_key AND r.id != j.id
+          AND r.state = :running AND r.lease_expires >= :now
+      )
+"""
+
+
+class Job:
+    """从任务库中领取的任务"""
+    __slots__ = ('id', 'url', 'url_key', 'user_id', 'payload', 'state', 'stage', 'attempts', 'result', 'error',
+                 'created_at', 'trace')
+
+    def __init__(self, row: sqlite3.Row):
+        self.id = row['id']
+        self.url = row['url']
+        self.url_key = row['url_key']
+        self.user_id = row['user_id']
+        self.payload = json.loads(row['payload'])
+        self.state = row['state']
+        self.stage = row['stage']
+        self.attempts = row['attempts']
+        self.result = row['result']
+        self.error = row['error']
+        self.created_at = row['created_at']
+        self.trace = json.loads(row['trace']) if row['trace'] else None
+
+    def __repr__(self) -> str:
+        return f"Job({self.id}, {self.state}, stage={self.stage}, attempts={self.attempts})"
+
+
+class JobStore:
+    """
+    持久化任务队列
+    使用 WAL 模式的 SQLite 保存任务状态、阶段和重试次数，多个进程通过租约领取任务，
+    进程崩溃后租约过期，任务由其他 worker 重新领取
+    所有数据库操作在单独的线程中串行执行，不阻塞事件循环
+    """
+    def __init__(
+        self,
+        db_path: str,
+        lease_seconds: float = 60.0,
+        max_attempts: int = 3,
+        max_queued: int = 100,
+        max_running_per_user: int = 3
+    ):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_queued = max_queued
+        self.max_running_per_user = max_running_per_user
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job-store')
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        # 显式管理事务，领取任务时使用 BEGIN IMMEDIATE 在进程间互斥
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10.0)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                url_key TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                stage TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                available_at REAL NOT NULL,
+                result TEXT,
+                error TEXT,
+                trace TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        # 旧版本的任务库没有 trace 列
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        if 'trace' not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN trace TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, available_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_url_key ON jobs (url_key, state)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, state)")
+
+    async def _run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _transaction(self, func: Callable, *args):
+        """在 BEGIN IMMEDIATE 事务中执行，出错时回滚"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(*args)
+            self.conn.execute("COMMIT")
+            return result
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    async def enqueue(self, url: str, url_key: str, user_id: int, payload: dict) -> int:
+        """添加任务并返回任务ID，排队任务数达到上限时抛出 QueueFullError"""
+        return await self._run(self._transaction, self._enqueue, url, url_key, user_id, json.dumps(payload))
+
+    def _enqueue(self, url: str, url_key: str, user_id: int, payload: str) -> int:
+        queued = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+        if queued >= self.max_queued:
+            raise QueueFullError(f"当前排队任务过多（{queued}个），请稍后再试")
+        now = time.time()
+        cursor = self.conn.execute(
+            """
+            INSERT INTO jobs (url, url_key, user_id, payload, state, available_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (url, url_key, user_id, payload, QUEUED, now, now, now)
+        )
+        return cursor.lastrowid
+
+    async def claim(self, owner: str) -> Optional[Job]:
+        """
+        领取一个任务并设置租约
+        可领取排队中的任务和租约已过期的运行中任务；同一链接同时只有一个任务运行，
+        运行中任务少的用户优先，每个用户的运行任务数不超过上限
+        """
+        return await self._run(self._transaction, self._claim, owner)
+
+    def _claim(self, owner: str) -> Optional[Job]:
+        now = time.time()
+        row = self.conn.execute(
+            f"SELECT id FROM ({_CLAIMABLE}) WHERE user_running < :per_user ORDER BY user_running, id LIMIT 1",
+            {'running': RUNNING, 'queued': QUEUED, 'now': now, 'per_user': self.max_running_per_user}
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            """
+            UPDATE jobs SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ?
+            WHERE id = ?
+            """,
+            (RUNNING, owner, now + self.lease_seconds, now, row['id'])
+        )
+        return Job(self.conn.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone())
+
+    async def positions(self, job_ids: List[int]) -> Dict[int, int]:
+        """
+        查询排队中任务的位置（从 1 开始），即按领取顺序排在其前面的可领取任务数加一
+        已开始运行、已结束或正在等待相同链接的运行中任务完成的任务不在结果中
+        """
+        return await self._run(self._positions, job_ids)
+
+    def _positions(self, job_ids: List[int]) -> Dict[int, int]:
+        now = time.time()
+        params = {'running': RUNNING, 'queued': QUEUED, 'now': now, 'per_user': self.max_running_per_user}
+        result = {}
+        for job_id in job_ids:
+            row = self.conn.execute(
+                f"""
+                SELECT j.id, (
+                    SELECT COUNT(*) FROM jobs r
+                    WHERE r.user_id = j.user_id AND r.state = :running AND r.lease_expires >= :now
+                ) AS user_running
+                FROM jobs j
+                WHERE j.id = :id AND j.state = :queued AND NOT EXISTS (
+                    SELECT 1 FROM jobs r
+                    WHERE r.url_key = j.url_key AND r.state = :running AND r.lease_expires >= :now
+                )
+                """,
+                {**params, 'id': job_id}
+            ).fetchone()
+            if row is None:
+                continue
+            ahead = self.conn.execute(
+                f"""
+                SELECT COUNT(*) FROM ({_CLAIMABLE})
+                WHERE user_running < :per_user AND id != :id
+                  AND (user_running < :user_running OR (user_running = :user_running AND id < :id))
+                """,
+                {**params, 'id': job_id, 'user_running': row['user_running']}
+            ).fetchone()[0]
+            result[job_id] = ahead + 1
+        return result
+
+    async def heartbeat(self, job_id: int, owner: str) -> bool:
+        """续租，租约已被其他 worker 接管时返回 False"""
+        return await self._run(self._update_owned, job_id, owner, "lease_expires = ?", (time.time() + self.lease_seconds,))
+
+    async def set_stage(self, job_id: int, owner: str, stage: str):
+        """记录任务当前所处的阶段"""
+        await self._run(self._update_owned, job_id, owner, "stage = ?", (stage,))
+
+    async def complete(self, job_id: int, owner: str, result: Optional[str] = None) -> bool:
+        """标记任务完成，保存结果（file_id）"""
+        return await self._run(
+            self._update_owned, job_id, owner,
+            "state = ?, result = ?, lease_owner = NULL, lease_expires = NULL", (DONE, result)
+        )
+
+    async def fail(self, job_id: int, owner: str, error: str, retry_delay: float = 0.0,
+                   retryable: bool = True) -> Optional[bool]:
+        """
+        记录任务失败，可重试且未达到最大尝试次数时延迟后重新排队
+        返回是否会重试，租约已被其他 worker 接管时返回 None
+        """
+        return await self._run(self._transaction, self._fail, job_id, owner, error, retry_delay, retryable)
+
+    def _fail(self, job_id: int, owner: str, error: str, retry_delay: float, retryable: bool) -> Optional[bool]:
+        row = self.conn.execute(
+            "SELECT attempts FROM jobs WHERE id = ? AND state = ? AND lease_owner = ?", (job_id, RUNNING, owner)
+        ).fetchone()
+        if row is None:
+            return None
+        retry = retryable and row['attempts'] < self.max_attempts
+        self.conn.execute(
+            """
+            UPDATE jobs SET state = ?, error = ?, available_at = ?, lease_owner = NULL, lease_expires = NULL,
+                updated_at = ?
+            WHERE id = ?
+            """,
+            (QUEUED if retry else FAILED, error, time.time() + retry_delay, time.time(), job_id)
+        )
+        return retry
+
+    async def fail_duplicates(self, url_key: str, error: str) -> List[Job]:
+        """相同链接的任务遇到永久性错误后，将排队中的相同链接任务一并标记失败并返回，由调用方通知各自的用户"""
+        return await self._run(self._transaction, self._fail_duplicates, url_key, error)
+
+    def _fail_duplicates(self, url_key: str, error: str) -> List[Job]:
+        rows = self.conn.execute(
+            "SELECT * FROM jobs WHERE url_key = ? AND state = ?", (url_key, QUEUED)
+        ).fetchall()
+        if rows:
+            self.conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE url_key = ? AND state = ?",
+                (FAILED, error, time.time(), url_key, QUEUED)
+            )
+        return [Job(row) for row in rows]
+
+    async def save_trace(self, job_id: int, trace: dict):
+        """保存最近一次执行的时间线，供其他进程查询"""
+        await self._run(
+            self.conn.execute, "UPDATE jobs SET trace = ? WHERE id = ?", (json.dumps(trace, default=str), job_id)
+        )
+
+    async def release(self, job_id: int, owner: str):
+        """worker 正常退出时归还任务，不计入尝试次数，重启后立即恢复"""
+        await self._run(
+            self._update_owned, job_id, owner,
+            "state = ?, attempts = MAX(attempts - 1, 0), lease_owner = NULL, lease_expires = NULL", (QUEUED,)
+        )
+
+    def _update_owned(self, job_id: int, owner: str, assignments: str, values: tuple) -> bool:
+        """只更新仍由 owner 持有租约的运行中任务"""
+        cursor = self.conn.execute(
+            f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND state = ? AND lease_owner = ?",
+            (*values, time.time(), job_id, RUNNING, owner)
+        )
+        return cursor.rowcount > 0
+
+    async def get(self, job_id: int) -> Optional[Job]:
+        """读取任务"""
+        return await self._run(self._get, job_id)
+
+    def _get(self, job_id: int) -> Optional[Job]:
+        row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(row) if row else None
+
+    async def wait(self, job_id: int, interval: float = 0.2) -> Optional[Job]:
+        """轮询等待任务结束"""
+        while True:
+            job = await self.get(job_id)
+            if job is None or job.state in (DONE, FAILED):
+                return job
+            await asyncio.sleep(interval)
+
+    async def is_active(self, url_key: str) -> bool:
+        """检查链接是否有排队或运行中的任务"""
+        return await self._run(self._is_active, url_key)
+
+    def _is_active(self, url_key: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM jobs WHERE url_key = ? AND state IN (?, ?) LIMIT 1", (url_key, QUEUED, RUNNING)
+        ).fetchone()
+        return row is not None
+
+    async def purge(self, max_age: float = 24 * 3600) -> int:
+        """删除结束超过 max_age 秒的任务"""
+        return await self._run(self._purge, max_age)
+
+    def _purge(self, max_age: float) -> int:
+        cursor = self.conn.execute(
+            "DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?", (DONE, FAILED, time.time() - max_age)
+        )
+        if cursor.rowcount:
+            logger.info(f"已清理 {cursor.rowcount} 个已结束的任务")
+        return cursor.rowcount
+
+    async def get_stats(self) -> Dict[str, int]:
+        """各状态的任务数"""
+        return await self._run(self._get_stats)
+
+    def _get_stats(self) -> Dict[str, int]:
+        stats = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for row in self.conn.execute("SELECT state, COUNT(*) AS count FROM jobs GROUP BY state"):
+            stats[row['state']] = row['count']
+        return stats
+
+    def close(self):
+        """关闭数据库连接"""
+        self.executor.shutdown(wait=True)
+        self.conn.close()
+
+
+JobHandler = Callable[[Job, str], Awaitable[None]]
+
+
+class JobWorker:
+    """
+    任务执行者
+    在容量范围内从任务库领取任务并交给 handler 执行，执行期间定期续租；
+    租约被接管时取消本地执行，停止时归还未完成的任务
+    handler 负责调用 complete 或 fail
+    """
+    def __init__(
+        self,
+        store: JobStore,
+        handler: JobHandler,
+        capacity: int = 8,
+        poll_interval: float = 1.0,
+        owner: Optional[str] = None
+    ):
+        self.store = store
+        self.handler = handler
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.running: Dict[int, asyncio.Task] = {}
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        """有新任务或空出名额时立即尝试领取"""
+        self.wakeup.set()
+
+    async def start(self):
+        """启动领取循环"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+            logger.info(f"任务 worker 已启动: {self.owner}，容量 {self.capacity}")
+
+    async def stop(self):
+        """停止领取，取消运行中的任务并归还"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        tasks = list(self.running.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                while len(self.running) < self.capacity:
+                    job = await self.store.claim(self.owner)
+                    if job is None:
+                        break
+                    if job.attempts > 1:
+                        logger.info(f"恢复任务 {job.id}（第{job.attempts}次尝试，上次阶段: {job.stage}）")
+                    task = asyncio.create_task(self._execute(job))
+                    self.running[job.id] = task
+                    task.add_done_callback(lambda t, job_id=job.id: self._finished(job_id))
+            except sqlite3.Error as e:
+                logger.error(f"领取任务失败: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _finished(self, job_id: int):
+        self.running.pop(job_id, None)
+        self.notify()
+
+    async def _execute(self, job: Job):
+        """执行任务并定期续租"""
+        work = asyncio.create_task(self.handler(job, self.owner))
+        heartbeat = asyncio.create_task(self._heartbeat(job, work))
+        try:
+            await work
+        except asyncio.CancelledError:
+            if not work.cancelled():
+                # worker 停止：取消执行并归还任务
+                work.cancel()
+                await asyncio.gather(work, return_exceptions=True)
+            await self.store.release(job.id, self.owner)
+            raise
+        except Exception as e:
+            logger.error(f"任务 {job.id} 执行出错: {e}")
+            await self.store.fail(job.id, self.owner, str(e))
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job: Job, work: asyncio.Task):
+        """每隔租约的三分之一续租一次，续租失败说明任务已被接管"""
+        interval = self.store.lease_seconds / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await self.store.heartbeat(job.id, self.owner):
+                    logger.warning(f"任务 {job.id} 的租约已被接管，停止执行")
+                    work.cancel()
+                    return
+            except sqlite3.Error as e:
+                logger.error(f"任务 {job.id} 续租失败: {e}")
@@ -0,0 +1,64 @@
+import math
+from typing import List, Optional, Sequence, Union
+
+from telegram import InputMediaPhoto, InputMediaVideo
+
+# Telegram 每个媒体组最多 10 个、最少 2 个媒体
+MEDIA_GROUP_LIMIT = 10
+
+
+class MediaItem:
+    """
+    批量任务中的单个媒体
+    key 用作 file_id 缓存和续传文件名的键，picker 中的媒体为 "<链接键>#<序号>"；
+    file_id 命中缓存时无需下载，stored 为下载处理后存储中的文件，error 记录失败原因
+    """
+    __slots__ = ('key', 'source_url', 'kind', 'download_url', 'file_id', 'stored', 'metadata', 'error')
+
+    def __init__(self, key: str, source_url: str, kind: str = 'video',
+                 download_url: Optional[str] = None, file_id: Optional[str] = None):
+        self.key = key
+        self.source_url = source_url
+        self.kind = kind
+        self.download_url = download_url
+        self.file_id = file_id
+        self.stored = None
+        self.metadata: dict = {}
+        self.error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.error is None and (self.file_id is not None or self.stored is not None)
+
+    def __repr__(self) -> str:
+        return f"MediaItem({self.kind}, {self.key})"
+
+
+def picker_kind(entry_type: Optional[str]) -> str:
+    """Cobalt picker 的媒体类型: photo 作为图片发送，video 和 gif 都作为视频发送"""
+    return 'photo' if entry_type == 'photo' else 'video'
+
+
+def split_media_groups(items: Sequence, limit: int = MEDIA_GROUP_LIMIT) -> List[list]:
+    """
+    按顺序均匀分组，每组不超过 limit 个
+    均匀分组保证多于一个媒体时每组至少两个，如 11 个分为 6 + 5 而不是 10 + 1
+    """
+    if not items:
+        return []
+    count = math.ceil(len(items) / limit)
+    size, extra = divmod(len(items), count)
+    groups = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        groups.append(list(items[start:end]))
+        start = end
+    return groups
+
+
+def build_input_media(item: MediaItem, media, caption: Optional[str] = None) -> Union[InputMediaPhoto, InputMediaVideo]:
+    """构造媒体组中的一项，media 为 file_id、本地文件引用或上传文件"""
+    if item.kind == 'photo':
+        return InputMediaPhoto(media=media, caption=caption)
+    return InputMediaVideo(media=media, caption=caption, **item.metadata)
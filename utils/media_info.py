@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+def moov_before_mdat(head: bytes) -> Optional[bool]:
+    """
+    遍历MP4顶层box，判断 moov 是否位于 mdat 之前
+    只有 moov 在前的MP4才能通过管道边下载边解码，无法判断时返回 None
+    """
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], 'big')
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                return None
+            size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+        if size < 8:
+            return None
+        offset += size
+    return None
+
+
+def mp4_faststart(path: str) -> Optional[bool]:
+    """读取文件的顶层box头，判断MP4是否为 faststart（moov 在 mdat 之前）"""
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            result = moov_before_mdat(header)
+            if result is not None:
+                return result
+            size = int.from_bytes(header[0:4], 'big')
+            if size == 1 and len(header) == 16:
+                size = int.from_bytes(header[8:16], 'big')
+            if size < 8:
+                return None
+            offset += size
+    return None
+
+
+def _parse_rate(rate: Optional[str]) -> float:
+    """解析 ffprobe 的帧率字符串，如 30000/1001"""
+    try:
+        numerator, _, denominator = (rate or '').partition('/')
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def _parse_rotation(stream: dict) -> int:
+    """读取视频旋转角度，兼容 side_data 和旧版的 rotate 标签"""
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(float(side_data['rotation'])) % 360
+    try:
+        return int(stream.get('tags', {}).get('rotate', 0)) % 360
+    except ValueError:
+        return 0
+
+
+class MediaInfo:
+    """一次 ffprobe 得到的媒体信息，码率单位为 kbps"""
+    __slots__ = (
+        'size', 'duration', 'format_name', 'bit_rate',
+        'video_codec', 'width', 'height', 'rotation', 'fps', 'video_bitrate',
+        'audio_codec', 'audio_bitrate', 'has_audio', 'faststart'
+    )
+
+    def __init__(self, data: dict, size: int = 0, faststart: Optional[bool] = None):
+        streams = data.get('streams', [])
+        video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+        fmt = data.get('format', {})
+
+        self.size = size or int(fmt.get('size') or 0)
+        self.duration = float(fmt.get('duration') or 0)
+        self.format_name = fmt.get('format_name', '')
+        self.bit_rate = int(fmt.get('bit_rate') or 0) // 1000
+        # MP4 的 moov 是否位于文件开头，未知时为 None
+        self.faststart = faststart
+
+        video = video or {}
+        self.video_codec = video.get('codec_name')
+        self.width = int(video.get('width') or 0)
+        self.height = int(video.get('height') or 0)
+        self.rotation = _parse_rotation(video)
+        self.fps = _parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate')) or 30.0
+        self.video_bitrate = int(video.get('bit_rate') or 0) // 1000
+
+        self.has_audio = audio is not None
+        self.audio_codec = audio.get('codec_name') if audio else None
+        self.audio_bitrate = int(audio.get('bit_rate') or 0) // 1000 if audio else 0
+
+    @property
+    def has_video(self) -> bool:
+        return self.video_codec is not None
+
+    @property
+    def is_mp4(self) -> bool:
+        return 'mp4' in self.format_name.split(',')
+
+    @property
+    def display_size(self) -> Tuple[int, int]:
+        """考虑旋转后的显示宽高"""
+        if self.rotation in (90, 270):
+            return self.height, self.width
+        return self.width, self.height
+
+    @property
+    def supports_streaming(self) -> bool:
+        """Telegram 客户端能否边下载边播放"""
+        return self.is_mp4 and self.video_codec == 'h264' and self.faststart is not False
+
+    def telegram_video_kwargs(self) -> dict:
+        """reply_video 所需的元数据，Telegram 无需再在服务端探测"""
+        width, height = self.display_size
+        kwargs = {'supports_streaming': self.supports_streaming}
+        if self.duration:
+            kwargs['duration'] = int(round(self.duration))
+        if width and height:
+            kwargs['width'] = width
+            kwargs['height'] = height
+        return kwargs
+
+    def __repr__(self) -> str:
+        return (f"MediaInfo({self.format_name}, {self.video_codec} {self.width}x{self.height}@{self.fps:.0f}, "
+                f"{self.audio_codec}, {self.duration:.1f}s, {self.bit_rate}k)")
+
+
+class MediaProber:
+    """
+    媒体信息探测
+    每个文件只调用一次 ffprobe，结果按 (路径, inode, 大小) 缓存，文件被替换或写入后自动失效；
+    不使用修改时间，存储管理器更新访问时间（utime）不会使缓存失效
+    """
+    def __init__(self, max_entries: int = 256, metrics: Optional[Metrics] = None):
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self.cache: "OrderedDict[str, Tuple[Tuple[int, int], MediaInfo]]" = OrderedDict()
+        self.pending: Dict[Tuple[str, Tuple[int, int]], asyncio.Future] = {}
+
+    @staticmethod
+    def _signature(path: str) -> Tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_size
+
+    async def probe(self, path: str) -> Optional[MediaInfo]:
+        """获取文件的媒体信息，无法解析时返回 None"""
+        path = os.path.abspath(path)
+        try:
+            signature = self._signature(path)
+        except OSError as e:
+            logger.error(f"读取文件信息失败: {e}")
+            return None
+
+        cached = self.cache.get(path)
+        if cached and cached[0] == signature:
+            self.cache.move_to_end(path)
+            return cached[1]
+
+        # 同一文件的并发探测共享一次 ffprobe
+        key = (path, signature)
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._probe(path, signature[1]))
+            self.pending[key] = future
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        info = await asyncio.shield(future)
+
+        if info is not None:
+            self.cache[path] = (signature, info)
+            self.cache.move_to_end(path)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return info
+
+    async def _probe(self, path: str, size: int) -> Optional[MediaInfo]:
+        """执行 ffprobe 并解析结果"""
+        start_time = time.perf_counter()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'ffprobe', '-v', 'error',
+                '-show_format', '-show_streams',
+                '-of', 'json',
+                path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await process.communicate()
+            if self.metrics is not None:
+                self.metrics.ffprobe_duration.observe(time.perf_counter() - start_time)
+            if process.returncode != 0:
+                logger.error(f"读取媒体信息失败: {stderr.decode(errors='ignore')}")
+                return None
+
+            faststart = None
+            if path.lower().endswith(('.mp4', '.m4v', '.mov')):
+                faststart = await asyncio.get_running_loop().run_in_executor(None, mp4_faststart, path)
+            return MediaInfo(json.loads(stdout.decode()), size, faststart)
+        except Exception as e:
+            logger.error(f"读取媒体信息出错: {e}")
+            return None
+
+    @staticmethod
+    async def probe_head(head: bytes) -> Optional[MediaInfo]:
+        """从文件头数据探测媒体信息，用于边下载边处理，不缓存"""
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error',
+            '-show_format', '-show_streams',
+            '-of', 'json', '-i', 'pipe:0',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            stdout, _ = await process.communicate(head)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffprobe 读取到足够的数据后可能提前关闭管道
+            stdout = await process.stdout.read()
+            await process.wait()
+
+        try:
+            return MediaInfo(json.loads(stdout.decode() or '{}'), faststart=moov_before_mdat(head))
+        except ValueError:
+            return None
+
+    def moved(self, old_path: str, new_path: str):
+        """
+        文件重命名后保留缓存的媒体信息
+        new_path 的内容必须与原文件相同（重命名或按内容寻址存储中的已有文件），按其当前状态重新记录签名
+        """
+        cached = self.cache.pop(os.path.abspath(old_path), None)
+        if cached:
+            new_path = os.path.abspath(new_path)
+            try:
+                self.cache[new_path] = (self._signature(new_path), cached[1])
+            except OSError:
+                pass
+
+    def invalidate(self, path: str):
+        """删除文件的缓存"""
+        self.cache.pop(os.path.abspath(path), None)
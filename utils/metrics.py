@@ -0,0 +1,191 @@
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# 各阶段耗时的分桶（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# 下载速度的分桶（字节/秒）
+THROUGHPUT_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.125, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+
+
+class Metrics:
+    """
+    Prometheus 指标
+    使用独立的注册表，通过本地 HTTP 端口提供 /metrics，/stats 命令读取同一注册表
+    """
+    def __init__(self, namespace: str = "videobot", lag_interval: float = 1.0):
+        self.registry = CollectorRegistry()
+        self.lag_interval = lag_interval
+        self.lag_task: Optional[asyncio.Task] = None
+        self.server = None
+
+        def histogram(name, doc, labels=(), buckets=LATENCY_BUCKETS):
+            return Histogram(name, doc, labels, namespace=namespace, buckets=buckets, registry=self.registry)
+
+        def gauge(name, doc, labels=()):
+            return Gauge(name, doc, labels, namespace=namespace, registry=self.registry)
+
+        def counter(name, doc, labels=()):
+            return Counter(name, doc, labels, namespace=namespace, registry=self.registry)
+
+        # 各阶段耗时
+        self.cobalt_latency = histogram('cobalt_latency_seconds', 'Cobalt API 解析耗时')
+        self.download_duration = histogram('download_duration_seconds', '下载耗时')
+        self.download_throughput = histogram(
+            'download_throughput_bytes_per_second', '下载速度', buckets=THROUGHPUT_BUCKETS
+        )
+        self.ffprobe_duration = histogram('ffprobe_duration_seconds', 'ffprobe 探测耗时')
+        self.transcode_duration = histogram('transcode_duration_seconds', '转码耗时', ['action'])
+        self.upload_duration = histogram('upload_duration_seconds', '上传耗时', ['mode'])
+        self.job_duration = histogram('job_duration_seconds', '请求端到端耗时', ['result'])
+
+        # 计数
+        self.jobs = counter('jobs', '处理完成的请求数', ['result'])
+        self.download_bytes = counter('download_bytes', '下载字节数')
+        self.cache_hits = counter('file_id_cache_hits', 'file_id 缓存命中次数')
+        self.coalesced = counter('coalesced_requests', '合并到进行中任务的请求数')
+        self.cobalt_errors = counter('cobalt_errors', 'Cobalt 解析失败次数', ['type'])
+
+        # 状态
+        self.queue_depth = gauge('queue_depth', '排队中的任务数')
+        self.running_jobs = gauge('running_jobs', '运行中的任务数')
+        self.stage_active = gauge('stage_active', '各阶段活跃任务数', ['stage'])
+        self.stage_limit = gauge('stage_limit', '各阶段当前并发上限', ['stage'])
+        self.transcode_running = gauge('transcode_running', '运行中的转码进程数')
+        self.transcode_waiting = gauge('transcode_waiting', '等待中的转码任务数')
+        self.disk_free = gauge('disk_free_bytes', '下载目录可用空间')
+        self.disk_usage = gauge('disk_usage_percent', '下载目录磁盘使用率')
+        self.event_loop_lag = gauge('event_loop_lag_seconds', '事件循环延迟')
+        self.storage_bytes = gauge('storage_bytes', '视频存储占用的字节数')
+        self.storage_files = gauge('storage_files', '视频存储中的文件数')
+        self.storage_evictions = gauge('storage_evictions', '视频存储累计淘汰的文件数')
+
+    @contextmanager
+    def time(self, histogram) -> Iterator[None]:
+        """记录代码块耗时，异常时同样记录"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    def watch(self, job_scheduler=None, transcode_pool=None, resource_monitor=None, storage_manager=None):
+        """状态类指标在抓取时直接读取各组件的当前值"""
+        if job_scheduler is not None:
+            self.queue_depth.set_function(lambda: job_scheduler.queued)
+            self.running_jobs.set_function(lambda: job_scheduler.running_total)
+            for name, stage in job_scheduler.stages.items():
+                self.stage_active.labels(name).set_function(lambda stage=stage: stage.active)
+                self.stage_limit.labels(name).set_function(lambda stage=stage: stage.limit)
+        if transcode_pool is not None:
+            self.transcode_running.set_function(lambda: transcode_pool.running)
+            self.stage_limit.labels('transcode').set_function(lambda: transcode_pool.max_processes)
+            self.transcode_waiting.set_function(lambda: transcode_pool.waiting)
+        if resource_monitor is not None:
+            snapshot = lambda: resource_monitor.snapshot or {}
+            self.disk_free.set_function(lambda: snapshot().get('disk_free', 0) * 1024 * 1024)
+            self.disk_usage.set_function(lambda: snapshot().get('disk_percent', 0))
+        if storage_manager is not None:
+            self.storage_bytes.set_function(lambda: storage_manager.total_bytes)
+            self.storage_files.set_function(lambda: len(storage_manager.index))
+            self.storage_evictions.set_function(lambda: storage_manager.evictions)
+
+    async def start(self, port: int = 0, addr: str = "127.0.0.1"):
+        """启动事件循环延迟采样，port 大于0时启动 /metrics 服务"""
+        if self.lag_task is None or self.lag_task.done():
+            self.lag_task = asyncio.create_task(self._lag_loop())
+        if port and self.server is None:
+            self.server = start_http_server(port, addr=addr, registry=self.registry)
+            logger.info(f"指标服务已启动: http://{addr}:{port}/metrics")
+
+    async def stop(self):
+        """停止采样和 /metrics 服务"""
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+            try:
+                await self.lag_task
+            except asyncio.CancelledError:
+                pass
+            self.lag_task = None
+        if self.server is not None:
+            server, _ = self.server
+            server.shutdown()
+            self.server = None
+
+    async def _lag_loop(self):
+        """定时休眠，实际唤醒时间超出的部分即事件循环延迟"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.event_loop_lag.set(max(0.0, loop.time() - start - self.lag_interval))
+
+    def _histogram_buckets(self, histogram) -> Dict[float, float]:
+        """汇总所有标签值的累计分桶计数"""
+        buckets: Dict[float, float] = {}
+        for metric in histogram.collect():
+            for sample in metric.samples:
+                if sample.name.endswith('_bucket'):
+                    le = float(sample.labels['le'])
+                    buckets[le] = buckets.get(le, 0) + sample.value
+        return dict(sorted(buckets.items()))
+
+    def quantile(self, histogram, q: float) -> Optional[float]:
+        """根据分桶线性插值估算分位数，无数据时返回 None"""
+        buckets = self._histogram_buckets(histogram)
+        total = buckets.get(float('inf'), 0)
+        if not total:
+            return None
+        rank = q * total
+        lower_bound, lower_count = 0.0, 0.0
+        for bound, count in buckets.items():
+            if count >= rank:
+                if bound == float('inf'):
+                    return lower_bound
+                if count == lower_count:
+                    return bound
+                return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+            lower_bound, lower_count = bound, count
+        return lower_bound
+
+    def counter_value(self, counter, **labels) -> float:
+        """读取计数器的当前值，未指定标签时汇总所有标签"""
+        value = 0.0
+        for metric in counter.collect():
+            for sample in metric.samples:
+                if sample.name.endswith('_total') and all(sample.labels.get(k) == v for k, v in labels.items()):
+                    value += sample.value
+        return value
+
+    def gauge_value(self, gauge) -> float:
+        """读取无标签状态指标的当前值"""
+        for metric in gauge.collect():
+            for sample in metric.samples:
+                return sample.value
+        return 0.0
+
+    def summary(self) -> Dict[str, dict]:
+        """各阶段耗时的次数和 P50/P95，供 /stats 使用"""
+        stages = {
+            'Cobalt解析': self.cobalt_latency,
+            '下载': self.download_duration,
+            'ffprobe': self.ffprobe_duration,
+            '转码': self.transcode_duration,
+            '上传': self.upload_duration,
+            '端到端': self.job_duration
+        }
+        result = {}
+        for name, histogram in stages.items():
+            buckets = self._histogram_buckets(histogram)
+            result[name] = {
+                'count': int(buckets.get(float('inf'), 0)),
+                'p50': self.quantile(histogram, 0.5),
+                'p95': self.quantile(histogram, 0.95)
+            }
+        return result
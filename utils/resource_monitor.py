@@ -1,31 +1,128 @@
-import psutil
+import os
+import time
+import asyncio
 import logging
-from typing import Tuple
+from typing import Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 class ResourceMonitor:
-    def __init__(self, memory_threshold: int = 75, min_memory_available: int = 500):
+    """
+    系统资源监控
+    后台定期采样并平滑，准入检查直接读取缓存的快照，不阻塞事件循环
+    """
+    def __init__(
+        self,
+        memory_threshold: int = 75,
+        min_memory_available: int = 500,
+        cpu_threshold: int = 90,
+        min_disk_free: int = 1024,
+        disk_path: str = ".",
+        sample_interval: float = 2.0,
+        smoothing: float = 0.3
+    ):
         self.memory_threshold = memory_threshold
         self.min_memory_available = min_memory_available
+        self.cpu_threshold = cpu_threshold
+        self.min_disk_free = min_disk_free
+        self.disk_path = disk_path
+        self.sample_interval = sample_interval
+        self.smoothing = smoothing
+
+        # 进程句柄在第一次采样时创建，psutil 在采样线程中导入，不计入启动耗时
+        self.process = None
+        self.snapshot: Optional[dict] = None
+        self.sampler_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """启动后台采样任务"""
+        if self.sampler_task is None or self.sampler_task.done():
+            self.sampler_task = asyncio.create_task(self._sample_loop())
+
+    async def stop(self):
+        """停止后台采样任务"""
+        if self.sampler_task is not None:
+            self.sampler_task.cancel()
+            try:
+                await self.sampler_task
+            except asyncio.CancelledError:
+                pass
+            self.sampler_task = None
+
+    async def _sample_loop(self):
+        """定期在线程池中采样"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self.snapshot = await loop.run_in_executor(None, self._sample)
+            except Exception as e:
+                logger.error(f"采样系统资源失败: {e}")
+            await asyncio.sleep(self.sample_interval)
+
+    def _smooth(self, key: str, value: float) -> float:
+        """指数加权平均，避免瞬时波动导致误判"""
+        if not self.snapshot or key not in self.snapshot:
+            return value
+        return self.smoothing * value + (1 - self.smoothing) * self.snapshot[key]
+
+    def _sample(self) -> dict:
+        """采集一次系统资源数据"""
+        import psutil
+        if self.process is None:
+            self.process = psutil.Process(os.getpid())
+            # 初始化CPU采样基准，之后的 cpu_percent(interval=None) 调用立即返回
+            psutil.cpu_percent(interval=None)
+
+        memory_info = psutil.virtual_memory()
+        disk_usage = psutil.disk_usage(self.disk_path)
+
+        # 本进程及子进程（如 ffmpeg）的常驻内存
+        process_rss = self.process.memory_info().rss
+        children_rss = 0
+        for child in self.process.children(recursive=True):
+            try:
+                children_rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+
+        return {
+            'cpu_percent': self._smooth('cpu_percent', psutil.cpu_percent(interval=None)),
+            'memory_percent': self._smooth('memory_percent', memory_info.percent),
+            'memory_available': memory_info.available / 1024 / 1024,
+            'load_avg': psutil.getloadavg(),
+            'disk_free': disk_usage.free / 1024 / 1024,
+            'disk_percent': disk_usage.percent,
+            'process_rss': process_rss / 1024 / 1024,
+            'children_rss': children_rss / 1024 / 1024,
+            'timestamp': time.time()
+        }
+
+    def _current(self) -> dict:
+        """返回最新快照，采样任务未启动时同步采样一次"""
+        if self.snapshot is None:
+            self.snapshot = self._sample()
+        return self.snapshot
 
     def check_system_resources(self) -> Tuple[bool, str]:
         """检查系统资源状态"""
         try:
-            memory_info = psutil.virtual_memory()
-            cpu_percent = psutil.cpu_percent(interval=1)
-            available_memory_mb = memory_info.available / 1024 / 1024
-            memory_usage = memory_info.percent
+            snapshot = self._current()
+            memory_usage = snapshot['memory_percent']
+            available_memory_mb = snapshot['memory_available']
+            cpu_percent = snapshot['cpu_percent']
 
             if memory_usage > self.memory_threshold:
                 return False, f"系统内存使用率过高: {memory_usage:.1f}%"
-            
+
             if available_memory_mb < self.min_memory_available:
                 return False, f"系统可用内存不足: {available_memory_mb:.1f}MB"
-            
-            if cpu_percent > 90:
+
+            if cpu_percent > self.cpu_threshold:
                 return False, f"CPU使用率过高: {cpu_percent:.1f}%"
-            
+
+            if snapshot['disk_free'] < self.min_disk_free:
+                return False, f"磁盘可用空间不足: {snapshot['disk_free']:.1f}MB"
+
             return True, ""
         except Exception as e:
             logger.error(f"检查系统资源失败: {e}")
@@ -34,13 +131,7 @@ class ResourceMonitor:
     def get_resource_usage(self) -> dict:
         """获取当前资源使用情况"""
         try:
-            memory_info = psutil.virtual_memory()
-            return {
-                'cpu_percent': psutil.cpu_percent(interval=1),
-                'memory_percent': memory_info.percent,
-                'memory_available': memory_info.available / 1024 / 1024,
-                'load_avg': psutil.getloadavg()
-            }
+            return dict(self._current())
         except Exception as e:
             logger.error(f"获取资源使用情况失败: {e}")
             return {}
@@ -0,0 +1,14 @@
+import ssl
+import functools
+
+import httpx
+
+
+@functools.lru_cache(maxsize=None)
+def shared_ssl_context(http2: bool = False) -> ssl.SSLContext:
+    """
+    进程内共用的 SSL 上下文
+    每个 httpx 客户端默认各自加载一次 CA 证书（约40ms），共用后整个进程只加载一次；
+    启用 HTTP/2 的客户端需要在 ALPN 中声明 h2，因此按是否启用 HTTP/2 分别缓存
+    """
+    return httpx.create_ssl_context(http2=http2)
@@ -0,0 +1,154 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+from .token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def format_transfer_progress(action: str, done: int, total: Optional[int], speed: float) -> str:
+    """格式化传输进度文本：百分比、速度和剩余时间"""
+    text = f"{action}... {done / 1024 / 1024:.1f}MB"
+    if total:
+        text += f" / {total / 1024 / 1024:.1f}MB ({done * 100 / total:.0f}%)"
+    text += f"\n速度: {speed / 1024 / 1024:.2f}MB/s"
+    if total and speed > 0 and done < total:
+        remaining = int((total - done) / speed)
+        text += f"，剩余: {remaining // 60}分{remaining % 60:02d}秒" if remaining >= 60 else f"，剩余: {remaining}秒"
+    return text
+
+
+class StatusMessage:
+    """
+    单条状态消息的更新器
+    多次更新只保留最新文本，两次编辑之间至少间隔 min_interval，文本未变化时不编辑
+    """
+    def __init__(self, updater: "StatusUpdater", message: Message):
+        self.updater = updater
+        self.message = message
+        self.chat_id = message.chat_id
+        self.current_text = message.text
+        self.pending_text: Optional[str] = None
+        self.last_edit = 0.0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def update(self, text: str):
+        """更新状态文本，不等待实际编辑完成"""
+        self.pending_text = text
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def finish(self, text: str):
+        """发送最终状态，忽略最小间隔，等待编辑完成"""
+        self.pending_text = None
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+        await self._edit(text)
+
+    def cancel(self):
+        """丢弃尚未发送的更新，消息交由其他进程更新时调用"""
+        self.pending_text = None
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+
+    async def _flush_loop(self):
+        """按最小间隔发送最新的待更新文本"""
+        while self.pending_text is not None:
+            wait = self.last_edit + self.updater.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            text, self.pending_text = self.pending_text, None
+            if text is not None:
+                await self._edit(text)
+
+    async def _edit(self, text: str):
+        """通过限速器编辑消息，遇到 RetryAfter 时等待后重试"""
+        for _ in range(self.updater.max_retries):
+            await self.updater.acquire(self.chat_id)
+            # 等待令牌期间有新的更新时直接发送最新文本
+            if self.pending_text is not None:
+                text, self.pending_text = self.pending_text, None
+            if text == self.current_text:
+                return
+            try:
+                await self.message.edit_text(text)
+                self.current_text = text
+                self.last_edit = time.monotonic()
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.warning(f"编辑状态消息触发限流，{retry_after}秒后重试")
+                self.updater.penalize(self.chat_id, retry_after)
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    self.current_text = text
+                else:
+                    logger.error(f"更新状态消息失败: {e}")
+                return
+            except Exception as e:
+                logger.error(f"更新状态消息失败: {e}")
+                return
+
+
+class StatusUpdater:
+    """
+    状态消息更新服务
+    所有编辑先后经过所在聊天和整个机器人的令牌桶，收到 RetryAfter 时暂停该聊天的令牌桶
+    """
+    def __init__(
+        self,
+        min_interval: float = 3.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        global_rate: float = 25.0,
+        global_burst: float = 30.0,
+        max_chats: int = 10000,
+        max_retries: int = 3
+    ):
+        self.min_interval = min_interval
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def track(self, message: Message) -> StatusMessage:
+        """为状态消息创建更新器"""
+        return StatusMessage(self, message)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id: int):
+        """先获取聊天令牌，再获取全局令牌"""
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def penalize(self, chat_id: int, seconds: float):
+        """收到 RetryAfter 后暂停该聊天的编辑"""
+        self._chat_bucket(chat_id).penalize(seconds)
+
+    def get_stats(self) -> dict:
+        """获取限速器统计信息"""
+        return {
+            'chats': len(self.chat_buckets),
+            'global_tokens': self.global_bucket.tokens
+        }
@@ -0,0 +1,266 @@
+import os
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DiskSpaceError(Exception):
+    """可用磁盘空间不足，淘汰后仍无法容纳新文件"""
+
+
+class _Entry:
+    """存储中的文件：大小、最后访问时间、访问次数和引用计数"""
+    __slots__ = ('path', 'size', 'last_access', 'hits', 'refs')
+
+    def __init__(self, path: str, size: int, last_access: float, hits: int = 1):
+        self.path = path
+        self.size = size
+        self.last_access = last_access
+        self.hits = hits
+        self.refs = 0
+
+
+class StoredFile:
+    """存储中的文件句柄，持有引用期间不会被淘汰"""
+    __slots__ = ('digest', 'path', 'size')
+
+    def __init__(self, digest: str, path: str, size: int):
+        self.digest = digest
+        self.path = path
+        self.size = size
+
+    def __repr__(self) -> str:
+        return f"StoredFile({self.digest[:12]}, {self.size / 1024 / 1024:.1f}MB)"
+
+
+class StorageManager:
+    """
+    按内容寻址的文件存储
+    文件以 SHA-256 命名，存放在 root/ab/cd/<摘要><扩展名> 的分片目录中，内容相同的文件只保存一份；
+    内存索引记录大小和访问情况，总大小超过配额时按 LRU 或 LFU 淘汰未被引用的文件，
+    下载前按可用空间做准入检查，必要时先淘汰旧文件腾出空间
+    引用计数只在本进程内有效，最近 grace 秒内访问过的文件同样不会被淘汰，以保护其他进程正在使用的文件
+    """
+    def __init__(
+        self,
+        root: str,
+        quota_bytes: int = 10 * 1024 ** 3,
+        min_free_bytes: int = 1024 ** 3,
+        policy: str = 'lru',
+        grace: float = 600.0,
+        rescan_interval: float = 300.0,
+        hash_chunk_size: int = 1024 * 1024
+    ):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"不支持的淘汰策略: {policy}")
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.policy = policy
+        self.grace = grace
+        self.rescan_interval = rescan_interval
+        self.hash_chunk_size = hash_chunk_size
+
+        self.index: Dict[str, _Entry] = {}
+        self.total_bytes = 0
+        self.evictions = 0
+        self.lock = asyncio.Lock()
+        self.rescan_task: Optional[asyncio.Task] = None
+        os.makedirs(root, exist_ok=True)
+
+    async def start(self):
+        """扫描已有文件建立索引，并定期重新扫描以同步其他进程写入和删除的文件"""
+        await self.rescan()
+        if self.rescan_task is None or self.rescan_task.done():
+            self.rescan_task = asyncio.create_task(self._rescan_loop())
+
+    async def stop(self):
+        """停止定期扫描"""
+        if self.rescan_task is not None:
+            self.rescan_task.cancel()
+            try:
+                await self.rescan_task
+            except asyncio.CancelledError:
+                pass
+            self.rescan_task = None
+
+    async def _rescan_loop(self):
+        while True:
+            await asyncio.sleep(self.rescan_interval)
+            try:
+                await self.rescan()
+                await self.enforce_quota()
+            except Exception as e:
+                logger.error(f"扫描文件存储失败: {e}")
+
+    async def rescan(self):
+        """在线程池中遍历存储目录，保留已有条目的访问统计"""
+        found = await asyncio.get_running_loop().run_in_executor(None, self._scan)
+        async with self.lock:
+            index = {}
+            for digest, (path, size, mtime) in found.items():
+                entry = self.index.get(digest)
+                if entry is None:
+                    entry = _Entry(path, size, mtime)
+                else:
+                    entry.last_access = max(entry.last_access, mtime)
+                index[digest] = entry
+            # 本进程仍在引用但已被删除的文件不再计入
+            self.index = index
+            self.total_bytes = sum(entry.size for entry in index.values())
+
+    def _scan(self) -> Dict[str, tuple]:
+        found = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[filename.split('.', 1)[0]] = (path, stat.st_size, stat.st_mtime)
+        return found
+
+    def _path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + ext)
+
+    def _hash(self, path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self.hash_chunk_size)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    async def put(self, path: str) -> StoredFile:
+        """
+        将文件移入存储并持有一个引用，调用方使用完毕后需调用 release
+        已存在相同内容时删除传入的文件，直接复用已有文件
+        """
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self._hash, path)
+        ext = os.path.splitext(path)[1]
+        async with self.lock:
+            entry = self.index.get(digest)
+            if entry is not None and os.path.exists(entry.path):
+                await loop.run_in_executor(None, os.remove, path)
+                logger.info(f"内容已存在，复用文件: {digest[:12]}")
+            else:
+                target = self._path(digest, ext)
+                await loop.run_in_executor(None, self._move, path, target)
+                size = os.path.getsize(target)
+                if entry is not None:
+                    self.total_bytes -= entry.size
+                entry = self.index[digest] = _Entry(target, size, time.time(), hits=0)
+                self.total_bytes += size
+            self._touch(entry)
+            entry.refs += 1
+        await self.enforce_quota()
+        return StoredFile(digest, entry.path, entry.size)
+
+    @staticmethod
+    def _move(source: str, target: str):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+
+    async def acquire(self, digest: str) -> Optional[StoredFile]:
+        """按摘要查找文件并持有一个引用，不存在时返回 None"""
+        async with self.lock:
+            entry = self.index.get(digest)
+            if entry is None or not os.path.exists(entry.path):
+                return None
+            self._touch(entry)
+            entry.refs += 1
+            return StoredFile(digest, entry.path, entry.size)
+
+    def release(self, stored: StoredFile):
+        """释放引用"""
+        entry = self.index.get(stored.digest)
+        if entry is not None and entry.refs > 0:
+            entry.refs -= 1
+
+    def _touch(self, entry: _Entry):
+        """更新访问统计，同时更新文件修改时间，重启和其他进程扫描时保留 LRU 顺序"""
+        entry.last_access = time.time()
+        entry.hits += 1
+        try:
+            os.utime(entry.path)
+        except OSError:
+            pass
+
+    def _eviction_order(self):
+        """未被引用且不在保护期内的条目，按淘汰优先级排序"""
+        now = time.time()
+        candidates = [
+            (digest, entry) for digest, entry in self.index.items()
+            if entry.refs == 0 and now - entry.last_access >= self.grace
+        ]
+        if self.policy == 'lfu':
+            candidates.sort(key=lambda item: (item[1].hits, item[1].last_access))
+        else:
+            candidates.sort(key=lambda item: item[1].last_access)
+        return candidates
+
+    async def _evict(self, need_bytes: int, reason: str) -> int:
+        """淘汰文件直到释放 need_bytes 字节，返回实际释放的字节数"""
+        freed = 0
+        loop = asyncio.get_running_loop()
+        for digest, entry in self._eviction_order():
+            if freed >= need_bytes:
+                break
+            try:
+                await loop.run_in_executor(None, os.remove, entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"淘汰文件失败 {entry.path}: {e}")
+                continue
+            del self.index[digest]
+            self.total_bytes -= entry.size
+            self.evictions += 1
+            freed += entry.size
+        if freed:
+            logger.info(f"{reason}，已淘汰 {freed / 1024 / 1024:.1f}MB")
+        return freed
+
+    async def enforce_quota(self):
+        """总大小超过配额时淘汰文件"""
+        async with self.lock:
+            overflow = self.total_bytes - self.quota_bytes
+            if overflow > 0:
+                await self._evict(overflow, "文件存储超出配额")
+
+    async def admit(self, size: int) -> bool:
+        """
+        准入检查：写入 size 字节后可用空间仍不低于 min_free_bytes 时允许写入
+        空间不足时先淘汰旧文件，仍不足则拒绝
+        """
+        async with self.lock:
+            shortfall = self.min_free_bytes + size - shutil.disk_usage(self.root).free
+            if shortfall <= 0:
+                return True
+            # 全部淘汰也不够时直接拒绝，保留缓存的文件
+            if sum(entry.size for _, entry in self._eviction_order()) < shortfall:
+                return False
+            freed = await self._evict(shortfall, "磁盘可用空间不足")
+            return freed >= shortfall
+
+    def get_stats(self) -> dict:
+        """获取存储统计信息"""
+        return {
+            'files': len(self.index),
+            'total_bytes': self.total_bytes,
+            'quota_bytes': self.quota_bytes,
+            'referenced': sum(1 for entry in self.index.values() if entry.refs),
+            'evictions': self.evictions,
+            'policy': self.policy
+        }
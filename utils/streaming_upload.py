@@ -0,0 +1,191 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import mimetypes
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+from telegram import InputFile
+from telegram.error import NetworkError, TimedOut
+from telegram.request import HTTPXRequest, RequestData
+from telegram._utils.defaultvalue import DEFAULT_NONE, DefaultValue
+
+from .download_manager import ProgressCallback, Throttle, _Progress
+from .ssl_context import shared_ssl_context
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingInputFile(InputFile):
+    """
+    按路径引用的上传文件
+    不在构造时读取文件内容，由 StreamingHTTPXRequest 在发送时分块读取，
+    每次上传占用的内存与文件大小无关；重试时重新从文件读取。
+    throttle 在发送每个数据块前调用，用于出站带宽限速
+    """
+    __slots__ = ('path', 'file_size', 'chunk_size', 'progress_callback', 'progress_interval', 'throttle')
+
+    def __init__(
+        self,
+        path: str,
+        filename: Optional[str] = None,
+        attach: bool = False,
+        chunk_size: int = 512 * 1024,
+        progress_callback: Optional[ProgressCallback] = None,
+        progress_interval: float = 5.0,
+        throttle: Optional[Throttle] = None
+    ):
+        self.path = path
+        self.file_size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.throttle = throttle
+
+        filename = filename or os.path.basename(path)
+        self.input_file_content = b''
+        self.attach_name = "attached" + uuid.uuid4().hex if attach else None
+        self.mimetype = mimetypes.guess_type(filename, strict=False)[0] or 'application/octet-stream'
+        self.filename = filename
+
+    @property
+    def field_tuple(self):
+        """内容位置放入文件对象本身，由请求层识别后流式发送"""
+        return self.filename, self, self.mimetype
+
+
+def _quote(value: str) -> str:
+    """转义 multipart 头部中的参数值"""
+    return value.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+class _MultipartBody:
+    """流式生成 multipart/form-data 请求体，预先计算总长度"""
+    def __init__(self, fields: Dict[str, str], files: Dict[str, tuple]):
+        self.boundary = uuid.uuid4().hex
+        # 每一部分为 (头部字节, 内容)，内容为 bytes 或 StreamingInputFile
+        self.parts: List[Tuple[bytes, object]] = []
+        for name, value in fields.items():
+            header = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"\r\n\r\n'
+            self.parts.append((header.encode(), str(value).encode()))
+        for name, (filename, content, mimetype) in files.items():
+            header = (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{_quote(name)}"; filename="{_quote(filename)}"\r\n'
+                f'Content-Type: {mimetype}\r\n\r\n'
+            )
+            self.parts.append((header.encode(), content))
+        self.closing = f'--{self.boundary}--\r\n'.encode()
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    @property
+    def content_length(self) -> int:
+        length = len(self.closing)
+        for header, content in self.parts:
+            size = content.file_size if isinstance(content, StreamingInputFile) else len(content)
+            length += len(header) + size + 2
+        return length
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """逐块产生请求体，文件内容在线程池中读取"""
+        for header, content in self.parts:
+            yield header
+            if isinstance(content, StreamingInputFile):
+                async for chunk in self._read_file(content):
+                    yield chunk
+            else:
+                yield content
+            yield b'\r\n'
+        yield self.closing
+
+    @staticmethod
+    async def _read_file(input_file: StreamingInputFile) -> AsyncIterator[bytes]:
+        """分块读取文件并汇报上传进度"""
+        loop = asyncio.get_running_loop()
+        progress = _Progress(input_file.progress_callback, input_file.progress_interval, input_file.throttle)
+        progress.reset(input_file.file_size)
+        start_time = time.time()
+        with open(input_file.path, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, input_file.chunk_size)
+                if not chunk:
+                    break
+                # 先获取带宽再发送
+                await progress.add(len(chunk))
+                yield chunk
+        if progress.downloaded != input_file.file_size:
+            raise IOError(f"上传过程中文件大小发生变化: {input_file.path}")
+        await progress.finish(time.time() - start_time)
+
+
+class StreamingHTTPXRequest(HTTPXRequest):
+    """
+    支持流式上传的 HTTPXRequest
+    请求中包含 StreamingInputFile 时自行生成 multipart 请求体并分块发送，
+    其他请求交给 HTTPXRequest 处理
+    """
+    def _build_client(self) -> httpx.AsyncClient:
+        # 与其他 httpx 客户端共用 SSL 上下文，避免重复加载 CA 证书
+        return httpx.AsyncClient(verify=shared_ssl_context(self._client_kwargs.get('http2', False)),
+                                 **self._client_kwargs)
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=DEFAULT_NONE,
+        write_timeout=DEFAULT_NONE,
+        connect_timeout=DEFAULT_NONE,
+        pool_timeout=DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        files = request_data.multipart_data if request_data else None
+        if not files or not any(isinstance(content, StreamingInputFile) for _, content, _ in files.values()):
+            return await super().do_request(
+                url, method, request_data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout
+            )
+
+        if self._client.is_closed:
+            raise RuntimeError("This HTTPXRequest is not initialized!")
+
+        client_timeout = self._client.timeout
+        timeout = httpx.Timeout(
+            connect=client_timeout.connect if isinstance(connect_timeout, DefaultValue) else connect_timeout,
+            read=client_timeout.read if isinstance(read_timeout, DefaultValue) else read_timeout,
+            # 写超时作用于单个数据块，与文件大小无关
+            write=client_timeout.write if isinstance(write_timeout, DefaultValue) else write_timeout,
+            pool=client_timeout.pool if isinstance(pool_timeout, DefaultValue) else pool_timeout,
+        )
+
+        body = _MultipartBody(request_data.json_parameters, files)
+        try:
+            res = await self._client.request(
+                method=method,
+                url=url,
+                headers={
+                    "User-Agent": self.USER_AGENT,
+                    "Content-Type": body.content_type,
+                    "Content-Length": str(body.content_length),
+                },
+                timeout=timeout,
+                content=body.stream(),
+            )
+        except httpx.TimeoutException as err:
+            if isinstance(err, httpx.PoolTimeout):
+                raise TimedOut(message="Pool timeout: 连接池已满，请求未发送") from err
+            raise TimedOut from err
+        except httpx.HTTPError as err:
+            raise NetworkError(f"httpx.{err.__class__.__name__}: {err}") from err
+        except OSError as err:
+            raise NetworkError(f"读取上传文件失败: {err}") from err
+
+        return res.status_code, res.content
@@ -0,0 +1,55 @@
+import time
+import asyncio
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    令牌桶限速
+    以固定速率补充令牌，允许不超过容量的突发；令牌不足时等待而不是拒绝
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # 在此时间之前暂停发放令牌（如收到 RetryAfter）
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """非阻塞地获取令牌"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens: float = 1) -> float:
+        """获取指定数量的令牌还需等待的时间（秒）"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, (tokens - self.tokens) / self.rate) if self.rate > 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    async def acquire(self, tokens: float = 1):
+        """获取令牌，不足时按先来先得等待；超过容量的请求允许令牌透支"""
+        async with self.lock:
+            tokens_needed = min(tokens, self.capacity)
+            while True:
+                wait = self.delay(tokens_needed)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.tokens -= tokens
+
+    def penalize(self, seconds: float):
+        """在指定时间内暂停发放令牌"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
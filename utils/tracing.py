@@ -0,0 +1,257 @@
+import json
+import time
+import random
+import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 当前任务的追踪和当前阶段，随 asyncio 任务的上下文传递到子任务
+current_trace: ContextVar[Optional["Trace"]] = ContextVar('current_trace', default=None)
+current_span: ContextVar[Optional["Span"]] = ContextVar('current_span', default=None)
+
+
+class Span:
+    """一个计时阶段，attrs 记录字节数、文件大小、重试次数等"""
+    __slots__ = ('name', 'start', 'end', 'attrs', 'error')
+
+    def __init__(self, name: str, start: Optional[float] = None, **attrs):
+        self.name = name
+        self.start = time.monotonic() if start is None else start
+        self.end: Optional[float] = None
+        self.attrs: Dict[str, Any] = attrs
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **counters):
+        """累加计数，如多次重试的字节数"""
+        for key, value in counters.items():
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def to_dict(self, origin: float) -> dict:
+        result = {
+            'name': self.name,
+            'offset': round(self.start - origin, 3),
+            'duration': round(self.duration, 3),
+        }
+        if self.attrs:
+            result['attrs'] = self.attrs
+        if self.error:
+            result['error'] = self.error
+        return result
+
+
+class Trace:
+    """一次任务执行的时间线"""
+    __slots__ = ('job_id', 'attrs', 'started_at', 'start', 'end', 'spans', 'error', 'token')
+
+    def __init__(self, job_id: Any, **attrs):
+        self.job_id = job_id
+        self.attrs: Dict[str, Any] = attrs
+        self.started_at = time.time()
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+        self.spans: List[Span] = []
+        self.error: Optional[str] = None
+        self.token = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'started_at': round(self.started_at, 3),
+            'duration': round(self.duration, 3),
+            'error': self.error,
+            'attrs': self.attrs,
+            'spans': [span.to_dict(self.start) for span in sorted(self.spans, key=lambda span: span.start)],
+        }
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Span]:
+    """
+    记录一个阶段，用法: with tracing.span('download') as span: ...
+    没有当前追踪时仍返回 Span 供调用方设置属性，但不记录
+    """
+    trace = current_trace.get()
+    item = Span(name, **attrs)
+    token = current_span.set(item)
+    try:
+        yield item
+    except BaseException as e:
+        item.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        item.end = time.monotonic()
+        current_span.reset(token)
+        if trace is not None:
+            trace.spans.append(item)
+
+
+def record(name: str, start: float, **attrs):
+    """记录已经结束的阶段，start 为 time.monotonic() 时间，如排队等待"""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    item = Span(name, start, **attrs)
+    item.end = time.monotonic()
+    trace.spans.append(item)
+
+
+def annotate(**attrs):
+    """设置当前阶段的属性，不在追踪中时忽略"""
+    item = current_span.get()
+    if item is not None:
+        item.set(**attrs)
+
+
+def add(**counters):
+    """累加当前阶段的计数"""
+    item = current_span.get()
+    if item is not None:
+        item.add(**counters)
+
+
+def current_job_id() -> Any:
+    trace = current_trace.get()
+    return trace.job_id if trace is not None else None
+
+
+class Tracer:
+    """
+    任务追踪
+    每个任务一条时间线，结束后保留在内存中供查询，并以 JSON 行输出到 trace 日志；
+    普通任务按 sample_rate 抽样输出，失败的任务和慢任务总是输出。
+    耗时超过 slow_seconds 或最近 window 个任务的 outlier_quantile 分位数时视为慢任务
+    """
+    def __init__(
+        self,
+        sample_rate: float = 0.05,
+        slow_seconds: float = 60.0,
+        outlier_quantile: float = 0.95,
+        window: int = 200,
+        max_traces: int = 500,
+        min_samples: int = 20
+    ):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.outlier_quantile = outlier_quantile
+        self.min_samples = min_samples
+        self.durations: Deque[float] = deque(maxlen=window)
+        self.traces: "OrderedDict[Any, dict]" = OrderedDict()
+        self.max_traces = max_traces
+        self.outliers: Deque[Any] = deque(maxlen=20)
+        self.output = logging.getLogger('trace')
+
+    def start(self, job_id: Any, **attrs) -> Trace:
+        """开始追踪并设为当前上下文的追踪"""
+        trace = Trace(job_id, **attrs)
+        trace.token = current_trace.set(trace)
+        return trace
+
+    def threshold(self) -> float:
+        """慢任务阈值：固定阈值和最近任务耗时分位数中较小的一个，样本不足时使用固定阈值"""
+        if len(self.durations) < self.min_samples:
+            return self.slow_seconds
+        ordered = sorted(self.durations)
+        quantile = ordered[min(len(ordered) - 1, int(self.outlier_quantile * len(ordered)))]
+        return min(self.slow_seconds, quantile)
+
+    def finish(self, trace: Trace, error: Optional[BaseException] = None) -> dict:
+        """结束追踪，按抽样规则输出，返回时间线"""
+        trace.end = time.monotonic()
+        if error is not None:
+            trace.error = f"{type(error).__name__}: {error}"
+        if trace.token is not None:
+            try:
+                current_trace.reset(trace.token)
+            except ValueError:
+                # 在其他上下文中结束时无法还原
+                current_trace.set(None)
+            trace.token = None
+
+        outlier = trace.duration >= self.threshold()
+        self.durations.append(trace.duration)
+        result = trace.to_dict()
+        result['outlier'] = outlier
+
+        self.traces[trace.job_id] = result
+        self.traces.move_to_end(trace.job_id)
+        while len(self.traces) > self.max_traces:
+            self.traces.popitem(last=False)
+        if outlier:
+            self.outliers.append(trace.job_id)
+
+        if outlier or trace.error or random.random() < self.sample_rate:
+            self.output.info(
+                f"任务 {trace.job_id} 耗时 {trace.duration:.2f}秒{'（慢任务）' if outlier else ''}: "
+                + ", ".join(f"{span['name']} {span['duration']:.2f}s" for span in result['spans']),
+                extra={'trace': result}
+            )
+        return result
+
+    def get(self, job_id: Any) -> Optional[dict]:
+        return self.traces.get(job_id)
+
+    def recent_outliers(self) -> List[dict]:
+        return [self.traces[job_id] for job_id in reversed(self.outliers) if job_id in self.traces]
+
+
+def format_timeline(trace: dict, limit: int = 3500) -> str:
+    """将时间线格式化为适合 Telegram 消息的文本"""
+    status = f"失败: {trace['error']}" if trace.get('error') else "成功"
+    lines = [f"任务 {trace['job_id']} {status}，耗时 {trace['duration']:.2f}秒{'（慢任务）' if trace.get('outlier') else ''}"]
+    for key, value in (trace.get('attrs') or {}).items():
+        lines.append(f"{key}: {value}")
+    for item in trace.get('spans', []):
+        attrs = ", ".join(f"{key}={value}" for key, value in (item.get('attrs') or {}).items())
+        line = f"+{item['offset']:7.2f}s {item['name']:<16} {item['duration']:7.2f}s"
+        if attrs:
+            line += f"  {attrs}"
+        if item.get('error'):
+            line += f"  错误: {item['error']}"
+        lines.append(line)
+    text = "\n".join(lines)
+    if len(text) > limit:
+        text = text[:limit] + "\n..."
+    return text
+
+
+class TraceContextFilter(logging.Filter):
+    """在日志记录中加入当前任务ID"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'job_id'):
+            record.job_id = current_job_id()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON，包含当前任务ID；追踪记录附带完整的时间线"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        job_id = getattr(record, 'job_id', None)
+        if job_id is not None:
+            entry['job_id'] = job_id
+        trace = getattr(record, 'trace', None)
+        if trace is not None:
+            entry['trace'] = trace
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
@@ -0,0 +1,172 @@
+import logging
+from typing import List, Optional
+
+from .media_info import MediaInfo
+
+logger = logging.getLogger(__name__)
+
+# Telegram 客户端可直接播放的编码
+COMPATIBLE_VIDEO_CODECS = {'h264'}
+COMPATIBLE_AUDIO_CODECS = {'aac', 'mp3'}
+
+# 分辨率阶梯（短边像素），码率不足时逐级降低分辨率
+RESOLUTION_LADDER = [1080, 720, 540, 480, 360, 240]
+
+# H.264 画质可接受的最低每像素比特数
+MIN_BITS_PER_PIXEL = 0.05
+
+# 封装格式开销占比
+CONTAINER_OVERHEAD = 0.02
+
+# 单次编码时实际码率相对目标码率的波动余量
+SINGLE_PASS_MARGIN = 0.9
+
+# 单次编码使用的 CRF 质量参数，码率上限由 maxrate 约束
+SINGLE_PASS_CRF = 23
+
+
+class TranscodePlan:
+    """转码方案"""
+    __slots__ = ('action', 'video_bitrate', 'audio_bitrate', 'scale', 'two_pass', 'reason')
+
+    # 不处理 / 仅重新封装 / 仅重编码音频 / 完整重编码
+    NONE = 'none'
+    REMUX = 'remux'
+    AUDIO = 'audio'
+    ENCODE = 'encode'
+
+    def __init__(self, action: str, reason: str, video_bitrate: Optional[int] = None,
+                 audio_bitrate: int = 128, scale: Optional[str] = None, two_pass: bool = False):
+        self.action = action
+        self.reason = reason
+        self.video_bitrate = video_bitrate
+        self.audio_bitrate = audio_bitrate
+        # ffmpeg scale 滤镜参数，不缩放时为 None
+        self.scale = scale
+        self.two_pass = two_pass
+
+    def __repr__(self) -> str:
+        return (f"TranscodePlan({self.action}, video={self.video_bitrate}k, audio={self.audio_bitrate}k, "
+                f"scale={self.scale}, two_pass={self.two_pass}, reason={self.reason})")
+
+
+def video_bitrate_budget(max_bytes: int, duration: float, audio_bitrate: int) -> int:
+    """扣除音频和封装开销后可用于视频的码率（kbps）"""
+    total_kbit = max_bytes * 8 / 1000 * (1 - CONTAINER_OVERHEAD)
+    return int(total_kbit / duration) - audio_bitrate
+
+
+def _pick_audio_bitrate(has_audio: bool, total_kbps: float) -> int:
+    """码率紧张时降低音频码率"""
+    if not has_audio:
+        return 0
+    if total_kbps < 400:
+        return 64
+    if total_kbps < 800:
+        return 96
+    return 128
+
+
+def _pick_scale(width: int, height: int, fps: float, video_bitrate: int) -> Optional[str]:
+    """选择每像素比特数满足要求的最大分辨率，返回 scale 滤镜参数，无需缩放时返回 None"""
+    if not width or not height:
+        return None
+    short_side = min(width, height)
+    aspect = max(width, height) / short_side
+    candidates = [short_side] + [size for size in RESOLUTION_LADDER if size < short_side]
+
+    target = candidates[-1]
+    for size in candidates:
+        bits_per_pixel = video_bitrate * 1000 / (size * size * aspect * fps)
+        if bits_per_pixel >= MIN_BITS_PER_PIXEL:
+            target = size
+            break
+
+    if target == short_side:
+        return None
+    # 按短边缩放，竖屏视频同样适用
+    return f'-2:{target}' if width >= height else f'{target}:-2'
+
+
+def plan_transcode(media: MediaInfo, max_bytes: int, two_pass: bool = True) -> Optional[TranscodePlan]:
+    """根据媒体信息选择代价最低的处理方式，无法规划时返回 None"""
+    file_size = media.size
+    fits = file_size <= max_bytes
+    video_ok = media.video_codec in COMPATIBLE_VIDEO_CODECS
+    audio_ok = not media.has_audio or media.audio_codec in COMPATIBLE_AUDIO_CODECS
+    duration = media.duration
+
+    if fits and video_ok and audio_ok:
+        if media.is_mp4 and media.faststart is not False:
+            return TranscodePlan(TranscodePlan.NONE, "大小和编码均符合要求")
+        return TranscodePlan(TranscodePlan.REMUX, "仅需重新封装为 faststart MP4")
+
+    if duration <= 0:
+        logger.error("无法获取视频时长，无法规划转码")
+        return None
+
+    if video_ok and not audio_ok:
+        # 仅音频不兼容或过大时，只重新编码音频
+        audio_bitrate = _pick_audio_bitrate(True, file_size * 8 / 1000 / duration)
+        estimated = (media.video_bitrate + audio_bitrate) * duration * 1000 / 8
+        if media.video_bitrate and estimated <= max_bytes * (1 - CONTAINER_OVERHEAD):
+            return TranscodePlan(TranscodePlan.AUDIO, "仅音频需要转码", audio_bitrate=audio_bitrate)
+        if fits:
+            return TranscodePlan(TranscodePlan.AUDIO, "仅音频编码不兼容", audio_bitrate=audio_bitrate)
+
+    total_kbps = max_bytes * 8 / 1000 / duration
+    audio_bitrate = _pick_audio_bitrate(media.has_audio, total_kbps)
+    budget = video_bitrate_budget(max_bytes, duration, audio_bitrate)
+    if media.video_bitrate:
+        budget = min(budget, media.video_bitrate)
+    budget = max(budget, 100)
+
+    # ffmpeg 默认按旋转信息自动旋转画面，缩放按显示尺寸计算
+    width, height = media.display_size
+    scale = _pick_scale(width, height, media.fps, budget)
+    # 大小本就符合要求时单次编码即可；需要精确命中目标大小时使用两遍编码
+    use_two_pass = two_pass and not fits
+    return TranscodePlan(
+        TranscodePlan.ENCODE,
+        "大小超出限制" if not fits else "视频编码不兼容",
+        video_bitrate=budget if use_two_pass else int(budget * SINGLE_PASS_MARGIN),
+        audio_bitrate=audio_bitrate,
+        scale=scale,
+        two_pass=use_two_pass
+    )
+
+
+def build_commands(plan: TranscodePlan, input_path: str, output_path: str,
+                   passlog_prefix: str) -> List[List[str]]:
+    """根据方案生成 ffmpeg 命令，两遍编码时返回两条命令"""
+    audio_args = (
+        ['-c:a', 'aac', '-b:a', f'{plan.audio_bitrate}k'] if plan.audio_bitrate else ['-an']
+    )
+    tail = ['-movflags', '+faststart', '-y', output_path]
+
+    if plan.action == TranscodePlan.REMUX:
+        return [['ffmpeg', '-i', input_path, '-c', 'copy'] + tail]
+
+    if plan.action == TranscodePlan.AUDIO:
+        return [['ffmpeg', '-i', input_path, '-c:v', 'copy'] + audio_args + tail]
+
+    video_args = ['-c:v', 'libx264', '-preset', 'medium', '-pix_fmt', 'yuv420p']
+    if plan.scale:
+        video_args += ['-vf', f'scale={plan.scale}']
+
+    bitrate = plan.video_bitrate
+    if not plan.two_pass:
+        return [
+            ['ffmpeg', '-i', input_path] + video_args
+            + ['-crf', str(SINGLE_PASS_CRF), '-maxrate', f'{bitrate}k', '-bufsize', f'{bitrate * 2}k']
+            + audio_args + tail
+        ]
+
+    return [
+        ['ffmpeg', '-i', input_path] + video_args
+        + ['-b:v', f'{bitrate}k', '-pass', '1', '-passlogfile', passlog_prefix,
+           '-an', '-f', 'mp4', '-y', '/dev/null'],
+        ['ffmpeg', '-i', input_path] + video_args
+        + ['-b:v', f'{bitrate}k', '-pass', '2', '-passlogfile', passlog_prefix]
+        + audio_args + tail
+    ]
@@ -0,0 +1,152 @@
+import os
+import time
+import heapq
+import shutil
+import asyncio
+import logging
+import itertools
+from typing import List, Optional, Tuple
+
+from . import tracing
+from .adaptive_limiter import AdaptiveLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class TranscodeCancelledError(Exception):
+    """转码任务被取消"""
+
+
+class TranscodePool:
+    """
+    转码进程池
+    限制同时运行的 ffmpeg 进程数，为每个进程分配固定线程数并降低调度优先级，
+    等待中的任务按优先级（数值越小越先执行）排队，调用方任务被取消时退出排队或终止进程。
+    设置 adaptive_max 时进程数以 max_processes 为初始值，根据每 MB 输入的转码耗时在 [1, adaptive_max] 之间自动调整
+    """
+    def __init__(
+        self,
+        max_processes: Optional[int] = None,
+        threads_per_job: Optional[int] = None,
+        niceness: int = 10,
+        backpressure_threshold: Optional[int] = None,
+        adaptive_max: Optional[int] = None
+    ):
+        self.cpu_count = os.cpu_count() or 1
+        self.max_processes = max_processes or max(1, self.cpu_count // 2)
+        # 未指定时按当前进程数上限均分 CPU，进程数自适应调整后随之变化
+        self.threads_override = threads_per_job
+        self.limiter = AdaptiveLimiter(
+            'transcode', self.max_processes, max_limit=adaptive_max, window=3, on_change=self.set_limit
+        ) if adaptive_max else None
+        if self.limiter is not None:
+            self.max_processes = self.limiter.limit
+        self.niceness = niceness
+        # 等待中的任务数达到该值时视为饱和，调度器应暂停派发新任务；未设置时随当前进程数上限变化
+        self.backpressure_threshold = backpressure_threshold
+
+        self.nice_prefix = ['nice', '-n', str(niceness)] if niceness and shutil.which('nice') else []
+
+        self.running = 0
+        self.waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+
+    @property
+    def threads_per_job(self) -> int:
+        """每个 ffmpeg 进程的线程数"""
+        return self.threads_override or max(1, self.cpu_count // self.max_processes)
+
+    @property
+    def waiting(self) -> int:
+        """等待中的任务数"""
+        return sum(1 for _, _, future in self.waiters if not future.done())
+
+    @property
+    def saturated(self) -> bool:
+        """进程池是否饱和"""
+        threshold = self.backpressure_threshold or self.max_processes
+        return self.running >= self.max_processes and self.waiting >= threshold
+
+    def try_acquire(self) -> bool:
+        """非阻塞地获取进程名额"""
+        if self.running < self.max_processes and not self.waiting:
+            self.running += 1
+            return True
+        return False
+
+    async def acquire(self, priority: float = 0):
+        """获取进程名额，已满时按优先级排队"""
+        if self.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已移交但等待者被取消，归还名额
+                self.release()
+            raise
+
+    def release(self):
+        """释放进程名额，未超过上限时移交给优先级最高的等待者"""
+        self.running -= 1
+        self._wake()
+
+    def set_limit(self, limit: int):
+        """修改进程数上限，下调时等待运行中的进程结束后生效"""
+        self.max_processes = limit
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.running < self.max_processes:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    def build_command(self, cmd: List[str]) -> List[str]:
+        """加上线程数限制和 nice 前缀，线程参数作为输出选项放在输出文件之前"""
+        return self.nice_prefix + cmd[:-1] + ['-threads', str(self.threads_per_job), cmd[-1]]
+
+    async def spawn(self, cmd: List[str], **kwargs) -> asyncio.subprocess.Process:
+        """在已持有名额的情况下启动进程"""
+        return await asyncio.create_subprocess_exec(*self.build_command(cmd), **kwargs)
+
+    async def run(self, cmd: List[str], priority: float = 0, cost: Optional[float] = None) -> Tuple[int, bytes]:
+        """排队执行 ffmpeg 命令，返回 (退出码, 标准错误输出)；cost 为输入文件的字节数，用于自适应进程数"""
+        start = time.monotonic()
+        await self.acquire(priority)
+        tracing.add(pool_wait=round(time.monotonic() - start, 3), commands=1)
+
+        process = None
+        inflight = self.running
+        run_start = time.monotonic()
+        try:
+            process = await self.spawn(
+                cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await process.communicate()
+            if process.returncode < 0:
+                raise TranscodeCancelledError("转码进程已终止")
+            if self.limiter is not None and process.returncode == 0:
+                self.limiter.sample(time.monotonic() - run_start, inflight, cost)
+            return process.returncode, stderr
+        finally:
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+            self.release()
+
+    def get_stats(self) -> dict:
+        """获取进程池统计信息"""
+        return {
+            'running': self.running,
+            'waiting': self.waiting,
+            'max_processes': self.max_processes,
+            'saturated': self.saturated,
+            'threads_per_job': self.threads_per_job,
+            'adaptive': self.limiter is not None
+        }
@@ -0,0 +1,47 @@
+import re
+from typing import List
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"]+', re.IGNORECASE)
+# 链接末尾常见的标点，通常属于正文而不是链接
+TRAILING_PUNCTUATION = '.,;:!?)]}>\'"，。；：！？）】'
+
+# 不影响内容的跟踪参数，归一化时去除
+TRACKING_PARAMS = {
+    'si', 'igshid', 'igsh', 'fbclid', 'gclid', 'feature', 'ref', 'ref_src',
+    'ref_url', 's', 't', 'is_from_webapp', 'sender_device', 'share_id', 'mibextid',
+}
+
+
+def normalize_url(url: str) -> str:
+    """归一化URL，使同一视频的不同分享链接得到相同的键"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if host.startswith('m.'):
+        host = host[2:]
+
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_PARAMS and not key.startswith('utm_')
+    ]
+    query.sort()
+
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower(), host, path, urlencode(query), ''))
+
+
+def extract_urls(text: str, limit: int = 10) -> List[str]:
+    """提取文本中的所有链接，按归一化后的键去重并保持顺序，最多返回 limit 个"""
+    urls = []
+    seen = set()
+    for match in URL_PATTERN.finditer(text or ''):
+        url = match.group(0).rstrip(TRAILING_PUNCTUATION)
+        key = normalize_url(url)
+        if key not in seen:
+            seen.add(key)
+            urls.append(url)
+            if len(urls) >= limit:
+                break
+    return urls
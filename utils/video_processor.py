@@ -1,127 +1,299 @@
 import os
+import time
+import uuid
 import logging
 import asyncio
-import subprocess
-from typing import Optional
+from typing import List, Optional
+
+from . import tracing
+from .media_info import MediaInfo, MediaProber, moov_before_mdat
+from .metrics import Metrics
+from .transcode_pool import TranscodePool
+from .transcode_planner import TranscodePlan, build_commands, plan_transcode, video_bitrate_budget
 
 logger = logging.getLogger(__name__)
 
+
 class VideoProcessor:
-    def __init__(self, max_size_mb: int = 50):
+    def __init__(self, max_size_mb: int = 50, stream_threshold: float = 1.5,
+                 transcode_pool: Optional[TranscodePool] = None, two_pass: bool = True,
+                 max_attempts: int = 3, prober: Optional[MediaProber] = None,
+                 metrics: Optional[Metrics] = None):
         self.max_size_mb = max_size_mb
+        self.two_pass = two_pass
+        # 输出超出大小限制时按实际大小修正码率重试的次数
+        self.max_attempts = max_attempts
+        # 各阶段共享的媒体信息缓存，每个文件只探测一次
+        self.prober = prober or MediaProber(metrics=metrics)
+        self.metrics = metrics
+        # 所有 ffmpeg 转码进程都通过进程池启动
+        self.transcode_pool = transcode_pool or TranscodePool()
+        # 文件大小超过限制的该倍数时，才认为必然需要压缩并启用边下载边压缩
+        self.stream_threshold = stream_threshold
+
+    @property
+    def max_bytes(self) -> int:
+        """大小限制（字节）"""
+        return self.max_size_mb * 1024 * 1024
+
+    def _compress_command(self, input_path: str, output_path: str, bitrate: int) -> List[str]:
+        """生成流式压缩命令"""
+        return [
+            'ffmpeg', '-i', input_path,
+            '-c:v', 'libx264',
+            '-b:v', f'{bitrate}k',
+            '-maxrate', f'{bitrate}k',
+            '-bufsize', f'{bitrate * 2}k',
+            '-preset', 'medium',
+            '-c:a', 'aac',
+            '-b:a', '128k',
+            '-movflags', '+faststart',
+            '-y',  # 覆盖已存在的文件
+            output_path
+        ]
+
+    def _target_bitrate(self, duration: float) -> int:
+        """计算目标视频码率（kbps），扣除音频码率和封装开销"""
+        return max(video_bitrate_budget(self.max_bytes, duration, 128), 100)
+
+    def create_stream_compressor(self, output_dir: str) -> "StreamingCompressor":
+        """创建边下载边压缩的处理器"""
+        output_path = os.path.join(output_dir, f"{uuid.uuid4().hex}_stream.mp4")
+        return StreamingCompressor(self, output_path)
 
     async def compress_video(self, input_path: str) -> Optional[str]:
-        """压缩视频文件"""
+        """
+        压缩视频文件
+        根据媒体信息选择不处理、重新封装、仅转码音频或完整重编码，
+        输出超出大小限制时按实际大小修正码率重试
+        """
+        output_path = f"{os.path.splitext(input_path)[0]}_compressed.mp4"
+        passlog_prefix = f"{os.path.splitext(input_path)[0]}_passlog"
         try:
             # 检查输入文件是否存在
             if not os.path.exists(input_path):
                 logger.error(f"输入文件不存在: {input_path}")
                 return None
 
-            # 获取文件大小（MB）
-            file_size = os.path.getsize(input_path) / (1024 * 1024)
-            if file_size <= self.max_size_mb:
-                return input_path
-
-            # 创建输出文件路径
-            output_path = f"{os.path.splitext(input_path)[0]}_compressed.mp4"
-            
-            # 计算目标比特率（kbps）
-            target_size = self.max_size_mb * 8192  # 将MB转换为kbit
-            duration = await self._get_video_duration(input_path)
-            if not duration:
+            media = await self.probe(input_path)
+            if not media:
                 return None
-            
-            bitrate = int(target_size / duration)
-            
-            # 使用ffmpeg压缩视频
-            cmd = [
-                'ffmpeg', '-i', input_path,
-                '-c:v', 'libx264',
-                '-b:v', f'{bitrate}k',
-                '-preset', 'medium',
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-y',  # 覆盖已存在的文件
-                output_path
-            ]
-
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                logger.error(f"视频压缩失败: {stderr.decode()}")
+
+            file_size = media.size
+            plan = plan_transcode(media, self.max_bytes, self.two_pass)
+            if plan is None:
                 return None
+            logger.info(f"转码方案: {plan}")
+            tracing.annotate(action=plan.action, input_size=file_size)
+            if plan.action == TranscodePlan.NONE:
+                return input_path
+
+            for attempt in range(1, self.max_attempts + 1):
+                if not await self._run_plan(plan, input_path, output_path, passlog_prefix, file_size):
+                    return None
+
+                output_size = os.path.getsize(output_path)
+                tracing.annotate(output_size=output_size, attempts=attempt)
+                logger.info(
+                    f"视频处理完成 ({plan.action}): {file_size / 1024 / 1024:.1f}MB -> "
+                    f"{output_size / 1024 / 1024:.1f}MB"
+                )
+                if output_size <= self.max_bytes:
+                    break
+
+                if plan.action != TranscodePlan.ENCODE or attempt == self.max_attempts:
+                    logger.error(f"处理后的视频仍超出大小限制: {output_size / 1024 / 1024:.1f}MB")
+                    return None
+
+                # 按实际超出比例修正码率后重试
+                plan.video_bitrate = max(int(plan.video_bitrate * self.max_bytes / output_size * 0.95), 50)
+                logger.warning(f"输出超出大小限制，修正码率为 {plan.video_bitrate}k 后重试 ({attempt}/{self.max_attempts})")
 
-            # 检查压缩后的文件大小
-            compressed_size = os.path.getsize(output_path) / (1024 * 1024)
-            logger.info(f"视频压缩完成: {file_size:.1f}MB -> {compressed_size:.1f}MB")
-            
             # 删除原文件
             os.remove(input_path)
             return output_path
 
         except Exception as e:
             logger.error(f"视频压缩过程出错: {e}")
+            if os.path.exists(output_path):
+                os.remove(output_path)
             return None
 
-    async def _get_video_duration(self, video_path: str) -> Optional[float]:
-        """获取视频时长（秒）"""
+        finally:
+            for suffix in ('-0.log', '-0.log.mbtree'):
+                if os.path.exists(passlog_prefix + suffix):
+                    os.remove(passlog_prefix + suffix)
+
+    async def _run_plan(self, plan: TranscodePlan, input_path: str, output_path: str,
+                        passlog_prefix: str, file_size: int) -> bool:
+        """在进程池中依次执行方案的命令，小文件优先"""
+        start_time = time.perf_counter()
+        for cmd in build_commands(plan, input_path, output_path, passlog_prefix):
+            returncode, stderr = await self.transcode_pool.run(cmd, priority=file_size, cost=file_size)
+            if returncode != 0:
+                logger.error(f"视频处理失败: {stderr.decode(errors='ignore')}")
+                return False
+        if self.metrics is not None:
+            self.metrics.transcode_duration.labels(plan.action).observe(time.perf_counter() - start_time)
+        return True
+
+    async def probe(self, video_path: str) -> Optional[MediaInfo]:
+        """获取媒体信息（带缓存）"""
+        return await self.prober.probe(video_path)
+
+    async def check_video_integrity(self, file_path: str) -> bool:
+        """检查视频文件完整性"""
+        media = await self.probe(file_path)
+        return media is not None and media.has_video
+
+
+class StreamingCompressor:
+    """
+    边下载边压缩
+    下载的数据在写入磁盘的同时送入 ffmpeg 标准输入，使网络传输和转码重叠进行。
+    输入无法流式解码时自动放弃，由调用方回退到先下载后压缩。
+    创建后必须调用 finish 或 abort 之一，否则转码名额和 ffmpeg 进程不会释放；closed 表示已结束
+    """
+    def __init__(self, processor: VideoProcessor, output_path: str,
+                 head_size: int = 2 * 1024 * 1024):
+        self.processor = processor
+        self.output_path = output_path
+        self.head_size = head_size
+        self.pool = processor.transcode_pool
+        self.slot_acquired = False
+        self.closed = False
+
+        self.enabled = False
+        self.failed = False
+        self.head = bytearray()
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.stderr_task: Optional[asyncio.Task] = None
+        self.start_time = 0.0
+
+    @property
+    def active(self) -> bool:
+        """是否正在向 ffmpeg 送入数据"""
+        return self.enabled and not self.failed
+
+    async def open(self, total: Optional[int]) -> bool:
+        """根据文件总大小决定是否启用流式压缩，返回 True 表示需要按顺序送入数据"""
+        if total is None or total / (1024 * 1024) <= self.processor.max_size_mb * self.processor.stream_threshold:
+            return False
+        if not self.pool.try_acquire():
+            logger.info("转码进程池已满，不启用边下载边压缩")
+            return False
+        self.slot_acquired = True
+        self.enabled = True
+        return True
+
+    async def feed(self, chunk: bytes):
+        """送入下载的数据"""
+        if not self.active:
+            return
         try:
-            cmd = [
-                'ffprobe',
-                '-v', 'error',
-                '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1',
-                video_path
-            ]
-            
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                logger.error(f"获取视频时长失败: {stderr.decode()}")
-                return None
-                
-            duration = float(stdout.decode().strip())
-            return duration
+            if self.process is None:
+                self.head.extend(chunk)
+                if len(self.head) >= self.head_size:
+                    await self._start()
+                return
 
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
         except Exception as e:
-            logger.error(f"获取视频时长出错: {e}")
-            return None
+            logger.warning(f"边下载边压缩失败，将回退到下载后压缩: {e}")
+            await self.abort()
 
-    @staticmethod
-    async def check_video_integrity(file_path: str) -> bool:
-        """检查视频文件完整性"""
+    async def _start(self):
+        """检查文件头并启动 ffmpeg"""
+        head = bytes(self.head)
+        self.head = bytearray()
+
+        # MP4 的 moov 在文件末尾时无法从管道解码
+        if head[4:8] == b'ftyp' and not moov_before_mdat(head):
+            raise ValueError("MP4 索引位于文件末尾，无法流式解码")
+
+        # 在线检查完整性并获取时长
+        media = await MediaProber.probe_head(head)
+        if not media or not media.has_video or not media.duration:
+            raise ValueError("无法从文件头获取视频时长")
+
+        bitrate = self.processor._target_bitrate(media.duration)
+        cmd = self.processor._compress_command('pipe:0', self.output_path, bitrate)
+        cmd[1:1] = ['-loglevel', 'error', '-nostats']
+        self.process = await self.pool.spawn(
+            cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self.stderr_task = asyncio.create_task(self.process.stderr.read())
+        self.start_time = time.perf_counter()
+        logger.info(f"开始边下载边压缩，目标比特率: {bitrate}k")
+
+        self.process.stdin.write(head)
+        await self.process.stdin.drain()
+
+    async def finish(self) -> Optional[str]:
+        """
+        下载完成后等待 ffmpeg 结束，成功时返回输出文件路径
+        单遍编码的输出超出大小限制时返回 None，由调用方保留原文件并用 compress_video 按实际大小修正码率重新压缩
+        """
         try:
-            cmd = [
-                'ffprobe',
-                '-v', 'error',
-                '-select_streams', 'v:0',
-                '-show_entries', 'stream=codec_type',
-                '-of', 'default=noprint_wrappers=1:nokey=1',
-                file_path
-            ]
-            
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
-            return process.returncode == 0 and stdout.decode().strip() == 'video'
-            
+            if not self.active or self.process is None:
+                return None
+
+            self.process.stdin.close()
+            await self.process.wait()
+            stderr = await self.stderr_task
+            if self.process.returncode != 0:
+                logger.error(f"边下载边压缩失败: {stderr.decode(errors='ignore')}")
+                self._remove_output()
+                return None
+
+            output_size = os.path.getsize(self.output_path)
+            size_mb = output_size / (1024 * 1024)
+            if output_size > self.processor.max_bytes:
+                logger.warning(f"边下载边压缩的输出超出大小限制: {size_mb:.1f}MB，回退到下载后压缩")
+                self._remove_output()
+                return None
+            logger.info(f"边下载边压缩完成: {size_mb:.1f}MB")
+            if self.processor.metrics is not None:
+                self.processor.metrics.transcode_duration.labels('stream').observe(
+                    time.perf_counter() - self.start_time
+                )
+            return self.output_path
+        except asyncio.CancelledError:
+            # 等待期间任务被取消，终止 ffmpeg 并删除输出
+            await self.abort()
+            raise
         except Exception as e:
-            logger.error(f"检查视频完整性失败: {e}")
-            return False
+            logger.error(f"等待压缩进程失败: {e}")
+            self._remove_output()
+            return None
+        finally:
+            self.closed = True
+            self._release_slot()
+
+    async def abort(self):
+        """放弃流式压缩"""
+        self.failed = True
+        self.closed = True
+        self.head = bytearray()
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        if self.stderr_task is not None:
+            self.stderr_task.cancel()
+        self._remove_output()
+        self._release_slot()
+
+    def _release_slot(self):
+        """释放转码名额"""
+        if self.slot_acquired:
+            self.pool.release()
+            self.slot_acquired = False
+
+    def _remove_output(self):
+        """删除未完成的输出文件"""
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)